@@ -9,6 +9,7 @@
   rich,
   ruff,
   setuptools,
+  zstandard,
 }:
 let
   inherit (lib.fileset) toSource unions;
@@ -37,11 +38,13 @@ let
     nativeCheckInputs = [
       pyright
       ruff
+      zstandard
     ];
     optional-dependencies.dev = [
       pyright
       ruff
     ];
+    optional-dependencies.zstd = [ zstandard ];
     doCheck = true;
     checkPhase =
       # preCheck
@@ -0,0 +1,120 @@
+"""
+Micro-benchmark of the per-evaluation overhead of capturing the stats, output, and stderr of nix.
+
+Runs a stand-in for `nix eval` which does nothing but write small stats, output, and stderr, so what is measured is the
+cost of capturing them: with a temporary file for stats and pipes for stdout and stderr, as nix-eval-jobs-python used
+to; with anonymous memory files (see `nix_eval_jobs.nix.eval.raw.Capture`); and with stats not shown at all.
+
+    python -m nix_eval_jobs.bench.capture --calls 500
+"""
+
+import json
+import os
+import resource
+from argparse import ArgumentParser, Namespace
+from collections.abc import Callable, Mapping, Sequence
+from pathlib import Path
+from subprocess import PIPE, Popen
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+from typing import Final
+
+import nix_eval_jobs.nix.eval.raw
+from nix_eval_jobs.nix.eval.raw import Capture, RawNixEvalResult
+
+_STATS: Final[str] = json.dumps({
+    "cpuTime": 0.01,
+    "envs": {"bytes": 5500000, "elements": 420000, "number": 275000},
+    "gc": {"cycles": 0, "heapSize": 402915328, "totalBytes": 118000000},
+    "list": {"bytes": 700000, "concats": 10000, "elements": 88000},
+    "nrAvoided": 350000,
+    "nrExprs": 177000,
+    "nrFunctionCalls": 230000,
+    "nrLookups": 140000,
+    "nrOpUpdateValuesCopied": 3400000,
+    "nrOpUpdates": 27000,
+    "nrPrimOpCalls": 186000,
+    "nrThunks": 686000,
+    "sets": {"bytes": 66000000, "elements": 4080000, "number": 53000},
+    "sizes": {"Attr": 16, "Bindings": 16, "Env": 8, "Value": 24},
+    "symbols": {"bytes": 383605, "number": 36905},
+    "time": {"cpu": 0.01, "gc": 0.0, "gcFraction": 0.0},
+    "values": {"bytes": 28750000, "number": 1198000},
+})
+
+# Writes stats if asked to, like nix, and a warning and a value.
+_FAKE_EVAL: Final[Sequence[str]] = [
+    "/bin/sh",
+    "-c",
+    f"""[ -n "$NIX_SHOW_STATS_PATH" ] && printf '%s' '{_STATS}' > "$NIX_SHOW_STATS_PATH"; """
+    + """printf 'warning: unknown setting\\n' >&2; printf '{"drvPath": "/nix/store/x.drv"}'""",
+]
+
+
+def _tmpfile_capture() -> RawNixEvalResult:
+    with NamedTemporaryFile() as stats_file:
+        env = os.environ | {"NIX_SHOW_STATS": "1", "NIX_SHOW_STATS_PATH": stats_file.name, "GC_DONT_GC": "1"}
+        with Popen(args=_FAKE_EVAL, stdout=PIPE, stderr=PIPE, env=env) as proc:
+            stdout, stderr = proc.communicate()
+        stats_json = Path(stats_file.name).read_bytes()
+    return nix_eval_jobs.nix.eval.raw.parse_result(stats_json, stdout, stderr, proc.returncode)
+
+
+def _memfd_capture() -> RawNixEvalResult:
+    with Capture(show_stats=True) as capture:
+        return nix_eval_jobs.nix.eval.raw.run_once(_FAKE_EVAL, capture)
+
+
+def _no_stats_capture() -> RawNixEvalResult:
+    with Capture(show_stats=False) as capture:
+        return nix_eval_jobs.nix.eval.raw.run_once(_FAKE_EVAL, capture)
+
+
+_MODES: Final[Mapping[str, Callable[[], RawNixEvalResult]]] = {
+    "tmpfile": _tmpfile_capture,
+    "memfd": _memfd_capture,
+    "no-stats": _no_stats_capture,
+}
+
+
+def time_calls(capture: Callable[[], RawNixEvalResult], calls: int) -> tuple[float, float]:
+    """
+    Returns the wall time and the CPU time of this process in seconds taken to make `calls` evaluations.
+    """
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = perf_counter()
+    for _ in range(calls):
+        _ = capture()
+    elapsed = perf_counter() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = end_usage.ru_utime + end_usage.ru_stime - start_usage.ru_utime - start_usage.ru_stime
+    return elapsed, cpu_time
+
+
+def setup_argparse() -> ArgumentParser:
+    parser = ArgumentParser(description="Compare ways of capturing the stats, output, and stderr of nix")
+    _ = parser.add_argument("--calls", type=int, help="Number of evaluations per measurement", default=200)
+    _ = parser.add_argument("--repeat", type=int, help="Number of times to measure each way", default=5)
+    return parser
+
+
+def main() -> None:
+    args: Namespace = setup_argparse().parse_args()
+
+    # Every way must produce the same result for the comparison to be meaningful, short of stats when they are skipped.
+    results = {mode: capture() for mode, capture in _MODES.items()}
+    if (
+        results["tmpfile"] != results["memfd"]
+        or results["memfd"].model_copy(update={"stats": None}) != results["no-stats"]
+    ):
+        raise SystemExit(f"Ways of capturing produced different results: {results}")
+
+    print(f"Making {args.calls} evaluations, best of {args.repeat}")
+    for mode, capture in _MODES.items():
+        elapsed, cpu_time = min(time_calls(capture, args.calls) for _ in range(args.repeat))
+        per_call_wall, per_call_cpu = elapsed / args.calls * 1e6, cpu_time / args.calls * 1e6
+        print(f"{mode:>8}: {per_call_wall:.0f}us wall, {per_call_cpu:.0f}us CPU per evaluation")
+
+
+if __name__ == "__main__":
+    main()
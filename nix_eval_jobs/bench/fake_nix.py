@@ -0,0 +1,234 @@
+"""
+A stand-in for the `nix` executable, serving a synthetic or recorded attribute tree, for benchmarking without Nix.
+
+It understands only the invocations nix-eval-jobs-python makes with the subprocess backend: `nix flake metadata`, and
+`nix eval` of an attribute path with info.nix, `builtins.attrNames`, a batch of children (many.nix), or the baseline
+expression applied to it. Like `nix eval`, it writes stats to `NIX_SHOW_STATS_PATH`.
+
+The tree is described by a JSON file named by `NIX_EVAL_JOBS_FAKE_NIX` (see `nix_eval_jobs.bench.harness`). Since it is
+run for every evaluation, this only uses the standard library, so it starts about as fast as Python can.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from hashlib import blake2b
+from pathlib import Path
+from typing import Any
+
+_EVAL_DIR = Path(__file__).parent.parent / "nix" / "eval"
+# info.nix is applied to its settings before the value.
+_INFO_NIX_PREFIX = f"({(_EVAL_DIR / 'info.nix').read_text()}) "
+_MANY_NIX_PREFIX = f"({(_EVAL_DIR / 'many.nix').read_text()}) "
+_NIX_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+
+def _parse_nix_string(escaped: str) -> str:
+    unescaped = escaped.replace("\\$", "$")
+    return json.loads(f'"{unescaped}"')
+
+
+def _parse_attr_path(attr_path: str) -> list[str]:
+    # The inverse of show_attr_path: identifiers separated by dots, where identifiers may be quoted strings.
+    names: list[str] = []
+    while attr_path:
+        if (match := _NIX_STRING.match(attr_path)) is not None:
+            names.append(_parse_nix_string(match.group(1)))
+            attr_path = attr_path[match.end() :]
+        else:
+            name, _, attr_path = attr_path.partition(".")
+            names.append(name)
+            continue
+        attr_path = attr_path.removeprefix(".")
+    return names
+
+
+def _fraction(seed: int, key: str) -> float:
+    # A deterministic number in [0, 1) for each key, so every evaluation of an attribute agrees.
+    digest = blake2b(f"{seed}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest) / 2**64
+
+
+def _stats(weight: float, cpu_time: float) -> dict[str, Any]:
+    def scaled(base: int) -> int:
+        return round(base * weight)
+
+    return {
+        "cpuTime": cpu_time,
+        "envs": {"bytes": scaled(5_500_000), "elements": scaled(420_000), "number": scaled(275_000)},
+        "gc": {"cycles": 0, "heapSize": 402_915_328, "totalBytes": scaled(118_000_000)},
+        "list": {"bytes": scaled(700_000), "concats": scaled(10_000), "elements": scaled(88_000)},
+        "nrAvoided": scaled(350_000),
+        "nrExprs": scaled(177_000),
+        "nrFunctionCalls": scaled(230_000),
+        "nrLookups": scaled(140_000),
+        "nrOpUpdateValuesCopied": scaled(3_400_000),
+        "nrOpUpdates": scaled(27_000),
+        "nrPrimOpCalls": scaled(186_000),
+        "nrThunks": scaled(686_000),
+        "sets": {"bytes": scaled(66_000_000), "elements": scaled(4_080_000), "number": scaled(53_000)},
+        "sizes": {"Attr": 16, "Bindings": 16, "Env": 8, "Value": 24},
+        "symbols": {"bytes": 383_605, "number": 36_905},
+        "time": {"cpu": cpu_time, "gc": 0.0, "gcFraction": 0.0},
+        "values": {"bytes": scaled(28_750_000), "number": scaled(1_198_000)},
+    }
+
+
+class _SyntheticTree:
+    """
+    A tree of `fan_out[d]` children at each depth `d` below the root, whose leaves are derivations.
+
+    A fraction `alias_rate` of the scopes below the top level are aliases of their first sibling, as package sets for
+    different versions of an interpreter often are, so everything below them is the same.
+    """
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.fan_out: list[int] = config.get("fan_out", [10, 100])
+        self.failure_rate: float = config.get("failure_rate", 0.0)
+        self.alias_rate: float = config.get("alias_rate", 0.0)
+        self.seed: int = config.get("seed", 0)
+        self.root_depth: int = len(config.get("root", ["root"]))
+
+    def _canonical(self, attr_path: list[str]) -> list[str]:
+        canonical = attr_path[: self.root_depth + 1]
+        for name in attr_path[self.root_depth + 1 :]:
+            depth = len(canonical) + 1 - self.root_depth
+            is_scope = depth < len(self.fan_out)
+            is_alias = is_scope and _fraction(self.seed + 2, ".".join([*canonical, name])) < self.alias_rate
+            canonical.append("a0" if is_alias else name)
+        return canonical
+
+    def node(self, attr_path: list[str], probe: bool = False) -> dict[str, Any] | None:
+        """
+        Returns the info.nix result for the attribute, or None if evaluating it fails.
+        """
+        depth = len(attr_path) - self.root_depth
+        if depth < len(self.fan_out):
+            names = [f"a{i}" for i in range(self.fan_out[depth])]
+            probe_drv_path = None
+            if probe and depth == len(self.fan_out) - 1:
+                children = (self.node([*attr_path, name]) for name in names[:4])
+                probe_drv_path = next((child["drvPath"] for child in children if child is not None), None)
+            return {
+                "include": False,
+                "drvPath": None,
+                "recurse": True,
+                "attrNames": names,
+                "probeDrvPath": probe_drv_path,
+                "name": None,
+                "system": None,
+            }
+
+        attr_path = self._canonical(attr_path)
+        key = ".".join(attr_path)
+        if _fraction(self.seed, key) < self.failure_rate:
+            return None
+        name = "-".join(attr_path[self.root_depth :])
+        return {
+            "include": True,
+            "drvPath": f"/nix/store/{blake2b(key.encode(), digest_size=16).hexdigest()}-{name}.drv",
+            "recurse": False,
+            "attrNames": None,
+            "name": name,
+            "system": "x86_64-linux",
+        }
+
+    def weight(self, attr_path: list[str]) -> float:
+        # Costs are skewed, as in nixpkgs: most attributes are cheap and a few are very expensive.
+        return 0.2 + _fraction(self.seed + 1, ".".join(self._canonical(attr_path))) ** 4 * 4
+
+
+class _RecordedTree:
+    """
+    A tree recorded from the output of a real run into a SQLite database by the harness.
+    """
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self._conn: sqlite3.Connection = sqlite3.connect(config["recorded"])
+
+    def node(self, attr_path: list[str], probe: bool = False) -> dict[str, Any] | None:
+        # Scopes are never probed, since the recorded output has no fingerprints.
+        del probe
+        row = self._conn.execute("SELECT info FROM nodes WHERE attr_path = ?", (json.dumps(attr_path),)).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] is not None else None
+
+    def weight(self, attr_path: list[str]) -> float:
+        row = self._conn.execute("SELECT weight FROM nodes WHERE attr_path = ?", (json.dumps(attr_path),)).fetchone()
+        return row[0] if row is not None else 1.0
+
+
+def _eval(config: dict[str, Any], args: list[str]) -> int:
+    tree = _RecordedTree(config) if "recorded" in config else _SyntheticTree(config)
+    ref = next(arg for arg in args if "#" in arg)
+    attr_path = _parse_attr_path(ref.split("#", 1)[1])
+    apply_expr = args[args.index("--apply") + 1]
+
+    children: list[str] | None = None
+    if apply_expr.startswith(_MANY_NIX_PREFIX):
+        children = [_parse_nix_string(name) for name in _NIX_STRING.findall(apply_expr.rsplit("[", 1)[1])]
+        apply_expr = apply_expr.removeprefix(_MANY_NIX_PREFIX)
+
+    # Simulate the time nix spends evaluating: a fixed cost for loading the flake and the parent, and a cost for each
+    # attribute evaluated in proportion to its weight.
+    weights = (
+        [tree.weight([*attr_path, child]) for child in children] if children is not None else [tree.weight(attr_path)]
+    )
+    latency = config.get("latency", 0.0) + config.get("latency_per_attr", 0.0) * sum(weights)
+    latency *= 1 + config.get("jitter", 0.0) * (int.from_bytes(os.urandom(8)) / 2**64 * 2 - 1)
+    time.sleep(max(0.0, latency))
+
+    if (stats_path := os.environ.get("NIX_SHOW_STATS_PATH")) is not None:
+        _ = Path(stats_path).write_text(json.dumps(_stats(sum(weights), latency)), encoding="utf-8")
+
+    probe = "probeScopes = true" in apply_expr
+    info = tree.node(attr_path, probe)
+    if children is not None:
+        # Children which fail become null, as under tryEval.
+        value: Any = [tree.node([*attr_path, child], probe) for child in children]
+    elif info is None:
+        sys.stderr.write(f"error: evaluation of {'.'.join(attr_path)} failed\n")
+        return 1
+    elif apply_expr == "builtins.attrNames":
+        value = info["attrNames"] or []
+    elif apply_expr.startswith(_INFO_NIX_PREFIX):
+        value = info
+    else:
+        # The baseline, or anything else.
+        value = None
+
+    sys.stdout.write(json.dumps(value))
+    return 0
+
+
+def _flake_metadata(config: dict[str, Any], args: list[str]) -> int:
+    flakeref = args[-1]
+    nar_hash = config.get("nar_hash", "sha256-fake")
+    sys.stdout.write(
+        json.dumps({
+            "originalUrl": flakeref,
+            "url": f"{flakeref}?narHash={nar_hash}",
+            "path": "/nix/store/fake-source",
+            "revision": "0" * 40,
+            "lastModified": 0,
+            "locked": {"narHash": nar_hash, "type": "path"},
+        })
+    )
+    return 0
+
+
+def main() -> int:
+    config: dict[str, Any] = json.loads(Path(os.environ["NIX_EVAL_JOBS_FAKE_NIX"]).read_text(encoding="utf-8"))
+    args = sys.argv[1:]
+    if args[:2] == ["flake", "metadata"]:
+        return _flake_metadata(config, args)
+    if args[:1] == ["eval"] and "--apply" in args:
+        return _eval(config, args)
+    sys.stderr.write(f"error: the fake nix does not support {' '.join(args)}\n")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+Benchmark of whole runs against a stand-in for nix (see `nix_eval_jobs.bench.fake_nix`), so the overhead of the
+scheduler can be measured on its own, without Nix, and reproducibly.
+
+The attribute tree is either synthetic, with the given fan-out at each depth, latency, and failure rate, or recorded
+from the output of a real run, in which case the relative cost of each attribute is kept. Each `--jobs` value is run in
+turn, and the measurements written by `--run-stats` are tabulated.
+
+    python -m nix_eval_jobs.bench.harness --jobs 1 2 4 8 --fan-out 20 50
+    python -m nix_eval_jobs.bench.harness --jobs 4 8 --recorded results.jsonl
+"""
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from collections.abc import Sequence
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any
+
+from rich.console import Console
+from rich.table import Table
+
+from nix_eval_jobs.output import OutputHeader, RunStats, open_for_reading
+
+_FAKE_NIX: Path = Path(__file__).parent / "fake_nix.py"
+
+
+def record_tree(output_path: Path, db_path: Path) -> Sequence[str]:
+    """
+    Records the attribute tree evaluated by a previous run into a database for the fake nix, returning the root
+    attribute path.
+
+    Only included attributes are in the output, so every attribute set containing them is recorded as recursed into.
+    Each attribute is weighed by its CPU time relative to the mean, so the fake nix keeps the spread of costs.
+    """
+    nodes: dict[tuple[str, ...], dict[str, Any]] = {}
+    children: dict[tuple[str, ...], dict[str, None]] = {}
+    cpu_times: dict[tuple[str, ...], float] = {}
+    with open_for_reading(output_path) as output:
+        root_attr_path = tuple(OutputHeader.model_validate_json(output.readline()).header.attr_path)
+        for line in output:
+            record: dict[str, Any] = json.loads(line)
+            value: dict[str, Any] = record["value"]
+            attr_path = tuple(value.pop("attrPath"))
+            del value["attr"]
+            nodes[attr_path] = value | {"attrNames": None}
+            if (stats := record["stats"]) is not None:
+                cpu_times[attr_path] = stats["cpuTime"] / record.get("batchSize", 1)
+            for depth in range(len(root_attr_path), len(attr_path)):
+                children.setdefault(attr_path[:depth], {})[attr_path[depth]] = None
+
+    for attr_path, names in children.items():
+        node = nodes.setdefault(
+            attr_path, {"include": False, "drvPath": None, "name": None, "system": None, "recurse": True}
+        )
+        node["recurse"] = True
+        node["attrNames"] = sorted(names)
+
+    mean_cpu_time = sum(cpu_times.values()) / len(cpu_times) if cpu_times else 0.0
+    with sqlite3.connect(db_path) as conn:
+        _ = conn.execute("CREATE TABLE nodes (attr_path TEXT PRIMARY KEY, info TEXT, weight REAL)")
+        _ = conn.executemany(
+            "INSERT INTO nodes VALUES (?, ?, ?)",
+            (
+                (
+                    json.dumps(list(attr_path)),
+                    json.dumps(info),
+                    cpu_times[attr_path] / mean_cpu_time if attr_path in cpu_times and mean_cpu_time else 1.0,
+                )
+                for attr_path, info in nodes.items()
+            ),
+        )
+    conn.close()
+    return root_attr_path
+
+
+def write_fake_nix(bin_dir: Path) -> None:
+    """
+    Writes a `nix` executable to `bin_dir` which runs the fake nix with this interpreter. It skips importing site for
+    a faster start, which the fake nix does not need.
+    """
+    nix = bin_dir / "nix"
+    _ = nix.write_text(
+        f"#!{sys.executable} -S\nimport runpy\nrunpy.run_path({str(_FAKE_NIX)!r}, run_name='__main__')\n",
+        encoding="utf-8",
+    )
+    nix.chmod(0o755)
+
+
+def run_once(
+    work_dir: Path,
+    config_path: Path,
+    root_attr_path: Sequence[str],
+    jobs: int,
+    args: Namespace,
+    schedule: str,
+    costs_path: Path | None = None,
+) -> RunStats:
+    run_stats_path = work_dir / f"run-stats-{jobs}.json"
+    env = os.environ | {
+        "PATH": f"{work_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+        "NIX_EVAL_JOBS_FAKE_NIX": str(config_path),
+    }
+    _ = subprocess.run(
+        args=[
+            sys.executable,
+            "-m",
+            "nix_eval_jobs",
+            "--jobs",
+            str(jobs),
+            "--engine",
+            args.engine,
+            "--batch-size",
+            str(args.batch_size),
+            "--validate",
+            args.validate,
+            "--schedule",
+            schedule,
+            "--dedup",
+            args.dedup,
+            *(["--schedule-costs", str(costs_path)] if costs_path is not None else []),
+            "--flakeref",
+            "bench",
+            "--output",
+            str(work_dir / f"output-{jobs}.jsonl"),
+            "--run-stats",
+            str(run_stats_path),
+            "--attr-path",
+            *root_attr_path,
+        ],
+        check=True,
+        env=env,
+        # The progress bar and logs of each run would drown out the results.
+        stderr=subprocess.DEVNULL,
+    )
+    return RunStats.model_validate_json(run_stats_path.read_text(encoding="utf-8"))
+
+
+def print_results(results: Sequence[tuple[int, RunStats]], console: Console) -> None:
+    table = Table(title="Benchmark results")
+    table.add_column("Jobs", justify="right")
+    table.add_column("Attributes", justify="right")
+    table.add_column("Elapsed", justify="right")
+    table.add_column("Attrs/s", justify="right")
+    table.add_column("Coordinator CPU", justify="right")
+    table.add_column("Queue latency (mean/max)", justify="right")
+    table.add_column("Task latency (mean/max)", justify="right")
+    table.add_column("Peak RSS (coordinator/children)", justify="right")
+    table.add_column("Predicted elapsed (at half)", justify="right")
+    for jobs, stats in results:
+        predictions = [
+            prediction.predicted_elapsed
+            for prediction in stats.finish_predictions
+            if prediction.elapsed >= stats.elapsed / 2
+        ]
+        table.add_row(
+            str(jobs),
+            str(stats.num_excluded + stats.num_evaluated),
+            f"{stats.elapsed:.2f}s",
+            f"{stats.attrs_per_second:.1f}",
+            f"{stats.coordinator_cpu_time:.2f}s ({stats.coordinator_cpu_time / stats.elapsed:.1%})",
+            f"{stats.queue_latency_mean * 1e3:.1f}/{stats.queue_latency_max * 1e3:.1f} ms",
+            f"{stats.task_latency_mean * 1e3:.1f}/{stats.task_latency_max * 1e3:.1f} ms",
+            f"{stats.coordinator_max_rss / 2**20:.1f}/{stats.children_max_rss / 2**20:.1f} MiB",
+            f"{predictions[0]:.2f}s" if predictions else "-",
+        )
+    console.print(table)
+
+
+def setup_argparse() -> ArgumentParser:
+    parser = ArgumentParser(description="Benchmark runs against a fake nix serving a synthetic or recorded tree")
+    _ = parser.add_argument("--jobs", type=int, nargs="+", help="Numbers of jobs to run with", default=[1, 2, 4, 8])
+    _ = parser.add_argument(
+        "--fan-out",
+        type=int,
+        nargs="+",
+        help="Number of children at each depth below the root of the synthetic tree; the last depth are derivations",
+        default=[20, 50],
+    )
+    _ = parser.add_argument(
+        "--recorded",
+        type=str,
+        help="Path to the output of a previous run whose attribute tree to serve instead of a synthetic one",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--latency",
+        type=float,
+        help="Seconds each evaluation takes regardless of what it evaluates, as for loading the flake",
+        default=0.05,
+    )
+    _ = parser.add_argument(
+        "--latency-per-attr",
+        type=float,
+        help="Mean seconds each attribute evaluated adds to an evaluation",
+        default=0.01,
+    )
+    _ = parser.add_argument("--jitter", type=float, help="Fraction by which latencies vary at random", default=0.2)
+    _ = parser.add_argument(
+        "--failure-rate",
+        type=float,
+        help="Fraction of derivations of the synthetic tree which fail to evaluate",
+        default=0.01,
+    )
+    _ = parser.add_argument(
+        "--alias-rate",
+        type=float,
+        help="Fraction of scopes of the synthetic tree below the top level which are aliases of their first sibling",
+        default=0.0,
+    )
+    _ = parser.add_argument("--seed", type=int, help="Seed of the synthetic tree", default=0)
+    _ = parser.add_argument(
+        "--engine", type=str, choices=["process", "asyncio"], help="Passed to each run", default="process"
+    )
+    _ = parser.add_argument(
+        "--schedule",
+        type=str,
+        choices=["fifo", "fan-out", "cost"],
+        help=(
+            "Passed to each run; costs for 'cost' come from --recorded, or from a run with 'fifo' and the first --jobs "
+            "before the others"
+        ),
+        default="fifo",
+    )
+    _ = parser.add_argument(
+        "--dedup", type=str, choices=["none", "derivations", "scopes"], help="Passed to each run", default="none"
+    )
+    _ = parser.add_argument("--batch-size", type=int, help="Passed to each run", default=1)
+    _ = parser.add_argument(
+        "--validate", type=str, choices=["strict", "fast"], help="Passed to each run", default="strict"
+    )
+    _ = parser.add_argument("--json", type=str, help="Path to write the measurements of every run to", default=None)
+    return parser
+
+
+def main() -> None:
+    args: Namespace = setup_argparse().parse_args()
+    console = Console()
+    with TemporaryDirectory(prefix="nix-eval-jobs-bench-") as work_dir_str:
+        work_dir = Path(work_dir_str)
+        write_fake_nix(work_dir)
+        config: dict[str, Any] = {
+            "latency": args.latency,
+            "latency_per_attr": args.latency_per_attr,
+            "jitter": args.jitter,
+        }
+        if args.recorded is not None:
+            root_attr_path = record_tree(Path(args.recorded), work_dir / "tree.sqlite")
+            config["recorded"] = str(work_dir / "tree.sqlite")
+        else:
+            root_attr_path = ["bench"]
+            config |= {
+                "fan_out": args.fan_out,
+                "failure_rate": args.failure_rate,
+                "alias_rate": args.alias_rate,
+                "seed": args.seed,
+                "root": root_attr_path,
+            }
+        config_path = work_dir / "config.json"
+        _ = config_path.write_text(json.dumps(config), encoding="utf-8")
+
+        costs_path: Path | None = None
+        if args.schedule == "cost" and args.recorded is not None:
+            costs_path = Path(args.recorded)
+        elif args.schedule == "cost":
+            console.log("Recording costs with the fifo policy")
+            _ = run_once(work_dir, config_path, root_attr_path, args.jobs[0], args, "fifo")
+            costs_path = work_dir / "costs.jsonl"
+            _ = (work_dir / f"output-{args.jobs[0]}.jsonl").rename(costs_path)
+
+        results: list[tuple[int, RunStats]] = []
+        for jobs in args.jobs:
+            console.log(f"Running with {jobs} jobs")
+            results.append((
+                jobs,
+                run_once(work_dir, config_path, root_attr_path, jobs, args, args.schedule, costs_path),
+            ))
+
+    print_results(results, console)
+    if args.json is not None:
+        _ = Path(args.json).write_text(
+            json.dumps([{"jobs": jobs} | stats.model_dump(by_alias=True) for jobs, stats in results], indent=2),
+            encoding="utf-8",
+        )
+
+
+if __name__ == "__main__":
+    main()
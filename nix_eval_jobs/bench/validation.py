@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of turning the output of nix into output lines with strict and with fast validation.
+
+Replays the records of a previous run as if nix had just produced them: the stats and value of each record are turned
+back into the stats file and output of a `nix eval`, which are then parsed, built into the info, and serialized the way
+a worker does it.
+
+    python -m nix_eval_jobs.bench.validation results.jsonl
+"""
+
+import json
+from argparse import ArgumentParser, Namespace
+from collections.abc import Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Any
+
+import nix_eval_jobs.nix.eval.info
+import nix_eval_jobs.nix.eval.raw
+import nix_eval_jobs.nix.eval.validation
+from nix_eval_jobs.output import open_for_reading
+
+
+@dataclass(frozen=True, slots=True)
+class RecordedEval:
+    attr_path: Sequence[str]
+    batch_size: int
+    stats_json: bytes
+    stdout: bytes
+    stderr: bytes
+
+
+def load_recorded(path: Path, limit: int | None = None) -> list[RecordedEval]:
+    recorded: list[RecordedEval] = []
+    with open_for_reading(path) as output:
+        # Skip the header.
+        _ = output.readline()
+        while (line := output.readline()) and (limit is None or len(recorded) < limit):
+            record: dict[str, Any] = json.loads(line)
+            value: dict[str, Any] = record["value"]
+            attr_path: Sequence[str] = value.pop("attrPath")
+            del value["attr"]
+            recorded.append(
+                RecordedEval(
+                    attr_path=attr_path,
+                    batch_size=record.get("batchSize", 1),
+                    stats_json=json.dumps(record["stats"]).encode() if record["stats"] is not None else b"",
+                    stdout=json.dumps(value).encode(),
+                    stderr=record["stderr"].encode(),
+                )
+            )
+    return recorded
+
+
+def replay(recorded: Sequence[RecordedEval], mode: nix_eval_jobs.nix.eval.validation.Validation) -> list[str]:
+    lines: list[str] = []
+    for recorded_eval in recorded:
+        raw = nix_eval_jobs.nix.eval.raw.parse_result(
+            recorded_eval.stats_json, recorded_eval.stdout, recorded_eval.stderr, 0, validation=mode
+        )
+        info = nix_eval_jobs.nix.eval.info.info_from_raw(
+            raw.stats, raw.stderr, raw.value, recorded_eval.attr_path, recorded_eval.batch_size, validation=mode
+        )
+        lines.append(
+            info.model_dump_json(by_alias=True, exclude=nix_eval_jobs.nix.eval.info.output_exclude(info), indent=None)
+        )
+    return lines
+
+
+def time_replay(recorded: Sequence[RecordedEval], mode: nix_eval_jobs.nix.eval.validation.Validation) -> float:
+    """
+    Returns the time in seconds taken to replay every record with the given validation mode.
+    """
+    start = perf_counter()
+    _ = replay(recorded, mode)
+    return perf_counter() - start
+
+
+def setup_argparse() -> ArgumentParser:
+    parser = ArgumentParser(description="Compare strict and fast validation of evaluation results")
+    _ = parser.add_argument("output", type=str, help="Path to the output of a previous run to replay")
+    _ = parser.add_argument("--limit", type=int, help="Number of records to replay", default=None)
+    _ = parser.add_argument("--repeat", type=int, help="Number of times to replay the records", default=5)
+    return parser
+
+
+def main() -> None:
+    args: Namespace = setup_argparse().parse_args()
+    recorded = load_recorded(Path(args.output), args.limit)
+    if not recorded:
+        raise SystemExit(f"{args.output} has no records")
+
+    # Both modes must produce the same output for the comparison to be meaningful.
+    if replay(recorded, "fast") != replay(recorded, "strict"):
+        raise SystemExit("strict and fast validation produced different output")
+
+    print(f"Replaying {len(recorded)} records, best of {args.repeat}")
+    best: dict[str, float] = {}
+    for mode in ("strict", "fast"):
+        best[mode] = min(time_replay(recorded, mode) for _ in range(args.repeat))
+        print(f"{mode:>6}: {best[mode]:.3f}s ({best[mode] / len(recorded) * 1e6:.1f}us per record)")
+    print(f"speedup: {best['strict'] / best['fast']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+from argparse import ArgumentParser, Namespace
+from collections.abc import Sequence
+from contextlib import closing
+from logging import Logger
+from pathlib import Path
+from typing import Final
+
+import nix_eval_jobs.index
+from nix_eval_jobs.index import IndexFormatError, OutputIndex
+from nix_eval_jobs.logger import get_logger
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+def setup_argparse() -> ArgumentParser:
+    parser = ArgumentParser(
+        prog="nix-eval-jobs-python index",
+        description="Index the output of a run, and query and compare runs by their indices",
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build an index of the output of a run")
+    _ = build_parser.add_argument("output", type=str, help="Path to the output of a run")
+    _ = build_parser.add_argument("index", type=str, help="Path to write the index to, replacing any index there")
+
+    query_parser = subparsers.add_parser(
+        "query",
+        help="Query an index; with no query, lists the attributes selected by --under and --system",
+    )
+    _ = query_parser.add_argument("index", type=str, help="Path to the index")
+    queries = query_parser.add_mutually_exclusive_group()
+    _ = queries.add_argument("--attr", type=str, help="Print what is indexed about an attribute as JSON", default=None)
+    _ = queries.add_argument(
+        "--drv-path", type=str, help="List the attributes with this derivation path, including aliases", default=None
+    )
+    _ = queries.add_argument(
+        "--children",
+        type=str,
+        help="List the children of this attribute set (or of the root, given '') with the number of records below each",
+        default=None,
+    )
+    _ = queries.add_argument(
+        "--systems", action="store_true", help="List the systems with the number of records of each, most common first"
+    )
+    _ = query_parser.add_argument(
+        "--under", type=str, help="Only list attributes at and below this attribute set", default=None
+    )
+    _ = query_parser.add_argument("--system", type=str, help="Only list attributes of this system", default=None)
+    _ = query_parser.add_argument("--limit", type=int, help="Number of attributes to list at most", default=None)
+    _ = query_parser.add_argument(
+        "--json", action="store_true", help="List what is indexed about each attribute as JSON, rather than its name"
+    )
+
+    diff_parser = subparsers.add_parser(
+        "diff",
+        help="List the attributes whose derivation was added, changed, or removed between two runs, as JSON lines",
+    )
+    _ = diff_parser.add_argument("previous", type=str, help="Path to the index of the earlier run")
+    _ = diff_parser.add_argument("current", type=str, help="Path to the index of the later run")
+    _ = diff_parser.add_argument(
+        "--under", type=str, help="Only compare attributes at and below this attribute set", default=None
+    )
+    return parser
+
+
+def query(index: OutputIndex, args: Namespace) -> None:
+    if args.attr is not None:
+        if (entry := index.entry(args.attr)) is None:
+            raise SystemExit(f"{args.attr} is not in {index.path}")
+        print(entry.model_dump_json(by_alias=True))
+    elif args.drv_path is not None:
+        for attr in index.attrs_with_drv_path(args.drv_path):
+            print(attr)
+    elif args.children is not None:
+        for node in index.children(args.children):
+            print(f"{node.num_attrs}\t{node.attr}")
+    elif args.systems:
+        for system, num_attrs in index.systems():
+            print(f"{num_attrs}\t{system}")
+    else:
+        for entry in index.entries(args.under, args.system, args.limit):
+            print(entry.model_dump_json(by_alias=True) if args.json else entry.attr)
+
+
+def diff(previous: OutputIndex, current: OutputIndex, under: str | None = None) -> None:
+    num_records = 0
+    for record in current.diff(previous, under):
+        print(record.model_dump_json(by_alias=True))
+        num_records += 1
+    LOGGER.info("%d attributes differ between %s and %s", num_records, previous.path, current.path)
+
+
+def _open(parser: ArgumentParser, path: str) -> OutputIndex:
+    try:
+        return OutputIndex(Path(path))
+    except IndexFormatError as e:
+        parser.error(str(e))
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = setup_argparse()
+    args: Namespace = parser.parse_args(argv)
+    match args.action:
+        case "build":
+            _ = nix_eval_jobs.index.build(Path(args.output), Path(args.index))
+        case "query":
+            with closing(_open(parser, args.index)) as index:
+                query(index, args)
+        case _:
+            with closing(_open(parser, args.previous)) as previous, closing(_open(parser, args.current)) as current:
+                diff(previous, current, args.under)
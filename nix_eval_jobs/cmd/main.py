@@ -1,11 +1,11 @@
+import resource
+import sys
 from argparse import ArgumentParser, Namespace
-from collections.abc import Mapping, Sequence
-from concurrent.futures import Future, ProcessPoolExecutor
+from collections.abc import Callable, Mapping, Sequence
 from logging import Logger
-from multiprocessing.managers import SyncManager
 from pathlib import Path
-from queue import Empty, Queue
-from typing import Final, TextIO
+from time import monotonic
+from typing import Final
 
 from rich.progress import (
     BarColumn,
@@ -17,8 +17,30 @@ from rich.progress import (
 )
 from rich.table import Column
 
-import nix_eval_jobs.nix.eval.info
+import nix_eval_jobs.cmd.index
+import nix_eval_jobs.cmd.report
+import nix_eval_jobs.cmd.worker
+import nix_eval_jobs.nix.eval.evaluator
+import nix_eval_jobs.nix.flake
+import nix_eval_jobs.scheduler.checkpoint
+import nix_eval_jobs.scheduler.policy
+import nix_eval_jobs.scheduler.remote
 from nix_eval_jobs.logger import CONSOLE, get_logger
+from nix_eval_jobs.metrics import Metrics
+from nix_eval_jobs.nix.eval.cache import CacheOptions
+from nix_eval_jobs.nix.eval.evaluator import EvaluatorOptions, UnknownBackendError
+from nix_eval_jobs.nix.eval.raw import EvalLimits
+from nix_eval_jobs.output import Compression, OutputHeader, OutputWriter, RunStats, infer_compression
+from nix_eval_jobs.scheduler.admission import MemoryLimits
+from nix_eval_jobs.scheduler.async_coordinator import AsyncCoordinator
+from nix_eval_jobs.scheduler.checkpoint import Checkpoint
+from nix_eval_jobs.scheduler.coordinator import Coordinator, CoordinatorBase, Counts
+from nix_eval_jobs.scheduler.dedup import Deduplicator
+from nix_eval_jobs.scheduler.exclusion import DEFAULT_EXCLUSIONS, ExclusionRules
+from nix_eval_jobs.scheduler.incremental import PreviousRun
+from nix_eval_jobs.scheduler.remote import RemoteCoordinator
+from nix_eval_jobs.scheduler.worker import WorkerOptions
+from nix_eval_jobs.tracing import Recorder
 
 LOGGER: Final[Logger] = get_logger(__name__)
 
@@ -27,9 +49,10 @@ def setup_argparse() -> ArgumentParser:
     parser = ArgumentParser(
         description="Like nix-eval-jobs, but worse!",
         epilog="""
-        NOTE: Due to a limitation in rich, there's no way to print to both stderr and stdout with a progress bar.
-        As a result, the program only outputs to stderr and contains the progress bar.
-        To work around this, use the --output option.
+        Results are written to stdout unless --output is given, while the progress bar and logs are written to stderr.
+        Run with the report subcommand (nix-eval-jobs-python report --help) to profile the output of a run, with the
+        index subcommand (nix-eval-jobs-python index --help) to query and compare the outputs of runs, or with the
+        worker subcommand (nix-eval-jobs-python worker --help) to evaluate for a coordinator started with --listen.
         """,
     )
     _ = parser.add_argument(
@@ -39,12 +62,361 @@ def setup_argparse() -> ArgumentParser:
         default=1,
     )
     _ = parser.add_argument("--output", type=str, help="Path to store the results of evaluation")
+    _ = parser.add_argument(
+        "--compression",
+        type=str,
+        choices=["none", "gzip", "zstd"],
+        help="How to compress the output (defaults to inferring it from the suffix of --output: .gz or .zst)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--fsync-interval",
+        type=float,
+        help="Seconds between flushing the output through to disk, bounding how much output a crash can lose",
+        default=None,
+    )
     _ = parser.add_argument(
         "--flakeref",
         type=str,
         help="Reference to a flake",
         required=True,
     )
+    _ = parser.add_argument(
+        "--batch-size",
+        type=int,
+        help=(
+            "Maximum number of sibling attributes to evaluate in a single nix process. "
+            "Stats are reported for the whole batch, so use 1 for per-attribute stats."
+        ),
+        default=1,
+    )
+    _ = parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["process", "asyncio"],
+        help=(
+            "How to run evaluations: 'process' hands them to --jobs worker processes, 'asyncio' runs up to --jobs "
+            "nix eval at once from a single event loop without worker processes (only for --backend subprocess, and "
+            "without --baseline or memory limits)"
+        ),
+        default="process",
+    )
+    _ = parser.add_argument(
+        "--listen",
+        type=str,
+        help=(
+            "Address to serve tasks on, as HOST:PORT, to workers started with the worker subcommand on this machine "
+            "or others (nix-eval-jobs-python worker --help); --jobs workers are also started on this machine, and may "
+            "be 0 (requires --authkey-file, and cannot be used with --engine asyncio or memory limits)"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--authkey-file",
+        type=str,
+        help="Path to a file holding the secret key workers authenticate with (only with --listen)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        help=(
+            "Seconds between heartbeats from workers; a worker silent for three intervals is lost and its tasks are "
+            "given to other workers (only with --listen)"
+        ),
+        default=5.0,
+    )
+    _ = parser.add_argument(
+        "--backend",
+        type=str,
+        help=(
+            "How to evaluate attributes: 'subprocess' runs a nix eval per evaluation and reports per-evaluation stats, "
+            "'repl' keeps a nix repl alive per job and does not report stats; any other backend is given as the import "
+            "path of a factory taking EvaluatorOptions, as in 'my_package.my_module:MyEvaluator'"
+        ),
+        default="subprocess",
+    )
+    _ = parser.add_argument(
+        "--no-stats",
+        action="store_false",
+        dest="stats",
+        help=(
+            "Do not have nix report stats, which is faster when only derivation paths are wanted (with the subprocess "
+            "backend, which then reports no stats)"
+        ),
+    )
+    _ = parser.add_argument(
+        "--nix-arg",
+        type=str,
+        action="append",
+        help=(
+            "Extra argument to pass to every nix evaluating attributes, which may be repeated, as in "
+            "--nix-arg=--option --nix-arg=allow-import-from-derivation --nix-arg=false"
+        ),
+        default=[],
+    )
+    _ = parser.add_argument(
+        "--repl-max-requests",
+        type=int,
+        help="Number of evaluations after which a nix repl is replaced (only for --backend repl)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--repl-max-rss",
+        type=int,
+        help="Resident set size in MiB after which a nix repl is replaced (only for --backend repl)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--eval-timeout",
+        type=float,
+        help="Seconds after which an evaluation is killed and recorded as failed (only for --backend subprocess)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--eval-max-memory",
+        type=int,
+        help=(
+            "Address space in MiB an evaluation may use, beyond which it runs out of memory, which is somewhat above "
+            "its resident set size (only for --backend subprocess)"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--retries",
+        type=int,
+        help=(
+            "Number of times to retry evaluations which ran out of memory or failed to fetch, with exponential "
+            "backoff; evaluation errors and timeouts are not retried (only for --backend subprocess)"
+        ),
+        default=0,
+    )
+    _ = parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        help="Seconds to wait before the first retry, doubling for each following one",
+        default=1.0,
+    )
+    _ = parser.add_argument(
+        "--failures",
+        type=str,
+        help=(
+            "Path to write a record of each attribute whose evaluation failed to as JSONL, classified as an evaluation "
+            "error (eval), timeout, running out of memory (oom), or failure to fetch (fetch)"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--validate",
+        type=str,
+        choices=["strict", "fast"],
+        help=(
+            "How thoroughly to validate results: 'strict' validates every model as it is built, 'fast' validates the "
+            "output of nix once and uses less CPU per result"
+        ),
+        default="strict",
+    )
+    _ = parser.add_argument(
+        "--baseline",
+        action="store_true",
+        help=(
+            "Measure the cost of each attribute less that of evaluating its parent, which is measured separately as a "
+            "baseline (requires a backend which reports stats, such as subprocess, and --batch-size 1)"
+        ),
+        default=False,
+    )
+    _ = parser.add_argument(
+        "--samples",
+        type=int,
+        help="Number of times to evaluate each attribute and its baseline, for the variance of costs (with --baseline)",
+        default=1,
+    )
+    _ = parser.add_argument(
+        "--cache",
+        type=str,
+        help="Path to a SQLite database caching evaluation results between runs",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--cache-mode",
+        type=str,
+        choices=["read-write", "read-only", "write-only"],
+        help="Whether to use cached results and whether to write new results to the cache (only with --cache)",
+        default="read-write",
+    )
+    _ = parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        help="Size in MiB after which the least recently used cache entries are evicted (only with --cache)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--max-memory",
+        type=int,
+        help="Resident set size in MiB allowed for all running evaluations; evaluations are held back to stay below it",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--min-available-memory",
+        type=int,
+        help="Memory in MiB the system must have available for a new evaluation to start",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--max-eval-rss",
+        type=int,
+        help="Resident set size in MiB above which an evaluation is killed and retried with garbage collection enabled",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--schedule",
+        type=str,
+        choices=nix_eval_jobs.scheduler.policy.POLICIES,
+        help=(
+            "Order to start tasks in: 'fifo' in the order they were discovered, 'fan-out' largest estimated subtree "
+            "first by the number of children seen at each depth, 'cost' most expensive subtree first by the stats of "
+            "a previous run (see --schedule-costs)"
+        ),
+        default="fifo",
+    )
+    _ = parser.add_argument(
+        "--schedule-costs",
+        type=str,
+        help="Path to the output of a previous run whose stats estimate costs for --schedule cost (or --previous)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--dedup",
+        type=str,
+        choices=["none", "derivations", "scopes"],
+        help=(
+            "Whether to write alias records for attributes whose derivation path was already seen instead of their "
+            "results ('derivations'), and also not recurse into scopes whose fingerprint was already seen ('scopes'), "
+            "which probes a child of each scope"
+        ),
+        default="none",
+    )
+    _ = parser.add_argument(
+        "--exclusions",
+        type=str,
+        help=(
+            "Path to a JSON file of rules for attributes not to evaluate, replacing the default rules: names excluded "
+            "directly below the root (topLevel) or anywhere below it (anyLevel), attribute paths (prefixes), and glob "
+            "patterns matched against attribute paths (globs)"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--exclude-attr",
+        type=str,
+        action="append",
+        help="Name of attributes not to evaluate anywhere below the root, which may be repeated",
+        default=[],
+    )
+    _ = parser.add_argument(
+        "--exclude",
+        type=str,
+        action="append",
+        help="Glob pattern matched against attribute paths not to evaluate, as in '*.tests', which may be repeated",
+        default=[],
+    )
+    _ = parser.add_argument(
+        "--previous",
+        type=str,
+        help=(
+            "Path to the output of a previous run to evaluate incrementally against: results for attributes whose "
+            "derivation path is unchanged are reused"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--incremental-batch-size",
+        type=int,
+        help=(
+            "Number of sibling attributes to evaluate in a single nix process when comparing with the previous run "
+            "(only with --previous); added and changed attributes are evaluated again on their own if --batch-size is 1"
+        ),
+        default=100,
+    )
+    _ = parser.add_argument(
+        "--diff",
+        type=str,
+        help="Path to write the attributes added, changed, and removed since the previous run (only with --previous)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="Path to periodically save the state of the run to, so it can be resumed with --resume (needs --output)",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        help="Seconds between checkpoints (only with --checkpoint)",
+        default=300.0,
+    )
+    _ = parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the run saved in --checkpoint, appending to --output",
+        default=False,
+    )
+    _ = parser.add_argument(
+        "--profile-report",
+        type=str,
+        help=(
+            "Path to write a profile of where evaluation time and memory went to as JSON once the run completes, "
+            "which is also summarized on stderr (requires --output; see the report subcommand for more)"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--run-stats",
+        type=str,
+        help=(
+            "Path to write measurements of the run to as JSON once it completes: throughput, latency of tasks, and CPU "
+            "time and peak memory of the coordinator and of the workers"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--metrics-listen",
+        type=str,
+        help=(
+            "Address to serve live metrics of the run on in the Prometheus text format, at /metrics, as HOST:PORT "
+            "(such as 127.0.0.1:9100): the depth of the frontier, tasks in flight, attributes per second, memory, and "
+            "the time spent in each step of evaluating and writing results"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--metrics-json",
+        type=str,
+        help="Path to append a sample of the live metrics of the run to every --metrics-interval seconds, as JSONL",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        help="Seconds between samples of the live metrics (with --metrics-listen, --metrics-json, or --trace)",
+        default=1.0,
+    )
+    _ = parser.add_argument(
+        "--trace",
+        type=str,
+        help=(
+            "Path to write a trace of the run to once it completes, in the Chrome Trace Event Format (open it with "
+            "Perfetto): the time each task waited, and each step of every evaluation by worker"
+        ),
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--refresh-rate",
+        type=float,
+        help="Number of times per second to refresh the progress bar",
+        default=4.0,
+    )
     _ = parser.add_argument(
         "--attr-path",
         type=str,
@@ -55,59 +427,23 @@ def setup_argparse() -> ArgumentParser:
     return parser
 
 
-def executor_loop(
-    flakeref: str,
-    root_attr_path: Sequence[str],
-    attr_paths_to_process: Queue[Sequence[str]],
-    counts: dict[str, int],
-    evaluation_results: Queue[str],
-) -> None:
-    while attr_paths_to_process:
-        try:
-            attr_path = attr_paths_to_process.get(timeout=1.0)
-        except Empty as _:
-            if counts["discovered"] == counts["evaluated"] + counts["excluded"]:
-                break
-            else:
-                continue
-
-        if nix_eval_jobs.nix.eval.info.is_excluded_attr(attr_path):
-            counts["excluded"] += 1
-            continue
-
-        info = nix_eval_jobs.nix.eval.info.get_info(flakeref, attr_path)
-        if root_attr_path == attr_path:
-            # LOGGER.info("Setting recurse to true for the root attribute %s", root_attr_path_str)
-            info.value.recurse = True
-
-        if info.value.include:
-            # Produce newline delimited, minified JSON.
-            evaluation_results.put(info.model_dump_json(by_alias=True, indent=None))
-
-        if info.value.recurse:
-            result = nix_eval_jobs.nix.eval.info.attr_names(flakeref, attr_path)
-            new_attr_paths = [[*attr_path, attr_name] for attr_name in result.value]
-            counts["discovered"] += len(new_attr_paths)
-            for new_attr_path in new_attr_paths:
-                attr_paths_to_process.put(new_attr_path)
-
-        counts["evaluated"] += 1
-
-
 def main_loop(
-    output_file: TextIO | None,
-    counts: Mapping[str, int],
-    futures: Sequence[Future[None]],
-    evaluation_results: Queue[str],
+    writer: OutputWriter,
+    coordinator: CoordinatorBase,
+    refresh_rate: float,
+    checkpoint: Callable[[], None] | None = None,
+    checkpoint_interval: float = 300.0,
+    failures_writer: OutputWriter | None = None,
+    metrics: Metrics | None = None,
 ) -> None:
     def update_progress(
-        counts: Mapping[str, int],
+        counts: Counts,
         progress: Progress,
     ) -> None:
-        num_discovered = counts["discovered"]
-        num_excluded = counts["excluded"]
-        num_evaluated = counts["evaluated"]
-        num_completed = num_excluded + num_evaluated
+        num_discovered = counts.discovered
+        num_excluded = counts.excluded
+        num_evaluated = counts.evaluated
+        num_completed = num_excluded + num_evaluated + counts.deduplicated
         progress.update(
             discover_progress,
             completed=num_discovered,
@@ -128,6 +464,21 @@ def main_loop(
             completed=num_completed,
             total=num_discovered,
         )
+        progress.update(
+            reused_progress,
+            completed=counts.reused,
+            total=None,
+        )
+        progress.update(
+            deduplicated_progress,
+            completed=counts.deduplicated,
+            total=None,
+        )
+        progress.update(
+            failed_progress,
+            completed=counts.failed,
+            total=None,
+        )
         progress.refresh()
 
     with Progress(
@@ -138,69 +489,487 @@ def main_loop(
         TimeRemainingColumn(),
         console=CONSOLE,
         auto_refresh=False,
+        # Results are written to stdout by the output writer, not through rich.
+        redirect_stdout=False,
     ) as progress:
         discover_progress = progress.add_task("Discovered", total=None)
         excluded_progress = progress.add_task("Excluded", total=None)
         eval_progress = progress.add_task("Evaluated", total=None)
         completed_progress = progress.add_task("Completed", total=None)
+        reused_progress = progress.add_task("Reused", total=None, visible=coordinator.incremental)
+        deduplicated_progress = progress.add_task("Deduplicated", total=None, visible=coordinator.deduplicating)
+        failed_progress = progress.add_task("Failed", total=None)
 
-        while any(not future.done() for future in futures):
-            # While waiting for futures to complete, print if something is available
-            try:
-                while evaluation_results:
-                    # Because output_file may be None, in the case that there's none specified the print provided
-                    # by Console is used, and we get nice output without odd spacing or clipping.
-                    print(evaluation_results.get_nowait(), file=output_file)
-            except Empty as _:
-                pass
+        refresh_interval = 1.0 / refresh_rate
+        next_refresh = monotonic()
+        next_checkpoint = next_refresh + checkpoint_interval
+        while not coordinator.done:
+            # Block until workers complete tasks or it is time to refresh the progress bar, so the coordinator uses
+            # next to no CPU while it waits. Results are handed to the writer thread, so writing them never holds up
+            # the coordinator.
+            writer.write(coordinator.step(timeout=max(0.0, next_refresh - monotonic())))
+            failures = coordinator.take_failures()
+            if failures_writer is not None:
+                failures_writer.write(failures)
 
-            update_progress(counts, progress)
+            if (now := monotonic()) >= next_refresh:
+                update_progress(coordinator.counts, progress)
+                next_refresh = now + refresh_interval
 
-        for future in futures:
-            future.result(timeout=0.0)  # Every future should be complete.
-            # update_progress(counts, progress)
+            if checkpoint is not None and now >= next_checkpoint:
+                checkpoint()
+                next_checkpoint = now + checkpoint_interval
 
+            if metrics is not None:
+                metrics.sample(coordinator, writer)
 
-def main() -> None:
-    parser = setup_argparse()
-    args: Namespace = parser.parse_args()
-    flakeref = args.flakeref
-    root_attr_path = args.attr_path
-
-    with SyncManager() as manager, ProcessPoolExecutor(max_workers=args.jobs) as executor:
-        # Shared queue so executors can steal tasks if they finish early
-        attr_paths_to_process: Queue[Sequence[str]] = manager.Queue()
-        attr_paths_to_process.put(root_attr_path)
-
-        # Shared queue so executors can publish the string representing the results of evaluation
-        evaluation_results: Queue[str] = manager.Queue()
-
-        # Track the number of discovered, excluded, and evaluated attributes
-        counts = manager.dict(
-            discovered=1,
-            excluded=0,
-            evaluated=0,
-        )
-
-        # Spawn and task our executors
-        futures = [
-            executor.submit(
-                executor_loop,  # pyright: ignore[reportUnknownArgumentType]
-                flakeref,
-                root_attr_path,
-                attr_paths_to_process,
-                counts,  # pyright: ignore[reportArgumentType]
-                evaluation_results,
+        update_progress(coordinator.counts, progress)
+        if metrics is not None:
+            metrics.sample(coordinator, writer, force=True)
+
+
+def _mib_to_bytes(mib: int | None) -> int | None:
+    return mib * 2**20 if mib is not None else None
+
+
+def _evaluator_options(args: Namespace) -> EvaluatorOptions:
+    return EvaluatorOptions(
+        nix_args=args.nix_arg,
+        repl_max_requests=args.repl_max_requests,
+        repl_max_rss_bytes=_mib_to_bytes(args.repl_max_rss),
+        limits=EvalLimits(
+            timeout=args.eval_timeout,
+            max_memory_bytes=_mib_to_bytes(args.eval_max_memory),
+            retries=args.retries,
+            retry_backoff=args.retry_backoff,
+        ),
+        stats=args.stats,
+        validation=args.validate,
+    )
+
+
+def _check_listen_args(parser: ArgumentParser, args: Namespace) -> None:
+    if (
+        args.authkey_file is None
+        or args.engine == "asyncio"
+        or MemoryLimits(args.max_memory, args.min_available_memory, args.max_eval_rss).enabled
+    ):
+        parser.error("--listen requires --authkey-file, and cannot be used with --engine asyncio or memory limits")
+    if args.heartbeat_interval <= 0:
+        parser.error("--heartbeat-interval must be positive")
+    try:
+        _ = nix_eval_jobs.scheduler.remote.parse_address(args.listen)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _metrics_enabled(args: Namespace) -> bool:
+    return args.metrics_listen is not None or args.metrics_json is not None or args.trace is not None
+
+
+def _check_metrics_args(parser: ArgumentParser, args: Namespace) -> None:
+    if args.metrics_interval <= 0:
+        parser.error("--metrics-interval must be positive")
+    if args.metrics_listen is not None:
+        try:
+            _ = nix_eval_jobs.scheduler.remote.parse_address(args.metrics_listen)
+        except ValueError as e:
+            parser.error(str(e))
+
+
+def _check_incremental_args(parser: ArgumentParser, args: Namespace) -> None:
+    if args.checkpoint is not None:
+        parser.error("--checkpoint cannot be used with --previous")
+    if args.dedup != "none":
+        parser.error("--dedup cannot be used with --previous")
+    if args.incremental_batch_size < 1:
+        parser.error("--incremental-batch-size must be at least 1")
+    # Results are reused by reading them back from the previous output as the new output is written.
+    if args.output is not None and Path(args.output).resolve() == Path(args.previous).resolve():
+        parser.error("--output cannot be the same file as --previous")
+
+
+def _check_counts(parser: ArgumentParser, args: Namespace) -> None:
+    # With --listen, evaluation may be left entirely to workers which connect over the network.
+    if args.jobs < 1 and not (args.jobs == 0 and args.listen is not None):
+        parser.error("--jobs must be at least 1, or 0 with --listen")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.refresh_rate <= 0:
+        parser.error("--refresh-rate must be positive")
+    if args.samples < 1:
+        parser.error("--samples must be at least 1")
+
+
+def _check_args(parser: ArgumentParser, args: Namespace) -> None:
+    """
+    Rejects combinations of arguments which cannot be used together.
+    """
+    if args.checkpoint is not None and args.output is None:
+        parser.error("--checkpoint requires --output")
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires --checkpoint")
+    try:
+        evaluator = nix_eval_jobs.nix.eval.evaluator.create(args.backend, _evaluator_options(args))
+    except UnknownBackendError as e:
+        parser.error(str(e))
+    capabilities = evaluator.capabilities
+    evaluator.close()
+    if args.baseline and (not capabilities.stats or args.batch_size != 1):
+        parser.error("--baseline requires a backend which reports stats and --batch-size 1")
+    if args.engine == "asyncio" and (
+        args.backend != "subprocess"
+        or args.baseline
+        or MemoryLimits(args.max_memory, args.min_available_memory, args.max_eval_rss).enabled
+    ):
+        parser.error(
+            "--engine asyncio requires --backend subprocess, and cannot be used with --baseline or memory limits"
+        )
+    if args.listen is not None:
+        _check_listen_args(parser, args)
+    if args.previous is not None:
+        _check_incremental_args(parser, args)
+    if args.schedule == "cost" and args.schedule_costs is None and args.previous is None:
+        parser.error("--schedule cost requires --schedule-costs or --previous")
+    _check_counts(parser, args)
+    if args.samples != 1 and not args.baseline:
+        parser.error("--samples requires --baseline")
+    if args.profile_report is not None and args.output is None:
+        parser.error("--profile-report requires --output")
+    _check_metrics_args(parser, args)
+
+
+def _load_checkpoint(
+    parser: ArgumentParser, checkpoint_path: Path, flakeref: str, root_attr_path: Sequence[str]
+) -> Checkpoint:
+    checkpoint = nix_eval_jobs.scheduler.checkpoint.load(checkpoint_path)
+    flake = checkpoint.header.header.flake
+    if flake.flakeref != flakeref or list(checkpoint.header.header.attr_path) != root_attr_path:
+        parser.error(
+            f"{checkpoint_path} evaluated {flake.flakeref} {checkpoint.header.header.attr_path}, not {flakeref} "
+            + f"{root_attr_path}"
+        )
+    LOGGER.warning("Resuming from %s with %d pending tasks", checkpoint_path, len(checkpoint.pending))
+    return checkpoint
+
+
+def _checkpointer(
+    checkpoint_path: Path,
+    coordinator: CoordinatorBase,
+    writer: OutputWriter,
+    header: OutputHeader,
+    compression: Compression,
+) -> Callable[[], None]:
+    def checkpoint() -> None:
+        # Capture the state now; it is saved once the writer has synced every result returned so far.
+        state = coordinator.checkpoint(header, compression)
+        writer.checkpoint(
+            lambda offset: nix_eval_jobs.scheduler.checkpoint.save(
+                checkpoint_path, state.model_copy(update={"output_offset": offset})
             )
-            for _ in range(args.jobs)
-        ]
+        )
+
+    return checkpoint
+
+
+def _worker_options(args: Namespace, flakeref: str, incremental: bool) -> WorkerOptions:
+    return WorkerOptions(
+        flakeref=flakeref,
+        root_attr_path=args.attr_path,
+        # Incremental runs discover attributes in batches, since only the derivation paths are needed to compare with
+        # the previous run.
+        batch_size=args.incremental_batch_size if incremental else args.batch_size,
+        backend=args.backend,
+        evaluator_options=_evaluator_options(args),
+        cache=(
+            CacheOptions(path=Path(args.cache), mode=args.cache_mode, max_bytes=_mib_to_bytes(args.cache_max_size))
+            if args.cache is not None
+            else None
+        ),
+        cost_samples=args.samples if args.baseline else None,
+        exclusions=(
+            ExclusionRules.load(Path(args.exclusions)) if args.exclusions is not None else DEFAULT_EXCLUSIONS
+        ).extend(any_level=args.exclude_attr, globs=args.exclude),
+        probe_scopes=args.dedup == "scopes",
+        report_not_included=incremental,
+        record_spans=_metrics_enabled(args),
+    )
+
+
+def _coordinator(
+    args: Namespace,
+    flakeref: str,
+    previous: PreviousRun | None,
+    resume_from: Checkpoint | None,
+    recorder: Recorder | None = None,
+) -> CoordinatorBase:
+    options = _worker_options(args, flakeref, incremental=previous is not None)
+    refresh_changed = args.batch_size == 1 and args.incremental_batch_size > 1
+    costs_path = args.schedule_costs if args.schedule_costs is not None else args.previous
+    frontier = nix_eval_jobs.scheduler.policy.create(
+        args.schedule, Path(costs_path) if costs_path is not None else None
+    )
+    if args.listen is not None:
+        return RemoteCoordinator(
+            options,
+            address=nix_eval_jobs.scheduler.remote.parse_address(args.listen),
+            authkey=Path(args.authkey_file).read_bytes().strip(),
+            num_local_workers=args.jobs,
+            heartbeat_interval=args.heartbeat_interval,
+            previous=previous,
+            refresh_changed=refresh_changed,
+            resume_from=resume_from,
+            frontier=frontier,
+            dedup=Deduplicator(args.dedup),
+            recorder=recorder,
+        )
+    if args.engine == "asyncio":
+        return AsyncCoordinator(
+            options,
+            max_concurrency=args.jobs,
+            previous=previous,
+            refresh_changed=refresh_changed,
+            resume_from=resume_from,
+            frontier=frontier,
+            dedup=Deduplicator(args.dedup),
+            recorder=recorder,
+        )
+    return Coordinator(
+        options,
+        num_workers=args.jobs,
+        memory_limits=MemoryLimits(
+            max_bytes=_mib_to_bytes(args.max_memory),
+            min_available_bytes=_mib_to_bytes(args.min_available_memory),
+            max_eval_bytes=_mib_to_bytes(args.max_eval_rss),
+        ),
+        previous=previous,
+        refresh_changed=refresh_changed,
+        resume_from=resume_from,
+        frontier=frontier,
+        dedup=Deduplicator(args.dedup),
+        recorder=recorder,
+    )
+
+
+def _metrics(args: Namespace) -> Metrics | None:
+    """
+    Starts collecting live metrics of the run, if asked for.
+    """
+    if not _metrics_enabled(args):
+        return None
+    return Metrics(
+        Recorder(tracing=args.trace is not None),
+        listen=(
+            nix_eval_jobs.scheduler.remote.parse_address(args.metrics_listen)
+            if args.metrics_listen is not None
+            else None
+        ),
+        json_path=Path(args.metrics_json) if args.metrics_json is not None else None,
+        trace_path=Path(args.trace) if args.trace is not None else None,
+        interval=args.metrics_interval,
+    )
+
+
+def _failures_writer(args: Namespace, resume: bool) -> OutputWriter | None:
+    """
+    Opens the failures for writing, if asked for. A resumed run appends to them, so attributes being evaluated when the
+    checkpoint was saved may have failures recorded twice.
+    """
+    if args.failures is None:
+        return None
+    failures_path = Path(args.failures)
+    append_offset = failures_path.stat().st_size if resume and failures_path.exists() else None
+    return OutputWriter(failures_path, "none", args.fsync_interval, append_offset=append_offset)
 
-        # Loop in the main thread, updating progress until complete
-        output_file = Path(args.output).open("w+", encoding="utf-8") if args.output is not None else None
-        main_loop(output_file, counts, futures, evaluation_results)
-        if output_file is not None:
-            output_file.flush()
-            output_file.close()
 
+def _write_reports(args: Namespace, coordinator: CoordinatorBase, output_path: Path | None) -> None:
+    """
+    Writes the diff from the previous run and the profile of the run, if asked for, once the run is complete.
+    """
+    if coordinator.incremental and args.diff is not None:
+        with Path(args.diff).open("w", encoding="utf-8") as diff_file:
+            for record in coordinator.diff():
+                print(record.model_dump_json(by_alias=True, indent=None), file=diff_file)
+
+    if output_path is not None and args.profile_report is not None:
+        nix_eval_jobs.cmd.report.report(output_path, CONSOLE, json_path=Path(args.profile_report))
+
+
+def _run_stats(coordinator: CoordinatorBase, elapsed: float) -> RunStats:
+    """
+    Measures the run once the coordinator has shut down, so the resource usage of every worker and nix is included.
+    """
+    coordinator_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    counts = coordinator.counts
+    return RunStats(
+        elapsed=elapsed,
+        num_discovered=counts.discovered,
+        num_excluded=counts.excluded,
+        num_evaluated=counts.evaluated,
+        num_deduplicated=counts.deduplicated,
+        num_failed=counts.failed,
+        attrs_per_second=(counts.excluded + counts.evaluated) / elapsed if elapsed > 0 else 0.0,
+        num_tasks=coordinator.task_latency.count,
+        queue_latency_mean=coordinator.queue_latency.mean,
+        queue_latency_max=coordinator.queue_latency.max,
+        task_latency_mean=coordinator.task_latency.mean,
+        task_latency_max=coordinator.task_latency.max,
+        coordinator_cpu_time=coordinator_usage.ru_utime + coordinator_usage.ru_stime,
+        # ru_maxrss is in KiB on Linux.
+        coordinator_max_rss=coordinator_usage.ru_maxrss * 2**10,
+        children_cpu_time=children_usage.ru_utime + children_usage.ru_stime,
+        children_max_rss=children_usage.ru_maxrss * 2**10,
+        schedule_policy=coordinator.policy,
+        finish_predictions=coordinator.finish_predictions(elapsed),
+    )
+
+
+def _write_run_stats(args: Namespace, coordinator: CoordinatorBase, elapsed: float) -> None:
+    """
+    Logs how the predictions of the scheduling policy compare with the time the run took, and writes the measurements
+    of the run, if asked for.
+    """
+    for prediction in coordinator.finish_predictions(elapsed):
+        LOGGER.info(
+            "After %.1fs, the %s policy predicted the run would take %.1fs; it took %.1fs",
+            prediction.elapsed,
+            coordinator.policy,
+            prediction.predicted_elapsed,
+            elapsed,
+        )
+    if args.run_stats is not None:
+        _ = Path(args.run_stats).write_text(
+            _run_stats(coordinator, elapsed).model_dump_json(by_alias=True, indent=2), encoding="utf-8"
+        )
+        LOGGER.info("Wrote measurements of the run to %s", args.run_stats)
+
+
+def _reuse_previous(
+    args: Namespace, previous: PreviousRun, header: OutputHeader, output_path: Path | None, compression: Compression
+) -> None:
+    """
+    Writes every result of the previous run as the output, for when the flake is unchanged since.
+    """
+    LOGGER.warning("The flake is unchanged since the previous run, reusing all %d results", len(previous))
+    writer = OutputWriter(output_path, compression, args.fsync_interval)
+    writer.write([header.model_dump_json(by_alias=True, indent=None), *previous.read_lines()])
+    writer.close()
+    if args.diff is not None:
+        Path(args.diff).write_text("", encoding="utf-8")
+    previous.close()
+
+
+def _evaluate(
+    args: Namespace,
+    coordinator: CoordinatorBase,
+    output_path: Path | None,
+    compression: Compression,
+    header: OutputHeader,
+    resume_from: Checkpoint | None,
+    checkpoint_path: Path | None,
+    metrics: Metrics | None,
+) -> None:
+    """
+    Runs the coordinator to completion, writing its results to the output.
+
+    Results already handed to the writers are written even if the run fails, and compressed outputs end their frame, so
+    the output is complete up to the failure.
+    """
+    writer = OutputWriter(
+        output_path,
+        compression,
+        args.fsync_interval,
+        append_offset=resume_from.output_offset if resume_from is not None else None,
+        recorder=metrics.recorder if metrics is not None else None,
+    )
+    failures_writer = _failures_writer(args, resume=resume_from is not None)
+    try:
+        if resume_from is None:
+            writer.write([header.model_dump_json(by_alias=True, indent=None)])
+        checkpoint = (
+            _checkpointer(checkpoint_path, coordinator, writer, header, compression)
+            if checkpoint_path is not None
+            else None
+        )
+        main_loop(
+            writer, coordinator, args.refresh_rate, checkpoint, args.checkpoint_interval, failures_writer, metrics
+        )
+    finally:
+        try:
+            writer.close()
+        finally:
+            if failures_writer is not None:
+                failures_writer.close()
+
+
+def run(argv: Sequence[str] | None = None) -> None:
+    parser = setup_argparse()
+    args: Namespace = parser.parse_args(argv)
+    output_path = Path(args.output) if args.output is not None else None
+    compression = args.compression if args.compression is not None else infer_compression(output_path)
+
+    _check_args(parser, args)
+    checkpoint_path = Path(args.checkpoint) if args.checkpoint is not None else None
+
+    resume_from = None
+    if args.resume:
+        assert checkpoint_path is not None
+        resume_from = _load_checkpoint(parser, checkpoint_path, args.flakeref, args.attr_path)
+        # Continue with the flake as it was locked at the start of the run, which may no longer be what the flake
+        # reference resolves to.
+        header = resume_from.header
+        flake = header.header.flake
+        compression = resume_from.compression
+    else:
+        # Resolve and lock the flake reference once so every evaluation uses the same revision without resolving it
+        # again.
+        flake = nix_eval_jobs.nix.flake.lock(args.flakeref)
+        header = OutputHeader.model_validate({"header": {"flake": flake, "attr_path": args.attr_path}})
+
+    previous = PreviousRun(Path(args.previous)) if args.previous is not None else None
+    if previous is not None and list(previous.header.header.attr_path) != args.attr_path:
+        parser.error(f"--previous evaluated {previous.header.header.attr_path}, not {args.attr_path}")
+    if previous is not None and flake.nar_hash is not None and previous.header.header.flake.nar_hash == flake.nar_hash:
+        if not previous.num_failed:
+            _reuse_previous(args, previous, header, output_path, compression)
+            return
+        # Failures may be transient, so attributes which failed are evaluated again even though nothing changed.
+        LOGGER.warning("The flake is unchanged since the previous run, but %d attributes failed", previous.num_failed)
+
+    start = monotonic()
+    metrics = _metrics(args)
+    coordinator = _coordinator(
+        args, flake.locked_flakeref, previous, resume_from, metrics.recorder if metrics is not None else None
+    )
+    try:
+        _evaluate(args, coordinator, output_path, compression, header, resume_from, checkpoint_path, metrics)
+        if checkpoint_path is not None:
+            # The run is complete, so there is nothing to resume.
+            checkpoint_path.unlink(missing_ok=True)
+
+        _write_reports(args, coordinator, output_path)
+    finally:
         # Cleanup and and shut down
-        manager.shutdown()
+        coordinator.shutdown()
+        if previous is not None:
+            previous.close()
+        if metrics is not None:
+            metrics.close()
+
+    _write_run_stats(args, coordinator, monotonic() - start)
+
+
+# Subcommands, which take their own arguments. Without one, attributes are evaluated.
+_SUBCOMMANDS: Final[Mapping[str, Callable[[Sequence[str]], None]]] = {
+    "index": nix_eval_jobs.cmd.index.main,
+    "report": nix_eval_jobs.cmd.report.main,
+    "worker": nix_eval_jobs.cmd.worker.main,
+}
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and (subcommand := _SUBCOMMANDS.get(sys.argv[1])) is not None:
+        subcommand(sys.argv[2:])
+    else:
+        run()
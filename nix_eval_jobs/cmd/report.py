@@ -0,0 +1,76 @@
+from argparse import ArgumentParser, Namespace
+from collections.abc import Sequence
+from logging import Logger
+from pathlib import Path
+from typing import Final
+
+from rich.console import Console
+
+import nix_eval_jobs.report
+from nix_eval_jobs.logger import get_logger
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+def setup_argparse() -> ArgumentParser:
+    parser = ArgumentParser(
+        prog="nix-eval-jobs-python report",
+        description="Summarize where evaluation time and memory go, using the stats in the output of a run",
+    )
+    _ = parser.add_argument("output", type=str, help="Path to the output of a run")
+    _ = parser.add_argument(
+        "--top",
+        type=int,
+        help="Number of attributes and attribute sets to list for each metric",
+        default=20,
+    )
+    _ = parser.add_argument("--json", type=str, help="Path to write the report to as JSON", default=None)
+    _ = parser.add_argument(
+        "--folded",
+        type=str,
+        help="Path to write the costs to as folded stacks, for flame graph tools",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--folded-metric",
+        type=str,
+        choices=list(nix_eval_jobs.report.METRICS),
+        help="Metric to weigh the folded stacks by",
+        default="cpuTime",
+    )
+    return parser
+
+
+def report(
+    output_path: Path,
+    console: Console,
+    top: int = 20,
+    json_path: Path | None = None,
+    folded_path: Path | None = None,
+    folded_metric: str = "cpuTime",
+) -> None:
+    """
+    Prints a profile of the run which wrote `output_path`, and optionally writes it as JSON and folded stacks.
+    """
+    header, num_records, costs = nix_eval_jobs.report.load_costs(output_path)
+    profile = nix_eval_jobs.report.build_report(header.header.attr_path, num_records, costs, top)
+    nix_eval_jobs.report.print_report(profile, console)
+    if json_path is not None:
+        _ = json_path.write_text(profile.model_dump_json(by_alias=True, indent=2), encoding="utf-8")
+        LOGGER.info("Wrote the profile to %s", json_path)
+    if folded_path is not None:
+        with folded_path.open("w", encoding="utf-8") as folded_file:
+            nix_eval_jobs.report.write_folded(costs, folded_metric, folded_file)
+        LOGGER.info("Wrote folded stacks to %s", folded_path)
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    args: Namespace = setup_argparse().parse_args(argv)
+    report(
+        Path(args.output),
+        Console(),
+        top=args.top,
+        json_path=Path(args.json) if args.json is not None else None,
+        folded_path=Path(args.folded) if args.folded is not None else None,
+        folded_metric=args.folded_metric,
+    )
@@ -0,0 +1,98 @@
+import sys
+from argparse import ArgumentParser, Namespace
+from collections.abc import Sequence
+from logging import Logger
+from multiprocessing import Process
+from pathlib import Path
+from typing import Final
+
+import nix_eval_jobs.scheduler.remote
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.cache import CacheOptions
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+def setup_argparse() -> ArgumentParser:
+    parser = ArgumentParser(
+        prog="nix-eval-jobs-python worker",
+        description="Evaluate attributes for a coordinator started with --listen, which may be on another machine",
+    )
+    _ = parser.add_argument(
+        "--connect",
+        type=str,
+        help="Address the coordinator listens on, as HOST:PORT",
+        required=True,
+    )
+    _ = parser.add_argument(
+        "--authkey-file",
+        type=str,
+        help="Path to the file holding the key shared with the coordinator (see --authkey-file of the coordinator)",
+        required=True,
+    )
+    _ = parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Number of workers to run, each a separate connection to the coordinator (memory intensive!)",
+        default=1,
+    )
+    _ = parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        help="Seconds to keep retrying to connect to a coordinator which is not yet listening",
+        default=60.0,
+    )
+    _ = parser.add_argument(
+        "--cache",
+        type=str,
+        help="Path to a SQLite database on this machine caching evaluation results between runs",
+        default=None,
+    )
+    _ = parser.add_argument(
+        "--cache-mode",
+        type=str,
+        choices=["read-write", "read-only", "write-only"],
+        help="Whether to use cached results and whether to write new results to the cache (only with --cache)",
+        default="read-write",
+    )
+    _ = parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        help="Size in MiB after which the least recently used cache entries are evicted (only with --cache)",
+        default=None,
+    )
+    return parser
+
+
+def main(argv: Sequence[str]) -> None:
+    parser = setup_argparse()
+    args: Namespace = parser.parse_args(argv)
+    try:
+        address = nix_eval_jobs.scheduler.remote.parse_address(args.connect)
+    except ValueError as e:
+        parser.error(str(e))
+    authkey = Path(args.authkey_file).read_bytes().strip()
+    cache = (
+        CacheOptions(
+            path=Path(args.cache),
+            mode=args.cache_mode,
+            max_bytes=args.cache_max_size * 2**20 if args.cache_max_size is not None else None,
+        )
+        if args.cache is not None
+        else None
+    )
+
+    processes = [
+        Process(target=nix_eval_jobs.scheduler.remote.run_worker, args=(address, authkey, cache, args.connect_timeout))
+        for _ in range(args.jobs)
+    ]
+    for process in processes:
+        process.start()
+    failed = False
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            LOGGER.error("Worker %d exited with code %s", process.pid, process.exitcode)
+            failed = True
+    if failed:
+        sys.exit(1)
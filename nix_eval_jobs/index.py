@@ -0,0 +1,324 @@
+"""
+An index of the output of a run, for querying and comparing runs without reading their outputs again.
+
+The index is a SQLite database holding, for each record of the output, its attribute, derivation path, system, name, and
+whether it is an alias or failed, along with:
+
+- the attribute path trie: every attribute set on the way to a record, with its children and the number of records
+  below it,
+- the map from derivation path to attributes, and
+- the number of records of each system.
+
+Each is indexed, so looking up an attribute, a derivation path, or the children of an attribute set takes time
+logarithmic in the size of the run, and listing attributes takes time proportional to the number listed. Attributes
+below an attribute set are a range of the attributes, since an attribute is shown as its parent followed by a dot.
+"""
+
+import json
+import os
+import sqlite3
+from collections.abc import Iterable, Iterator, Sequence
+from dataclasses import dataclass
+from itertools import starmap
+from logging import Logger
+from pathlib import Path
+from typing import Any, Final
+
+from pydantic.alias_generators import to_camel
+
+from nix_eval_jobs.extra_pydantic import PydanticObject
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.failure import FailureKind
+from nix_eval_jobs.nix.utilities import show_attr_path
+from nix_eval_jobs.output import DiffRecord, OutputHeader, open_for_reading
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+# Bumped whenever the schema changes, so an index built by another version is rebuilt rather than misread.
+_VERSION: Final[str] = "1"
+
+# Number of records inserted at once while building.
+_BATCH_SIZE: Final[int] = 10_000
+
+_SCHEMA: Final[str] = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE attrs (
+    attr TEXT PRIMARY KEY,
+    attr_path TEXT NOT NULL,
+    drv_path TEXT,
+    system TEXT,
+    name TEXT,
+    alias_of TEXT,
+    failure TEXT
+) WITHOUT ROWID;
+CREATE TABLE nodes (
+    attr TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    num_attrs INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE systems (
+    system TEXT PRIMARY KEY,
+    num_attrs INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Created once every record is inserted, which is faster than maintaining them while inserting.
+_INDICES: Final[Sequence[str]] = [
+    "CREATE INDEX attrs_drv_path ON attrs (drv_path) WHERE drv_path IS NOT NULL",
+    "CREATE INDEX attrs_system ON attrs (system, attr) WHERE system IS NOT NULL",
+    "CREATE INDEX nodes_parent ON nodes (parent, name)",
+]
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+class IndexEntry(PydanticObject, alias_generator=to_camel):
+    attr: str
+    attr_path: Sequence[str]
+    drv_path: str | None
+    system: str | None
+    name: str | None
+    # The canonical attribute, if this is an alias record (see nix_eval_jobs.scheduler.dedup).
+    alias_of: str | None
+    failure: FailureKind | None
+
+
+@dataclass(frozen=True, slots=True)
+class TrieNode:
+    name: str
+    attr: str
+    # Number of records at and below the node.
+    num_attrs: int
+
+
+def _entry_row(line: bytes) -> tuple[str, str, str | None, str | None, str | None, str | None, str | None]:
+    record: dict[str, Any] = json.loads(line)
+    value: dict[str, Any] = record["value"]
+    failure: dict[str, Any] | None = record.get("failure")
+    return (
+        value["attr"],
+        json.dumps(value["attrPath"]),
+        value["drvPath"],
+        value["system"],
+        value["name"],
+        value.get("aliasOf"),
+        failure["kind"] if failure is not None else None,
+    )
+
+
+def _batches(rows: Iterable[tuple[Any, ...]]) -> Iterator[list[tuple[Any, ...]]]:
+    batch: list[tuple[Any, ...]] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == _BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _node_row(attr_path: tuple[str, ...], num_attrs: int) -> tuple[str, str, str, int]:
+    *parent, name = attr_path
+    # Top-level attributes are children of the empty attribute.
+    return show_attr_path(attr_path), show_attr_path(parent) if parent else "", name, num_attrs
+
+
+def _build_trie(conn: sqlite3.Connection) -> None:
+    # Built from the attributes inserted rather than while reading, so records written more than once (as by runs
+    # resumed from a checkpoint) are counted once.
+    num_attrs: dict[tuple[str, ...], int] = {}
+    for (attr_path_json,) in conn.execute("SELECT attr_path FROM attrs"):
+        attr_path: list[str] = json.loads(attr_path_json)
+        for depth in range(1, len(attr_path) + 1):
+            prefix = tuple(attr_path[:depth])
+            num_attrs[prefix] = num_attrs.get(prefix, 0) + 1
+    for batch in _batches(starmap(_node_row, num_attrs.items())):
+        _ = conn.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?)", batch)
+
+
+def build(output_path: Path, index_path: Path) -> int:
+    """
+    Builds an index of the output at `output_path` at `index_path`, replacing any index there, and returns the number
+    of records indexed.
+    """
+    # Built beside the index and moved into place, so a reader never sees a partial index.
+    building_path = index_path.with_name(f"{index_path.name}.building")
+    building_path.unlink(missing_ok=True)
+    conn = sqlite3.connect(building_path, isolation_level=None)
+    try:
+        # A partial index is discarded, so there is no need for a journal.
+        _ = conn.execute("PRAGMA journal_mode=OFF")
+        _ = conn.execute("PRAGMA synchronous=OFF")
+        _ = conn.executescript(_SCHEMA)
+        _ = conn.execute("BEGIN")
+        with open_for_reading(output_path) as output:
+            header = OutputHeader.model_validate_json(output.readline())
+            for batch in _batches(_entry_row(line) for line in output):
+                _ = conn.executemany("INSERT OR REPLACE INTO attrs VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        _build_trie(conn)
+        _ = conn.execute(
+            "INSERT INTO systems SELECT system, COUNT(*) FROM attrs WHERE system IS NOT NULL GROUP BY system"
+        )
+        for statement in _INDICES:
+            _ = conn.execute(statement)
+        (num_attrs,) = conn.execute("SELECT COUNT(*) FROM attrs").fetchone()
+        _ = conn.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [
+                ("version", _VERSION),
+                ("header", header.model_dump_json(by_alias=True)),
+                ("output", str(output_path)),
+                ("numAttrs", str(num_attrs)),
+            ],
+        )
+        _ = conn.execute("COMMIT")
+    finally:
+        conn.close()
+    os.replace(building_path, index_path)
+    LOGGER.info("Indexed %d records of %s in %s", num_attrs, output_path, index_path)
+    return num_attrs
+
+
+def _subtree_bounds(attr: str) -> tuple[str, str]:
+    # Attributes below `attr` start with `attr.`, which sort from `attr.` up to but excluding `attr/`.
+    return f"{attr}.", f"{attr}/"
+
+
+class OutputIndex:
+    """
+    An index built by `build`, opened read-only.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        if not path.is_file():
+            raise IndexFormatError(f"{path} does not exist")
+        self._conn: sqlite3.Connection = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            meta: dict[str, str] = dict(self._conn.execute("SELECT key, value FROM meta"))
+        except sqlite3.DatabaseError as e:
+            self._conn.close()
+            raise IndexFormatError(f"{path} is not an index: {e}") from e
+        if meta.get("version") != _VERSION:
+            self._conn.close()
+            raise IndexFormatError(f"{path} was built by another version, build it again")
+        self.header: OutputHeader = OutputHeader.model_validate_json(meta["header"])
+        self.num_attrs: int = int(meta["numAttrs"])
+
+    @staticmethod
+    def _entry(row: tuple[Any, ...]) -> IndexEntry:
+        attr, attr_path, drv_path, system, name, alias_of, failure = row
+        return IndexEntry.model_validate({
+            "attr": attr,
+            "attr_path": json.loads(attr_path),
+            "drv_path": drv_path,
+            "system": system,
+            "name": name,
+            "alias_of": alias_of,
+            "failure": failure,
+        })
+
+    def entry(self, attr: str) -> IndexEntry | None:
+        row: tuple[Any, ...] | None = self._conn.execute("SELECT * FROM attrs WHERE attr = ?", (attr,)).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def attrs_with_drv_path(self, drv_path: str) -> list[str]:
+        """
+        Returns the attributes whose derivation path is `drv_path`, which includes aliases of derivations.
+        """
+        return [attr for (attr,) in self._conn.execute("SELECT attr FROM attrs WHERE drv_path = ?", (drv_path,))]
+
+    def entries(
+        self, under: str | None = None, system: str | None = None, limit: int | None = None
+    ) -> list[IndexEntry]:
+        """
+        Returns the entries at and below the attribute `under` (or all of them), of `system` if given, in order of
+        attribute.
+        """
+        entries: list[IndexEntry] = []
+        conditions: list[str] = []
+        params: list[Any] = []
+        if under is not None:
+            # The attribute set itself sorts before everything below it. Looking it up separately leaves a range of
+            # the primary key (or of the system index), which is read in order without sorting.
+            if (entry := self.entry(under)) is not None and system in {None, entry.system}:
+                entries.append(entry)
+            conditions.append("attr >= ? AND attr < ?")
+            params.extend(_subtree_bounds(under))
+        if system is not None:
+            conditions.append("system = ?")
+            params.append(system)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(max(limit - len(entries), 0) if limit is not None else -1)
+        entries.extend(
+            self._entry(row) for row in self._conn.execute(f"SELECT * FROM attrs {where} ORDER BY attr LIMIT ?", params)
+        )
+        return entries[:limit] if limit is not None else entries
+
+    def children(self, attr: str) -> list[TrieNode]:
+        """
+        Returns the children of the attribute set `attr` which have records at or below them. The children of the empty
+        attribute are the top-level attributes.
+        """
+        return [
+            TrieNode(name, child_attr, num_attrs)
+            for child_attr, name, num_attrs in self._conn.execute(
+                "SELECT attr, name, num_attrs FROM nodes WHERE parent = ? ORDER BY name", (attr,)
+            )
+        ]
+
+    def systems(self) -> list[tuple[str, int]]:
+        """
+        Returns each system with the number of records of it, most common first.
+        """
+        return list(self._conn.execute("SELECT system, num_attrs FROM systems ORDER BY num_attrs DESC, system"))
+
+    def diff(self, previous: "OutputIndex", under: str | None = None) -> Iterator[DiffRecord]:
+        """
+        Yields the attributes at and below `under` (or all of them) whose derivation was added, changed, or removed
+        since the run indexed by `previous`, in order of attribute. Attributes without a derivation path, such as those
+        which failed, are treated as absent.
+        """
+        scope = ""
+        params: list[str] = []
+        if under is not None:
+            scope = "AND (attr = ? OR (attr >= ? AND attr < ?))"
+            params = [under, *_subtree_bounds(under)]
+        _ = self._conn.execute("ATTACH DATABASE ? AS previous", (f"{previous.path.resolve().as_uri()}?mode=ro",))
+        rows = self._conn.cursor()
+        try:
+            _ = rows.execute(
+                f"""
+                SELECT current.attr, current.drv_path, previous_attrs.drv_path
+                FROM (SELECT attr, drv_path FROM main.attrs WHERE drv_path IS NOT NULL {scope}) AS current
+                LEFT JOIN previous.attrs AS previous_attrs ON previous_attrs.attr = current.attr
+                WHERE previous_attrs.drv_path IS NULL OR previous_attrs.drv_path != current.drv_path
+                UNION ALL
+                SELECT previous_attrs.attr, NULL, previous_attrs.drv_path
+                FROM (SELECT attr, drv_path FROM previous.attrs WHERE drv_path IS NOT NULL {scope}) AS previous_attrs
+                LEFT JOIN main.attrs AS current ON current.attr = previous_attrs.attr
+                WHERE current.drv_path IS NULL
+                ORDER BY 1
+                """,
+                params * 2,
+            )
+            for attr, drv_path, previous_drv_path in rows:
+                yield DiffRecord(
+                    attr=attr,
+                    status="removed" if drv_path is None else "added" if previous_drv_path is None else "changed",
+                    drv_path=drv_path,
+                    previous_drv_path=previous_drv_path,
+                )
+        finally:
+            # A database cannot be detached while it is being read, as it is when the caller stops early.
+            rows.close()
+            _ = self._conn.execute("DETACH DATABASE previous")
+
+    def close(self) -> None:
+        self._conn.close()
@@ -1,5 +1,6 @@
 import logging
 
+import rich.console
 import rich.logging
 
 LOGGING_LEVEL = logging.WARNING
@@ -0,0 +1,80 @@
+"""
+Utilities for inspecting memory usage of processes through procfs.
+
+These return None (or nothing) on systems without procfs, so callers degrade to not tracking memory.
+"""
+
+import os
+from collections.abc import Mapping
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Final
+
+_PAGE_SIZE: Final[int] = os.sysconf("SC_PAGE_SIZE")
+
+
+@dataclass(frozen=True, slots=True)
+class ProcessMemory:
+    pid: int
+    ppid: int
+    rss_bytes: int
+
+
+def _read_stat(stat_path: Path) -> ProcessMemory | None:
+    try:
+        stat = stat_path.read_text(encoding="utf-8")
+    except OSError:
+        # The process exited.
+        return None
+    # The command name is parenthesized and may itself contain spaces and parentheses, so split after the last one.
+    # The fields after it start with the state (field 3), then the parent pid (field 4); rss is field 24, in pages.
+    fields = stat[stat.rindex(")") + 2 :].split()
+    return ProcessMemory(pid=int(stat_path.parent.name), ppid=int(fields[1]), rss_bytes=int(fields[21]) * _PAGE_SIZE)
+
+
+def processes() -> Mapping[int, ProcessMemory]:
+    """
+    Returns the memory usage of every process on the system, keyed by pid.
+    """
+    procs: dict[int, ProcessMemory] = {}
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        if (proc := _read_stat(stat_path)) is not None:
+            procs[proc.pid] = proc
+    return procs
+
+
+def descendants(procs: Mapping[int, ProcessMemory], pid: int) -> list[ProcessMemory]:
+    """
+    Returns the processes in `procs` which descend from `pid`, excluding `pid` itself.
+    """
+    children: dict[int, list[ProcessMemory]] = {}
+    for proc in procs.values():
+        children.setdefault(proc.ppid, []).append(proc)
+
+    found: list[ProcessMemory] = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            found.append(child)
+            stack.append(child.pid)
+    return found
+
+
+def rss_bytes(pid: int) -> int | None:
+    if (proc := _read_stat(Path(f"/proc/{pid}/stat"))) is None:
+        return None
+    return proc.rss_bytes
+
+
+def available_bytes() -> int | None:
+    """
+    Returns the amount of memory available for starting new applications without swapping, as estimated by the kernel.
+    """
+    try:
+        with Path("/proc/meminfo").open(encoding="utf-8") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
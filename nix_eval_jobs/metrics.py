@@ -0,0 +1,239 @@
+"""
+Live metrics of a run, to tell whether a slow run is limited by nix, by handing tasks to and results from workers, or
+by writing the output.
+
+The main loop samples gauges (the depth of the frontier, tasks in flight, attributes completed per second, memory, and
+batches waiting to be written) along with the totals of every span (see `nix_eval_jobs.tracing`) every `interval`
+seconds. The latest sample can be served in the Prometheus text format on `/metrics`, and every sample appended to a
+JSONL file. Serving the latest sample rather than sampling on request means scrapes never touch the state of the
+coordinator from another thread.
+"""
+
+import os
+import time
+from collections.abc import Iterator, Sequence
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from pathlib import Path
+from threading import Thread
+from typing import Final, TextIO, cast
+
+from pydantic.alias_generators import to_camel
+
+import nix_eval_jobs.memory
+from nix_eval_jobs.extra_pydantic import PydanticObject
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.output import OutputWriter
+from nix_eval_jobs.scheduler.coordinator import CoordinatorBase
+from nix_eval_jobs.scheduler.remote import Address
+from nix_eval_jobs.tracing import Recorder
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+_PROMETHEUS_CONTENT_TYPE: Final[str] = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsSnapshot(PydanticObject, alias_generator=to_camel):
+    """
+    A sample of the metrics of a run. Times are in seconds and sizes in bytes.
+    """
+
+    class SpanSummary(PydanticObject, alias_generator=to_camel):
+        count: int
+        seconds: float
+
+    # Wall clock time the sample was taken at.
+    time: float
+    elapsed: float
+    num_discovered: int
+    num_excluded: int
+    num_evaluated: int
+    num_deduplicated: int
+    num_failed: int
+    num_tasks: int
+    queue_depth: int
+    num_in_flight: int
+    # Attributes evaluated or excluded per second since the previous sample.
+    attrs_per_second: float
+    # None on systems without procfs. Workers are the descendants of this process, including every nix they run, so
+    # workers on other machines are not included.
+    coordinator_rss_bytes: int | None
+    workers_rss_bytes: int | None
+    # Batches of lines and checkpoints queued for the output writer but not yet written.
+    output_pending: int
+    # The totals of the spans recorded so far, keyed by name.
+    spans: dict[str, SpanSummary]
+
+
+def _rss_bytes() -> tuple[int | None, int | None]:
+    """
+    Returns the RSS of this process and the sum of that of its descendants.
+    """
+    procs = nix_eval_jobs.memory.processes()
+    if (coordinator := procs.get(os.getpid())) is None:
+        return None, None
+    return coordinator.rss_bytes, sum(proc.rss_bytes for proc in nix_eval_jobs.memory.descendants(procs, os.getpid()))
+
+
+def _prometheus_lines(snapshot: MetricsSnapshot) -> Iterator[str]:
+    metrics: Sequence[tuple[str, str, str, float | None]] = [
+        ("attrs_discovered_total", "counter", "Attributes discovered", snapshot.num_discovered),
+        ("attrs_excluded_total", "counter", "Attributes excluded", snapshot.num_excluded),
+        (
+            "attrs_evaluated_total",
+            "counter",
+            "Attributes evaluated, including those which failed",
+            snapshot.num_evaluated,
+        ),
+        ("attrs_deduplicated_total", "counter", "Attributes below an alias, not evaluated", snapshot.num_deduplicated),
+        ("attrs_failed_total", "counter", "Attributes whose evaluation failed", snapshot.num_failed),
+        ("tasks_completed_total", "counter", "Tasks completed", snapshot.num_tasks),
+        ("queue_depth", "gauge", "Tasks waiting in the frontier", snapshot.queue_depth),
+        ("tasks_in_flight", "gauge", "Tasks started but not completed", snapshot.num_in_flight),
+        ("attrs_per_second", "gauge", "Attributes evaluated or excluded per second", snapshot.attrs_per_second),
+        ("coordinator_rss_bytes", "gauge", "RSS of the coordinator", snapshot.coordinator_rss_bytes),
+        ("workers_rss_bytes", "gauge", "RSS of the local workers and every nix they run", snapshot.workers_rss_bytes),
+        ("output_pending", "gauge", "Batches queued for the output writer", snapshot.output_pending),
+        ("elapsed_seconds", "gauge", "Seconds since the run started", snapshot.elapsed),
+    ]
+    for name, kind, description, value in metrics:
+        if value is None:
+            continue
+        yield f"# HELP nix_eval_jobs_{name} {description}."
+        yield f"# TYPE nix_eval_jobs_{name} {kind}"
+        yield f"nix_eval_jobs_{name} {value}"
+
+    yield "# HELP nix_eval_jobs_span_seconds Time spent in each step of evaluating and writing results."
+    yield "# TYPE nix_eval_jobs_span_seconds summary"
+    for span_name, summary in sorted(snapshot.spans.items()):
+        yield f'nix_eval_jobs_span_seconds_sum{{span="{span_name}"}} {summary.seconds}'
+        yield f'nix_eval_jobs_span_seconds_count{{span="{span_name}"}} {summary.count}'
+
+
+def prometheus_text(snapshot: MetricsSnapshot) -> str:
+    """
+    Renders a sample in the Prometheus text exposition format.
+    """
+    return "".join(f"{line}\n" for line in _prometheus_lines(snapshot))
+
+
+class _MetricsServer(ThreadingHTTPServer):
+    daemon_threads: bool = True
+
+    def __init__(self, address: Address, metrics: "Metrics") -> None:
+        super().__init__(address, _MetricsHandler)
+        self.metrics: Metrics = metrics
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = cast(_MetricsServer, self.server).metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", _PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        _ = self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        # Requests are logged to stderr by default, which would garble the progress bar.
+        LOGGER.debug("Metrics request from %s: %s", self.address_string(), format % args)
+
+
+class Metrics:
+    def __init__(
+        self,
+        recorder: Recorder,
+        listen: Address | None = None,
+        json_path: Path | None = None,
+        trace_path: Path | None = None,
+        interval: float = 1.0,
+    ) -> None:
+        """
+        Samples metrics every `interval` seconds, serving the latest sample on `listen` and appending every sample to
+        `json_path` as JSONL, if given. The spans added to `recorder` are written to `trace_path` as a Chrome trace once
+        the run is complete (see `close`), if given, in which case `recorder` must be tracing.
+        """
+        self.recorder: Recorder = recorder
+        self._trace_path: Path | None = trace_path
+        self._interval: float = interval
+        self._start: float = time.monotonic()
+        self._last_sampled_at: float | None = None
+        self._last_num_completed: int = 0
+        self._latest: MetricsSnapshot | None = None
+        self._json_file: TextIO | None = (
+            json_path.open("w", encoding="utf-8", buffering=1) if json_path is not None else None
+        )
+        self._server: _MetricsServer | None = None
+        if listen is not None:
+            self._server = _MetricsServer(listen, self)
+            host, port = self._server.server_address[:2]
+            LOGGER.info("Serving metrics on http://%s:%s/metrics", host, port)
+            Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+
+    def prometheus_text(self) -> str:
+        # Reading the latest sample is atomic, so this is safe from the server threads.
+        latest = self._latest
+        return prometheus_text(latest) if latest is not None else ""
+
+    def sample(self, coordinator: CoordinatorBase, writer: OutputWriter, force: bool = False) -> None:
+        """
+        Samples metrics if `interval` seconds passed since the last sample, or if `force` is set.
+        """
+        now = time.monotonic()
+        if not force and self._last_sampled_at is not None and now - self._last_sampled_at < self._interval:
+            return
+        counts = coordinator.counts
+        num_completed = counts.excluded + counts.evaluated
+        since = now - (self._last_sampled_at if self._last_sampled_at is not None else self._start)
+        coordinator_rss_bytes, workers_rss_bytes = _rss_bytes()
+        snapshot = MetricsSnapshot(
+            time=time.time(),
+            elapsed=now - self._start,
+            num_discovered=counts.discovered,
+            num_excluded=counts.excluded,
+            num_evaluated=counts.evaluated,
+            num_deduplicated=counts.deduplicated,
+            num_failed=counts.failed,
+            num_tasks=coordinator.task_latency.count,
+            queue_depth=coordinator.queue_depth,
+            num_in_flight=coordinator.num_in_flight,
+            attrs_per_second=(num_completed - self._last_num_completed) / since if since > 0 else 0.0,
+            coordinator_rss_bytes=coordinator_rss_bytes,
+            workers_rss_bytes=workers_rss_bytes,
+            output_pending=writer.pending,
+            spans={
+                name: MetricsSnapshot.SpanSummary(count=total.count, seconds=total.seconds)
+                for name, total in self.recorder.totals().items()
+            },
+        )
+        self._last_sampled_at = now
+        self._last_num_completed = num_completed
+        self._latest = snapshot
+        if self._json_file is not None:
+            print(snapshot.model_dump_json(by_alias=True, indent=None), file=self._json_file)
+        self.recorder.add_counters(
+            snapshot.time,
+            {
+                "queue depth": snapshot.queue_depth,
+                "in flight": snapshot.num_in_flight,
+                "attrs/s": snapshot.attrs_per_second,
+                "output pending": snapshot.output_pending,
+                "workers RSS (MiB)": (workers_rss_bytes or 0) / 2**20,
+            },
+        )
+
+    def close(self) -> None:
+        """
+        Stops serving metrics, and writes the trace if asked for.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._json_file is not None:
+            self._json_file.close()
+        if self._trace_path is not None:
+            self.recorder.write_trace(self._trace_path)
+            LOGGER.info("Wrote a trace of the run to %s", self._trace_path)
@@ -0,0 +1,146 @@
+"""
+A persistent, on-disk cache of evaluation results backed by SQLite.
+
+Entries are keyed by the locked flake reference, the attribute path, and a hash of the expression applied to the value
+along with how it was evaluated (see `evaluation_context`), so a cached result is only reused when it would be identical
+to evaluating again. Multiple processes may share a cache.
+"""
+
+import json
+import sqlite3
+from collections.abc import Sequence
+from dataclasses import dataclass
+from hashlib import sha256
+from logging import Logger
+from pathlib import Path
+from time import time
+from typing import Final, Literal
+
+from nix_eval_jobs.logger import get_logger
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+CacheMode = Literal["read-write", "read-only", "write-only"]
+
+# Number of writes between checks of whether the cache exceeds its maximum size.
+_EVICTION_CHECK_INTERVAL: Final[int] = 256
+
+_SCHEMA: Final[str] = """
+CREATE TABLE IF NOT EXISTS results (
+    flakeref TEXT NOT NULL,
+    attr_path TEXT NOT NULL,
+    apply_hash TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (flakeref, attr_path, apply_hash)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class CacheOptions:
+    path: Path
+    mode: CacheMode = "read-write"
+    # Total size of cached values after which the least recently used entries are evicted.
+    max_bytes: int | None = None
+
+
+def evaluation_context(backend: str, stats: bool, nix_args: Sequence[str]) -> str:
+    """
+    Returns what, besides the expression, decides the result of an evaluation: the backend, whether it reports stats
+    (results without stats must not be reused by a run which wants them), and the arguments given to nix, such as
+    `--option` settings.
+    """
+    return json.dumps([backend, stats, list(nix_args)])
+
+
+def hash_apply_expr(apply_expr: str, context: str = "") -> str:
+    return sha256(f"{context}\0{apply_expr}".encode()).hexdigest()
+
+
+class EvalCache:
+    def __init__(self, options: CacheOptions, context: str = "") -> None:
+        """
+        Opens the cache for results evaluated in `context` (see `evaluation_context`); entries of other contexts are
+        never returned.
+        """
+        self.options: CacheOptions = options
+        self._context: str = context
+        self._num_writes: int = 0
+        # Hashing an expression as large as info.nix for every lookup adds up, so remember them.
+        self._apply_hashes: dict[str, str] = {}
+        self._conn: sqlite3.Connection = sqlite3.connect(options.path, timeout=60.0, isolation_level=None)
+        _ = self._conn.execute("PRAGMA journal_mode=WAL")
+        _ = self._conn.execute("PRAGMA synchronous=NORMAL")
+        _ = self._conn.executescript(_SCHEMA)
+
+    def _key(self, flakeref: str, attr_path: Sequence[str], apply_expr: str) -> tuple[str, str, str]:
+        if (apply_hash := self._apply_hashes.get(apply_expr)) is None:
+            apply_hash = self._apply_hashes[apply_expr] = hash_apply_expr(apply_expr, self._context)
+        return flakeref, json.dumps(attr_path), apply_hash
+
+    def get(self, flakeref: str, attr_path: Sequence[str], apply_expr: str) -> str | None:
+        """
+        Returns the cached value for the evaluation, or None if there is none (or the cache is write-only).
+        """
+        if self.options.mode == "write-only":
+            return None
+
+        key = self._key(flakeref, attr_path, apply_expr)
+        row: tuple[str] | None = self._conn.execute(
+            "SELECT value FROM results WHERE flakeref = ? AND attr_path = ? AND apply_hash = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+
+        if self.options.mode == "read-write":
+            _ = self._conn.execute(
+                "UPDATE results SET last_used = ? WHERE flakeref = ? AND attr_path = ? AND apply_hash = ?",
+                (time(), *key),
+            )
+        return row[0]
+
+    def put(self, flakeref: str, attr_path: Sequence[str], apply_expr: str, value: str) -> None:
+        if self.options.mode == "read-only":
+            return
+
+        key = self._key(flakeref, attr_path, apply_expr)
+        _ = self._conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            (*key, value, len(value), time()),
+        )
+        self._num_writes += 1
+        if self._num_writes % _EVICTION_CHECK_INTERVAL == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Evicts the least recently used entries until the cache is no larger than its maximum size.
+        """
+        if self.options.max_bytes is None:
+            return
+
+        row: tuple[int | None] = self._conn.execute("SELECT SUM(size) FROM results").fetchone()
+        excess_bytes = (row[0] or 0) - self.options.max_bytes
+        if excess_bytes <= 0:
+            return
+
+        LOGGER.info("Evicting %d bytes from the evaluation cache", excess_bytes)
+        # Delete the oldest entries whose cumulative size covers the excess.
+        _ = self._conn.execute(
+            """
+            DELETE FROM results WHERE (flakeref, attr_path, apply_hash) IN (
+                SELECT flakeref, attr_path, apply_hash FROM (
+                    SELECT flakeref, attr_path, apply_hash, SUM(size) OVER (ORDER BY last_used) - size AS preceding
+                    FROM results
+                ) WHERE preceding < ?
+            )
+            """,
+            (excess_bytes,),
+        )
+
+    def close(self) -> None:
+        self.evict()
+        self._conn.close()
@@ -0,0 +1,125 @@
+"""
+Measurement of the cost of evaluating a single attribute.
+
+Every `nix eval` pays for loading the flake and evaluating the scope containing the attribute, which usually dwarfs the
+cost of the attribute itself. To separate the two, the parent of each attribute is evaluated on its own (forced to weak
+head normal form) as a baseline, and its stats are subtracted from those of the attribute. Both are sampled repeatedly
+so the variance of the CPU time, which unlike the counters is not deterministic, can be reported.
+"""
+
+import statistics
+from collections.abc import Callable, Mapping, Sequence
+from logging import Logger
+from typing import Final
+
+from pydantic.alias_generators import to_camel
+
+from nix_eval_jobs.extra_pydantic import PydanticObject
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.evaluator import Evaluator
+from nix_eval_jobs.nix.eval.stats import NixEvalStats
+from nix_eval_jobs.nix.utilities import show_attr_path
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+# The metrics measured, named after their paths in the stats.
+COST_METRICS: Final[Mapping[str, Callable[[NixEvalStats], float]]] = {
+    "cpuTime": lambda stats: stats.cpu_time,
+    "nrThunks": lambda stats: stats.nr_thunks,
+    "nrFunctionCalls": lambda stats: stats.nr_function_calls,
+    "gc.heapSize": lambda stats: stats.gc.heap_size,
+    "envs.bytes": lambda stats: stats.envs.bytes,
+    "sets.bytes": lambda stats: stats.sets.bytes,
+    "values.bytes": lambda stats: stats.values.bytes,
+}
+
+_BASELINE_FUNC_EXPR: Final[str] = "value: builtins.seq value null"
+
+
+class CostSummary(PydanticObject, alias_generator=to_camel):
+    mean: float
+    stdev: float
+    min: float
+
+
+class NixEvalCost(PydanticObject, alias_generator=to_camel):
+    samples: int
+    # Keyed by metric (see COST_METRICS).
+    raw: Mapping[str, CostSummary]
+    baseline: Mapping[str, CostSummary]
+    # The difference between each sample of the attribute and the corresponding sample of the baseline.
+    delta: Mapping[str, CostSummary]
+
+
+def _summarize(values: Sequence[float]) -> CostSummary:
+    return CostSummary(
+        mean=statistics.fmean(values),
+        stdev=statistics.stdev(values) if len(values) > 1 else 0.0,
+        min=min(values),
+    )
+
+
+def _summarize_metrics(samples: Sequence[Mapping[str, float]]) -> dict[str, CostSummary]:
+    return {metric: _summarize([sample[metric] for sample in samples]) for metric in COST_METRICS}
+
+
+def _sample(
+    evaluator: Evaluator, flakeref: str, attr_path: Sequence[str], apply_expr: str, samples: int
+) -> list[NixEvalStats] | None:
+    sampled: list[NixEvalStats] = []
+    for _ in range(samples):
+        if (stats := evaluator.eval(flakeref, attr_path, apply_expr).stats) is None:
+            return None
+        sampled.append(stats)
+    return sampled
+
+
+# Baselines are per-process and shared by every attribute with the same parent the process measures.
+_BASELINES: dict[tuple[str, tuple[str, ...]], list[NixEvalStats] | None] = {}
+
+
+def _baseline(
+    evaluator: Evaluator, flakeref: str, parent_attr_path: Sequence[str], samples: int
+) -> list[NixEvalStats] | None:
+    key = (flakeref, tuple(parent_attr_path))
+    if key not in _BASELINES:
+        LOGGER.info("Measuring the baseline for %s", show_attr_path(parent_attr_path))
+        _BASELINES[key] = _sample(evaluator, flakeref, parent_attr_path, _BASELINE_FUNC_EXPR, samples)
+    return _BASELINES[key]
+
+
+def measure(
+    evaluator: Evaluator,
+    flakeref: str,
+    attr_path: Sequence[str],
+    apply_expr: str,
+    first_sample: NixEvalStats | None,
+    samples: int,
+) -> NixEvalCost | None:
+    """
+    Measures the cost of evaluating `apply_expr` applied to the value at `attr_path` with `evaluator` over `samples`
+    samples, the first of which has already been taken if `first_sample` is given.
+
+    Returns None if the attribute is at the top level, so it has no parent to serve as the baseline, or if a sample
+    could not be taken.
+    """
+    if not attr_path[:-1]:
+        return None
+    if (baseline := _baseline(evaluator, flakeref, attr_path[:-1], samples)) is None:
+        return None
+    taken = [first_sample] if first_sample is not None else []
+    if (rest := _sample(evaluator, flakeref, attr_path, apply_expr, samples - len(taken))) is None:
+        return None
+
+    raw_samples = [{metric: get(stats) for metric, get in COST_METRICS.items()} for stats in [*taken, *rest]]
+    baseline_samples = [{metric: get(stats) for metric, get in COST_METRICS.items()} for stats in baseline]
+    delta_samples = [
+        {metric: raw_sample[metric] - baseline_sample[metric] for metric in COST_METRICS}
+        for raw_sample, baseline_sample in zip(raw_samples, baseline_samples, strict=True)
+    ]
+    return NixEvalCost(
+        samples=samples,
+        raw=_summarize_metrics(raw_samples),
+        baseline=_summarize_metrics(baseline_samples),
+        delta=_summarize_metrics(delta_samples),
+    )
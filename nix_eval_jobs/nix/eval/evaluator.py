@@ -0,0 +1,290 @@
+"""
+The interface between the scheduler and whatever evaluates Nix expressions.
+
+An evaluator applies an expression to the value at an attribute path of a flake, or to each of several children of one
+(see `nix_eval_jobs.nix.eval.raw.eval_many`), and reports what it can do through its capabilities, which callers use to
+decide how to use it: children are only evaluated in batches by evaluators which support batching, and costs are only
+measured with evaluators which report stats.
+
+Backends are selected by name (see `BACKENDS`), or by the import path of a factory taking `EvaluatorOptions`, as in
+`my_package.my_module:MyEvaluator`, so new backends can be used without changing the scheduler.
+"""
+
+import asyncio
+import importlib
+from collections.abc import AsyncGenerator, Callable, Mapping, Sequence
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Final, Protocol, cast
+
+import nix_eval_jobs.nix.eval.failure
+import nix_eval_jobs.nix.eval.raw
+import nix_eval_jobs.tracing
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.raw import EvalLimits, RawNixEvalResult
+from nix_eval_jobs.nix.eval.repl import NixReplError, NixReplSession
+from nix_eval_jobs.nix.eval.validation import Validation
+from nix_eval_jobs.nix.utilities import show_attr_path
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class EvaluatorCapabilities:
+    # Whether eval_many evaluates children in a single evaluation, rather than one at a time.
+    batching: bool
+    # Whether results have stats which can be attributed to the evaluation which produced them.
+    stats: bool
+
+
+@dataclass(frozen=True, slots=True)
+class EvaluatorOptions:
+    # Extra arguments passed to every nix the evaluator runs, such as `--option` settings.
+    nix_args: Sequence[str] = ()
+    # Only used by the repl backend: the number of requests and the resident set size after which a session is replaced
+    # by a fresh one.
+    repl_max_requests: int | None = None
+    repl_max_rss_bytes: int | None = None
+    # Only used by the subprocess backends: bounds on each nix eval, and how failures are retried.
+    limits: EvalLimits = field(default_factory=EvalLimits)
+    # Only used by the subprocess backends: whether nix reports stats, which costs time in nix and in reading them.
+    stats: bool = True
+    # How thoroughly results are validated (see nix_eval_jobs.nix.eval.validation).
+    validation: Validation = "strict"
+
+
+class Evaluator(Protocol):
+    @property
+    def capabilities(self) -> EvaluatorCapabilities: ...
+
+    def eval(self, flakeref: str, attr_path: Sequence[str], apply_expr: str) -> RawNixEvalResult:
+        """
+        Evaluates `apply_expr` applied to the value at `attr_path`. The value of the result is None if evaluation
+        failed.
+        """
+        ...
+
+    def eval_many(
+        self, flakeref: str, parent_attr_path: Sequence[str], child_names: Sequence[str], apply_expr: str
+    ) -> RawNixEvalResult:
+        """
+        Evaluates `apply_expr` applied to each of the children of `parent_attr_path` named by `child_names`. On
+        success, the value of the result is a list with one entry per child, in order, which is null if evaluating that
+        child threw.
+        """
+        ...
+
+    def close(self) -> None:
+        """
+        Releases any resources held, such as long-lived processes.
+        """
+        ...
+
+
+class SubprocessEvaluator:
+    """
+    Runs a `nix eval` per evaluation, which gives per-evaluation stats.
+    """
+
+    def __init__(self, options: EvaluatorOptions) -> None:
+        self._nix_args: Sequence[str] = options.nix_args
+        self._limits: EvalLimits = options.limits
+        self._stats: bool = options.stats
+        self._validation: Validation = options.validation
+
+    @property
+    def capabilities(self) -> EvaluatorCapabilities:
+        return EvaluatorCapabilities(batching=True, stats=self._stats)
+
+    def eval(self, flakeref: str, attr_path: Sequence[str], apply_expr: str) -> RawNixEvalResult:
+        return nix_eval_jobs.nix.eval.raw.eval(
+            flakeref, attr_path, apply_expr, self._nix_args, self._limits, self._stats, self._validation
+        )
+
+    def eval_many(
+        self, flakeref: str, parent_attr_path: Sequence[str], child_names: Sequence[str], apply_expr: str
+    ) -> RawNixEvalResult:
+        return nix_eval_jobs.nix.eval.raw.eval_many(
+            flakeref,
+            parent_attr_path,
+            child_names,
+            apply_expr,
+            self._nix_args,
+            self._limits,
+            self._stats,
+            self._validation,
+        )
+
+    def close(self) -> None:
+        pass
+
+
+class ReplEvaluator:
+    """
+    Streams evaluations to a long-lived `nix repl` per flake, which is faster but does not give stats.
+    """
+
+    def __init__(self, options: EvaluatorOptions) -> None:
+        self._options: EvaluatorOptions = options
+        self._sessions: dict[str, NixReplSession] = {}
+
+    @property
+    def capabilities(self) -> EvaluatorCapabilities:
+        return EvaluatorCapabilities(batching=True, stats=False)
+
+    def _eval(
+        self,
+        flakeref: str,
+        attr_path: Sequence[str],
+        apply_expr: str,
+        child_names: Sequence[str] | None = None,
+    ) -> RawNixEvalResult:
+        if (session := self._sessions.get(flakeref)) is None:
+            session = self._sessions[flakeref] = NixReplSession(
+                flakeref, self._options.nix_args, self._options.validation
+            )
+
+        try:
+            result = session.eval(attr_path, apply_expr, child_names)
+        except NixReplError as e:
+            failure = nix_eval_jobs.nix.eval.failure.classify(str(e), None)
+            LOGGER.error("Evaluation failed (%s): %s", failure.kind, e)
+            del self._sessions[flakeref]
+            session.close()
+            return RawNixEvalResult.model_validate({"stats": None, "stderr": str(e), "value": None, "failure": failure})
+
+        max_requests = self._options.repl_max_requests
+        max_rss_bytes = self._options.repl_max_rss_bytes
+        if (max_requests is not None and session.num_requests >= max_requests) or (
+            max_rss_bytes is not None and (session.rss_bytes() or 0) >= max_rss_bytes
+        ):
+            LOGGER.info("Recycling nix repl for %s after %d requests", flakeref, session.num_requests)
+            del self._sessions[flakeref]
+            session.close()
+
+        return result
+
+    def eval(self, flakeref: str, attr_path: Sequence[str], apply_expr: str) -> RawNixEvalResult:
+        LOGGER.info("Evaluating %s#%s", flakeref, show_attr_path(attr_path))
+        return self._eval(flakeref, attr_path, apply_expr)
+
+    def eval_many(
+        self, flakeref: str, parent_attr_path: Sequence[str], child_names: Sequence[str], apply_expr: str
+    ) -> RawNixEvalResult:
+        LOGGER.info("Evaluating %d children of %s#%s", len(child_names), flakeref, show_attr_path(parent_attr_path))
+        return self._eval(flakeref, parent_attr_path, apply_expr, child_names)
+
+    def close(self) -> None:
+        while self._sessions:
+            _, session = self._sessions.popitem()
+            session.close()
+
+
+class AsyncEvaluator(Protocol):
+    """
+    Like `Evaluator`, but evaluating without blocking, so many evaluations can run at once in a single event loop.
+    """
+
+    @property
+    def capabilities(self) -> EvaluatorCapabilities: ...
+
+    async def eval(self, flakeref: str, attr_path: Sequence[str], apply_expr: str) -> RawNixEvalResult: ...
+
+    async def eval_many(
+        self, flakeref: str, parent_attr_path: Sequence[str], child_names: Sequence[str], apply_expr: str
+    ) -> RawNixEvalResult: ...
+
+    def close(self) -> None: ...
+
+
+class AsyncSubprocessEvaluator:
+    """
+    Like `SubprocessEvaluator`, but running up to `max_concurrency` `nix eval` at once without blocking.
+    """
+
+    def __init__(self, options: EvaluatorOptions, max_concurrency: int) -> None:
+        self._nix_args: Sequence[str] = options.nix_args
+        self._limits: EvalLimits = options.limits
+        self._stats: bool = options.stats
+        self._validation: Validation = options.validation
+        self._semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def capabilities(self) -> EvaluatorCapabilities:
+        return EvaluatorCapabilities(batching=True, stats=self._stats)
+
+    @asynccontextmanager
+    async def _slot(self) -> AsyncGenerator[None, None]:
+        """
+        Waits for one of the `max_concurrency` slots to evaluate in, recording the wait as a span.
+        """
+        with nix_eval_jobs.tracing.span("slot"):
+            await self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    async def eval(self, flakeref: str, attr_path: Sequence[str], apply_expr: str) -> RawNixEvalResult:
+        async with self._slot():
+            return await nix_eval_jobs.nix.eval.raw.eval_async(
+                flakeref, attr_path, apply_expr, self._nix_args, self._limits, self._stats, self._validation
+            )
+
+    async def eval_many(
+        self, flakeref: str, parent_attr_path: Sequence[str], child_names: Sequence[str], apply_expr: str
+    ) -> RawNixEvalResult:
+        async with self._slot():
+            return await nix_eval_jobs.nix.eval.raw.eval_many_async(
+                flakeref,
+                parent_attr_path,
+                child_names,
+                apply_expr,
+                self._nix_args,
+                self._limits,
+                self._stats,
+                self._validation,
+            )
+
+    def close(self) -> None:
+        pass
+
+
+EvaluatorFactory = Callable[[EvaluatorOptions], Evaluator]
+
+BACKENDS: Final[Mapping[str, EvaluatorFactory]] = {
+    "subprocess": SubprocessEvaluator,
+    "repl": ReplEvaluator,
+}
+
+
+class UnknownBackendError(Exception):
+    pass
+
+
+def _factory(backend: str) -> EvaluatorFactory:
+    if (factory := BACKENDS.get(backend)) is not None:
+        return factory
+
+    module_name, sep, attr = backend.partition(":")
+    if not sep:
+        raise UnknownBackendError(
+            f"Unknown backend {backend}: expected one of {', '.join(BACKENDS)} or the import path of a factory, as in "
+            + "module:attr"
+        )
+    try:
+        imported: object = getattr(importlib.import_module(module_name), attr)
+    except (ImportError, AttributeError) as e:
+        raise UnknownBackendError(f"Cannot import backend {backend}: {e}") from e
+    if not callable(imported):
+        raise UnknownBackendError(f"Backend {backend} is not callable")
+    # There is no checking what an arbitrary callable returns until it is called, so trust it to return an evaluator.
+    return cast(EvaluatorFactory, imported)
+
+
+def create(backend: str, options: EvaluatorOptions) -> Evaluator:
+    """
+    Creates an evaluator for the backend named `backend` (see the module documentation).
+    """
+    return _factory(backend)(options)
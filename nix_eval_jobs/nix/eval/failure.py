@@ -0,0 +1,66 @@
+"""
+Classification of failed evaluations.
+
+An evaluation fails because Nix reported an error (`eval`), because it ran for longer than the timeout (`timeout`), ran
+out of memory or was killed for using too much (`oom`), or could not fetch a flake input or a source needed by an import
+from derivation (`fetch`). Only running out of memory and fetching may succeed when tried again; errors are
+deterministic, and retrying an attribute which timed out would only make it a longer straggler.
+"""
+
+import re
+import signal
+from collections.abc import Sequence
+from typing import Final, Literal
+
+from pydantic.alias_generators import to_camel
+
+from nix_eval_jobs.extra_pydantic import PydanticObject
+
+FailureKind = Literal["eval", "timeout", "oom", "fetch"]
+
+RETRYABLE: Final[frozenset[FailureKind]] = frozenset({"oom", "fetch"})
+
+# Patterns in stderr identifying the kind of a failure, checked in order. Anything else is an evaluation error.
+_PATTERNS: Final[Sequence[tuple[FailureKind, re.Pattern[str]]]] = [
+    ("oom", re.compile(r"out of memory|std::bad_alloc|cannot allocate memory", re.IGNORECASE)),
+    (
+        "fetch",
+        re.compile(
+            r"unable to download|while fetching|cannot fetch|failed to fetch|could not resolve host|failed to connect"
+            + r"|connection timed out|HTTP error \d+",
+            re.IGNORECASE,
+        ),
+    ),
+]
+
+
+class EvalFailure(PydanticObject, alias_generator=to_camel):
+    kind: FailureKind
+    # The most specific error reported, which is the last line of stderr starting with "error:", if any.
+    message: str
+    # Number of times the evaluation was attempted, including retries.
+    attempts: int = 1
+
+
+def _message(stderr: str) -> str:
+    lines = [line.strip() for line in stderr.splitlines() if line.strip()]
+    errors = [line for line in lines if line.startswith("error:")]
+    return errors[-1] if errors else lines[-1] if lines else ""
+
+
+def classify(stderr: str, returncode: int | None, timeout: float | None = None, attempts: int = 1) -> EvalFailure:
+    """
+    Classifies a failed evaluation from its stderr and exit status. `timeout` is given when the evaluation was killed
+    for running longer than it.
+    """
+    if timeout is not None:
+        return EvalFailure(kind="timeout", message=f"timed out after {timeout:g}s", attempts=attempts)
+    message = _message(stderr)
+    if returncode == -signal.SIGKILL:
+        # Killed by the coordinator for using too much memory (see nix_eval_jobs.scheduler.admission), or by the OOM
+        # killer.
+        return EvalFailure(kind="oom", message=message or "killed", attempts=attempts)
+    for kind, pattern in _PATTERNS:
+        if pattern.search(stderr) is not None:
+            return EvalFailure(kind=kind, message=message, attempts=attempts)
+    return EvalFailure(kind="eval", message=message, attempts=attempts)
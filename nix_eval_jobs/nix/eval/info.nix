@@ -2,9 +2,16 @@
 # excluded.
 # NOTE: Because we are being provided the value from a flake reference, due to the way `nix eval` works, we know that
 # it is not `builtins.throw`, because the evaluation would have failed even before reaching this function.
+# NOTE: Applied to its settings first (see nix_eval_jobs.nix.eval.info), then to the value.
 let
-  inherit (builtins) deepSeq tryEval;
+  inherit (builtins)
+    deepSeq
+    elemAt
+    length
+    tryEval
+    ;
 in
+{ probeScopes }:
 value:
 let
   isAttrs = builtins.isAttrs value;
@@ -42,9 +49,45 @@ let
     && (!isDerivation || value.__recurseIntoDerivationForReleaseJobs or false)
     && value.recurseForDerivations or false
     && !(value.__attrsFailEvaluation or false);
+  # Fuse discovery of children into the same evaluation so recursing does not require launching a second `nix eval`
+  # which would re-evaluate everything leading up to this value.
+  attrNames = if recurse then builtins.attrNames value else null;
+
+  # Only when scopes are deduplicated (see nix_eval_jobs.scheduler.dedup): the derivation path of the first derivation
+  # among the first few children, which together with the names of the children cheaply tells apart scopes which share
+  # names, such as package sets for different versions of an interpreter.
+  # NOTE: Children which throw are skipped, but errors which `tryEval` cannot catch fail the evaluation of the scope,
+  # which is why this is opt-in.
+  childDrvPath =
+    name:
+    let
+      child = value.${name};
+      attempt = tryEval (
+        if builtins.isAttrs child && child.type or null == "derivation" then
+          deepSeq child.drvPath child.drvPath
+        else
+          null
+      );
+    in
+    if attempt.success then attempt.value else null;
+  firstChildDrvPath =
+    i:
+    if i >= length attrNames || i >= 4 then
+      null
+    else
+      let
+        childDrvPath' = childDrvPath (elemAt attrNames i);
+      in
+      if childDrvPath' != null then childDrvPath' else firstChildDrvPath (i + 1);
 in
 {
-  inherit include drvPath recurse;
+  inherit
+    include
+    drvPath
+    recurse
+    attrNames
+    ;
+  probeDrvPath = if probeScopes && recurse then firstChildDrvPath 0 else null;
   name = if isDerivation then value.name or null else null;
   system = if isDerivation then value.system or null else null;
 }
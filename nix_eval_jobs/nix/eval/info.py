@@ -1,104 +1,89 @@
-from collections.abc import Iterable, Sequence, Set
+import asyncio
+from collections.abc import Mapping, Sequence
 from logging import Logger
 from pathlib import Path
-from typing import Final
+from typing import Any, Final
 
 from pydantic.alias_generators import to_camel
 
+import nix_eval_jobs.nix.eval.cost
+import nix_eval_jobs.nix.eval.failure
+import nix_eval_jobs.nix.eval.validation
+import nix_eval_jobs.tracing
 from nix_eval_jobs.extra_pydantic import PydanticObject
 from nix_eval_jobs.logger import get_logger
-from nix_eval_jobs.nix.eval.raw import eval
+from nix_eval_jobs.nix.eval.cache import EvalCache
+from nix_eval_jobs.nix.eval.cost import NixEvalCost
+from nix_eval_jobs.nix.eval.evaluator import AsyncEvaluator, Evaluator
+from nix_eval_jobs.nix.eval.failure import EvalFailure
+from nix_eval_jobs.nix.eval.raw import RawNixEvalResult
 from nix_eval_jobs.nix.eval.stats import NixEvalStats
+from nix_eval_jobs.nix.eval.validation import Validation
 from nix_eval_jobs.nix.utilities import show_attr_path
 
 LOGGER: Final[Logger] = get_logger(__name__)
 
+_INFO_NIX: Final[str] = (Path(__file__).parent / "info.nix").read_text()
 
-# TODO: Since the attribute set of derivations we're recursing into isn't necessarily rooted at pkgs,
-# excluding things at the top level doesn't make sense.
-_EXCLUDED_ATTRS: Set[str] = (
-    # Originally excludedAtTopLevel
-    #
-    # No release package attrpath may have any of these attrnames as
-    # its initial component.
-    #
-    # If you can find a way to remove any of these entries without
-    # causing CI to fail, please do so.
-    #
-    {
-        "AAAAAASomeThingsFailToEvaluate",
-        #  spliced packagesets
-        "__splicedPackages",
-        "pkgsBuildBuild",
-        "pkgsBuildHost",
-        "pkgsBuildTarget",
-        "pkgsHostHost",
-        "pkgsHostTarget",
-        "pkgsTargetTarget",
-        "buildPackages",
-        "targetPackages",
-        # cross packagesets
-        "pkgsLLVM",
-        "pkgsMusl",
-        "pkgsStatic",
-        "pkgsCross",
-        "pkgsx86_64Darwin",
-        "pkgsi686Linux",
-        "pkgsLinux",
-        "pkgsExtraHardening",
-    }
-    |
-    # Originally excludedAtAnyLevel
-    #
-    # No release package attrname may have any of these at a component
-    # anywhere in its attrpath.  These are the names of gigantic
-    # top-level attrsets that have leaked into so many sub-packagesets
-    # that it's easier to simply exclude them entirely.
-    #
-    # If you can find a way to remove any of these entries without
-    # causing CI to fail, please do so.
-    #
-    {
-        "lib",
-        "override",
-        "__functor",
-        "__functionArgs",
-        "__splicedPackages",
-        "newScope",
-        "scope",
-        "pkgs",
-        "callPackage",
-        "mkDerivation",
-        "overrideDerivation",
-        "overrideScope",
-        "overrideScope'",
-        # Special case: lib/types.nix leaks into a lot of nixos-related
-        # derivations, and does not eval deeply.
-        "type",
-    }
-)
+# info.nix applied to its settings, keyed by whether scopes are probed.
+_INFO_NIX_FUNC_EXPRS: Final[Mapping[bool, str]] = {
+    probe_scopes: f"({_INFO_NIX}) {{ probeScopes = {'true' if probe_scopes else 'false'}; }}"
+    for probe_scopes in (False, True)
+}
 
-_INFO_NIX_FUNC_EXPR: str = (Path(__file__).parent / "info.nix").read_text()
 
+def _info_nix_func_expr(probe_scopes: bool) -> str:
+    """
+    Returns info.nix applied to its settings, probing scopes for a derivation path to fingerprint them with (see
+    `nix_eval_jobs.scheduler.dedup`) if `probe_scopes` is set.
+    """
+    return _INFO_NIX_FUNC_EXPRS[probe_scopes]
 
-def is_excluded_attr(attr_path: Iterable[str]) -> bool:
-    exclude: bool = any(attr in _EXCLUDED_ATTRS for attr in attr_path)
-    if exclude:
-        LOGGER.info("excluding attribute %s", show_attr_path(attr_path))
-    return exclude
+
+_ATTR_NAMES_FUNC_EXPR: str = "builtins.attrNames"
 
 
 class NixEvalResultAttrNames(PydanticObject, alias_generator=to_camel):
-    stats: NixEvalStats
+    stats: NixEvalStats | None
     stderr: str
     value: Sequence[str]
 
 
-def attr_names(flakeref: str, attr_path: Iterable[str]) -> NixEvalResultAttrNames:
-    if (raw := eval(flakeref, attr_path, "builtins.attrNames")).value is None:
-        raw.value = []
+def _get_cached_attr_names(
+    cache: EvalCache | None, flakeref: str, attr_path: Sequence[str]
+) -> NixEvalResultAttrNames | None:
+    if cache is None or (cached := cache.get(flakeref, attr_path, _ATTR_NAMES_FUNC_EXPR)) is None:
+        return None
+    return NixEvalResultAttrNames.model_validate_json(cached)
+
+
+def _attr_names_from_raw(
+    cache: EvalCache | None, flakeref: str, attr_path: Sequence[str], raw: RawNixEvalResult, validation: Validation
+) -> NixEvalResultAttrNames:
+    result = nix_eval_jobs.nix.eval.validation.assemble(
+        NixEvalResultAttrNames,
+        validation,
+        stats=raw.stats,
+        stderr=raw.stderr,
+        value=raw.value if raw.value is not None else [],
+    )
+    if raw.value is not None and cache is not None:
+        cache.put(flakeref, attr_path, _ATTR_NAMES_FUNC_EXPR, result.model_dump_json(by_alias=True))
+    return result
+
 
-    return NixEvalResultAttrNames.model_validate(raw, from_attributes=True)
+def attr_names(
+    flakeref: str,
+    attr_path: Sequence[str],
+    evaluator: Evaluator,
+    cache: EvalCache | None = None,
+    validation: Validation = "strict",
+) -> NixEvalResultAttrNames:
+    if (result := _get_cached_attr_names(cache, flakeref, attr_path)) is not None:
+        return result
+    return _attr_names_from_raw(
+        cache, flakeref, attr_path, evaluator.eval(flakeref, attr_path, _ATTR_NAMES_FUNC_EXPR), validation
+    )
 
 
 class NixEvalResultGetInfo(PydanticObject, alias_generator=to_camel):
@@ -110,16 +95,351 @@ class NixEvalResultGetInfo(PydanticObject, alias_generator=to_camel):
         drv_path: str | None = None
         system: str | None = None
         recurse: bool
+        # Names of the children, populated by info.nix only when recurse is true. Only used to discover new attribute
+        # paths, so it is excluded from the output (see OUTPUT_EXCLUDE).
+        attr_names: Sequence[str] | None = None
+        # The derivation path of one of the children, populated by info.nix only when recurse is true and scopes are
+        # probed. Only used to fingerprint scopes, so it is excluded from the output.
+        probe_drv_path: str | None = None
 
-    stats: NixEvalStats
+    stats: NixEvalStats | None
     stderr: str
+    # Number of attributes evaluated by the `nix eval` which produced stats and stderr.
+    batch_size: int = 1
     value: NixEvalResultInfo
+    # Only measured when requested, and only written to the output when measured (see output_exclude).
+    cost: NixEvalCost | None = None
+    # Why evaluating the attribute failed, only written to the output when it did.
+    failure: EvalFailure | None = None
+
+
+# Fields of NixEvalResultGetInfo which are not written to the output.
+OUTPUT_EXCLUDE: Final[Mapping[str, Any]] = {"value": {"attr_names", "probe_drv_path"}}
+
+
+def output_exclude(info: NixEvalResultGetInfo) -> Mapping[str, Any]:
+    """
+    Returns the fields of `info` which are not written to the output.
+    """
+    exclude = {**OUTPUT_EXCLUDE}
+    if info.cost is None:
+        exclude["cost"] = True
+    if info.failure is None:
+        exclude["failure"] = True
+    return exclude
+
+
+# The failure of a child which threw in a batch, whose error is not reported.
+_BATCH_CHILD_FAILURE: Final[EvalFailure] = EvalFailure(
+    kind="eval", message="threw an error while evaluated in a batch (evaluate it on its own for the error)"
+)
+
+
+def info_from_raw(
+    stats: NixEvalStats | None,
+    stderr: str,
+    value: dict[str, Any] | None,
+    attr_path: Sequence[str],
+    batch_size: int = 1,
+    failure: EvalFailure | None = None,
+    validation: Validation = "strict",
+) -> NixEvalResultGetInfo:
+    """
+    Builds the info for `attr_path` from the stats and stderr of the evaluation and the value info.nix returned for it
+    (or None if evaluating it failed, in which case `failure` is why, if known).
+
+    In a batch, a child whose value is None threw an error which was caught (see many.nix), so only the evaluation of
+    the batch as a whole would have a failure; the child gets one of its own.
+    """
+    if value is None:
+        value = {"include": False, "drvPath": None, "recurse": False}
+        if failure is None:
+            failure = _BATCH_CHILD_FAILURE if batch_size > 1 else nix_eval_jobs.nix.eval.failure.classify(stderr, None)
+    value["attr"] = show_attr_path(attr_path)
+    value["attrPath"] = attr_path
+    return nix_eval_jobs.nix.eval.validation.assemble(
+        NixEvalResultGetInfo,
+        validation,
+        stats=stats,
+        stderr=stderr,
+        batch_size=batch_size,
+        value=NixEvalResultGetInfo.NixEvalResultInfo.model_validate(value),
+        failure=failure,
+    )
+
+
+def _cache_info(cache: EvalCache | None, flakeref: str, apply_expr: str, info: NixEvalResultGetInfo) -> None:
+    # Only successful evaluations are cached, since failures may be transient. This includes children which threw in a
+    # batch, though the batch itself succeeded.
+    if cache is not None and info.failure is None:
+        cache.put(flakeref, info.value.attr_path, apply_expr, info.model_dump_json(by_alias=True))
+
+
+def _get_cached_info(
+    cache: EvalCache | None, flakeref: str, apply_expr: str, attr_path: Sequence[str]
+) -> NixEvalResultGetInfo | None:
+    if cache is None or (cached := cache.get(flakeref, attr_path, apply_expr)) is None:
+        return None
+    return NixEvalResultGetInfo.model_validate_json(cached)
+
+
+def _info_from_eval(
+    cache: EvalCache | None,
+    flakeref: str,
+    apply_expr: str,
+    attr_path: Sequence[str],
+    raw: RawNixEvalResult,
+    validation: Validation,
+) -> NixEvalResultGetInfo:
+    with nix_eval_jobs.tracing.span("validate"):
+        info = info_from_raw(raw.stats, raw.stderr, raw.value, attr_path, failure=raw.failure, validation=validation)
+    _cache_info(cache, flakeref, apply_expr, info)
+    return info
+
+
+def _batches(evaluator: Evaluator | AsyncEvaluator, child_names: Sequence[str]) -> bool:
+    return len(child_names) > 1 and evaluator.capabilities.batching
+
+
+def _infos_from_batch(
+    cache: EvalCache | None,
+    flakeref: str,
+    apply_expr: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+    raw: RawNixEvalResult,
+    validation: Validation,
+) -> list[NixEvalResultGetInfo] | None:
+    """
+    Returns the info of each child from the evaluation of a batch, or None if the batch as a whole failed.
+    """
+    if raw.value is None:
+        LOGGER.warning(
+            "Batch of %d children of %s failed, falling back to individual evaluation",
+            len(child_names),
+            show_attr_path(parent_attr_path),
+        )
+        return None
+
+    with nix_eval_jobs.tracing.span("validate"):
+        infos = [
+            info_from_raw(
+                raw.stats,
+                raw.stderr,
+                value,
+                [*parent_attr_path, child_name],
+                len(child_names),
+                validation=validation,
+            )
+            for child_name, value in zip(child_names, raw.value, strict=True)
+        ]
+    for info in infos:
+        _cache_info(cache, flakeref, apply_expr, info)
+    return infos
+
+
+def _get_cached_infos(
+    cache: EvalCache | None,
+    flakeref: str,
+    apply_expr: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+) -> dict[str, NixEvalResultGetInfo]:
+    infos: dict[str, NixEvalResultGetInfo] = {}
+    for child_name in child_names:
+        if (info := _get_cached_info(cache, flakeref, apply_expr, [*parent_attr_path, child_name])) is not None:
+            infos[child_name] = info
+    return infos
+
+
+def _get_info(
+    flakeref: str,
+    attr_path: Sequence[str],
+    evaluator: Evaluator,
+    cache: EvalCache | None,
+    apply_expr: str,
+    validation: Validation,
+) -> NixEvalResultGetInfo:
+    return _info_from_eval(
+        cache, flakeref, apply_expr, attr_path, evaluator.eval(flakeref, attr_path, apply_expr), validation
+    )
+
+
+def get_info(
+    flakeref: str,
+    attr_path: Sequence[str],
+    evaluator: Evaluator,
+    cache: EvalCache | None = None,
+    probe_scopes: bool = False,
+    validation: Validation = "strict",
+) -> NixEvalResultGetInfo:
+    apply_expr = _info_nix_func_expr(probe_scopes)
+    if (info := _get_cached_info(cache, flakeref, apply_expr, attr_path)) is not None:
+        return info
+    return _get_info(flakeref, attr_path, evaluator, cache, apply_expr, validation)
+
+
+def _get_info_many(
+    flakeref: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+    evaluator: Evaluator,
+    cache: EvalCache | None,
+    apply_expr: str,
+    validation: Validation,
+) -> list[NixEvalResultGetInfo]:
+    if _batches(evaluator, child_names):
+        raw = evaluator.eval_many(flakeref, parent_attr_path, child_names, apply_expr)
+        if (
+            infos := _infos_from_batch(cache, flakeref, apply_expr, parent_attr_path, child_names, raw, validation)
+        ) is not None:
+            return infos
+    return [
+        _get_info(flakeref, [*parent_attr_path, child_name], evaluator, cache, apply_expr, validation)
+        for child_name in child_names
+    ]
+
+
+def get_info_many(
+    flakeref: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+    evaluator: Evaluator,
+    cache: EvalCache | None = None,
+    probe_scopes: bool = False,
+    validation: Validation = "strict",
+) -> list[NixEvalResultGetInfo]:
+    """
+    Gets the info for each of the children of `parent_attr_path` named by `child_names` using a single evaluation, if
+    the evaluator supports batching.
+
+    Children with results in the cache are not evaluated. If the batch as a whole fails to evaluate (for example,
+    because a child fails with an error `tryEval` cannot catch), falls back to evaluating each child individually so
+    failures remain isolated. Scopes are probed to fingerprint them with if `probe_scopes` is set (see
+    `nix_eval_jobs.scheduler.dedup`).
+    """
+    apply_expr = _info_nix_func_expr(probe_scopes)
+    infos = _get_cached_infos(cache, flakeref, apply_expr, parent_attr_path, child_names)
+    if uncached_child_names := [child_name for child_name in child_names if child_name not in infos]:
+        infos.update(
+            zip(
+                uncached_child_names,
+                _get_info_many(
+                    flakeref, parent_attr_path, uncached_child_names, evaluator, cache, apply_expr, validation
+                ),
+                strict=True,
+            )
+        )
+    return [infos[child_name] for child_name in child_names]
+
+
+async def attr_names_async(
+    flakeref: str,
+    attr_path: Sequence[str],
+    evaluator: AsyncEvaluator,
+    cache: EvalCache | None = None,
+    validation: Validation = "strict",
+) -> NixEvalResultAttrNames:
+    """
+    Like `attr_names`, but with an evaluator which does not block.
+    """
+    if (result := _get_cached_attr_names(cache, flakeref, attr_path)) is not None:
+        return result
+    return _attr_names_from_raw(
+        cache, flakeref, attr_path, await evaluator.eval(flakeref, attr_path, _ATTR_NAMES_FUNC_EXPR), validation
+    )
+
+
+async def _get_info_async(
+    flakeref: str,
+    attr_path: Sequence[str],
+    evaluator: AsyncEvaluator,
+    cache: EvalCache | None,
+    apply_expr: str,
+    validation: Validation,
+) -> NixEvalResultGetInfo:
+    return _info_from_eval(
+        cache, flakeref, apply_expr, attr_path, await evaluator.eval(flakeref, attr_path, apply_expr), validation
+    )
+
+
+async def _get_info_many_async(
+    flakeref: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+    evaluator: AsyncEvaluator,
+    cache: EvalCache | None,
+    apply_expr: str,
+    validation: Validation,
+) -> list[NixEvalResultGetInfo]:
+    if _batches(evaluator, child_names):
+        raw = await evaluator.eval_many(flakeref, parent_attr_path, child_names, apply_expr)
+        if (
+            infos := _infos_from_batch(cache, flakeref, apply_expr, parent_attr_path, child_names, raw, validation)
+        ) is not None:
+            return infos
+    # Evaluates each child on its own, all at once.
+    return list(
+        await asyncio.gather(
+            *(
+                _get_info_async(flakeref, [*parent_attr_path, child_name], evaluator, cache, apply_expr, validation)
+                for child_name in child_names
+            )
+        )
+    )
+
+
+async def get_info_many_async(
+    flakeref: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+    evaluator: AsyncEvaluator,
+    cache: EvalCache | None = None,
+    probe_scopes: bool = False,
+    validation: Validation = "strict",
+) -> list[NixEvalResultGetInfo]:
+    """
+    Like `get_info_many`, but with an evaluator which does not block. When falling back to evaluating children
+    individually, they are evaluated concurrently.
+    """
+    apply_expr = _info_nix_func_expr(probe_scopes)
+    infos = _get_cached_infos(cache, flakeref, apply_expr, parent_attr_path, child_names)
+    if uncached_child_names := [child_name for child_name in child_names if child_name not in infos]:
+        infos.update(
+            zip(
+                uncached_child_names,
+                await _get_info_many_async(
+                    flakeref, parent_attr_path, uncached_child_names, evaluator, cache, apply_expr, validation
+                ),
+                strict=True,
+            )
+        )
+    return [infos[child_name] for child_name in child_names]
 
 
-def get_info(flakeref: str, attr_path: Iterable[str]) -> NixEvalResultGetInfo:
-    if (raw := eval(flakeref, attr_path, _INFO_NIX_FUNC_EXPR)).value is None:
-        raw.value = {"include": False, "drvPath": None, "recurse": False}
-    raw.value["attr"] = show_attr_path(attr_path)
-    raw.value["attrPath"] = attr_path
+def measure_cost(
+    evaluator: Evaluator,
+    flakeref: str,
+    info: NixEvalResultGetInfo,
+    samples: int,
+    fresh: bool = True,
+    probe_scopes: bool = False,
+) -> None:
+    """
+    Measures the cost of evaluating the attribute `info` is for, storing it in `info`, if it can be measured (see
+    `nix_eval_jobs.nix.eval.cost.measure`).
 
-    return NixEvalResultGetInfo.model_validate(raw, from_attributes=True)
+    Only attributes evaluated on their own, by an evaluator which reports stats, have stats which can be attributed to
+    them. The stats of `info` are taken as the first sample only if it is `fresh`, rather than possibly taken from the
+    cache by an earlier run. `probe_scopes` must be as it was for the evaluation `info` came from.
+    """
+    if not evaluator.capabilities.stats or info.stats is None or info.batch_size != 1:
+        return
+    info.cost = nix_eval_jobs.nix.eval.cost.measure(
+        evaluator,
+        flakeref,
+        info.value.attr_path,
+        _info_nix_func_expr(probe_scopes),
+        info.stats if fresh else None,
+        samples,
+    )
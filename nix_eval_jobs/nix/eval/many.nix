@@ -0,0 +1,21 @@
+# Maps a function over a chunk of children of a single parent so the parent (and everything leading up to it) is only
+# evaluated once for the whole chunk.
+# NOTE: Each child is evaluated under `tryEval` so a child which throws only fails its own entry (which becomes null)
+# instead of the whole chunk. Errors which `tryEval` cannot catch still fail the chunk, and the caller is expected to
+# fall back to evaluating children individually.
+let
+  inherit (builtins) deepSeq map tryEval;
+in
+f: names: parent:
+map (
+  name:
+  let
+    attempt = tryEval (
+      let
+        result = f parent.${name};
+      in
+      deepSeq result result
+    );
+  in
+  if attempt.success then attempt.value else null
+) names
@@ -1,63 +1,406 @@
+import asyncio
 import json
 import os
-from collections.abc import Iterable
+import resource
+import tempfile
+import time
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass, replace
 from logging import Logger
-from subprocess import run
-from tempfile import NamedTemporaryFile
-from typing import Any, Final
+from pathlib import Path
+from subprocess import PIPE, Popen, TimeoutExpired
+from typing import Any, Final, Self
 
 from pydantic.alias_generators import to_camel
 
+import nix_eval_jobs.nix.eval.failure
+import nix_eval_jobs.nix.eval.validation
+import nix_eval_jobs.tracing
 from nix_eval_jobs.extra_pydantic import PydanticObject
 from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.failure import EvalFailure
 from nix_eval_jobs.nix.eval.stats import NixEvalStats
-from nix_eval_jobs.nix.utilities import show_attr_path
+from nix_eval_jobs.nix.eval.validation import Validation
+from nix_eval_jobs.nix.utilities import show_attr_path, show_nix_string_list
 
 LOGGER: Final[Logger] = get_logger(__name__)
 
 
 class RawNixEvalResult(PydanticObject, alias_generator=to_camel):
-    stats: NixEvalStats
+    # None when the evaluator cannot attribute stats to a single evaluation.
+    stats: NixEvalStats | None
     stderr: str
     value: Any  # JSON object
+    # Set when the evaluation failed, in which case value is None.
+    failure: EvalFailure | None = None
 
 
-def eval(flakeref: str, attr_path: Iterable[str], apply_expr: str) -> RawNixEvalResult:
+_MANY_NIX_FUNC_EXPR: str = (Path(__file__).parent / "many.nix").read_text()
+
+
+def many_apply_expr(child_names: Sequence[str], apply_expr: str) -> str:
+    """
+    Returns an expression which, applied to a parent attribute set, applies `apply_expr` to each of the children named
+    by `child_names`.
+    """
+    return f"({_MANY_NIX_FUNC_EXPR}) ({apply_expr}) {show_nix_string_list(child_names)}"
+
+
+@dataclass(frozen=True, slots=True)
+class EvalLimits:
+    """
+    Bounds on each `nix eval`, and how failures which may be transient are retried (see
+    `nix_eval_jobs.nix.eval.failure`).
+    """
+
+    # Wall-clock seconds after which an evaluation is killed.
+    timeout: float | None = None
+    # Address space in bytes an evaluation may use, beyond which allocations fail. This is a bound on virtual memory,
+    # which is somewhat above the resident set size.
+    max_memory_bytes: int | None = None
+    # Number of times a failure which may be transient is retried, waiting `retry_backoff` seconds before the first
+    # retry and twice as long before each following one.
+    retries: int = 0
+    retry_backoff: float = 1.0
+
+
+@dataclass(frozen=True, slots=True)
+class _Attempt:
+    number: int = 1
+    # Evaluate without garbage collection for speed, unless a previous attempt ran out of memory.
+    gc_dont_gc: bool = True
+    retries: int = 0
+
+
+def _retry(
+    full_ref: str, result: RawNixEvalResult, attempt: _Attempt, limits: EvalLimits
+) -> tuple[_Attempt, float] | None:
+    """
+    Returns the attempt to make after `attempt` produced `result` and the seconds to wait before making it, or None if
+    it should not be retried.
+
+    An evaluation which ran out of memory (or was killed, by the coordinator for using too much memory or by the OOM
+    killer) is retried at once with garbage collection enabled without counting against the retries. Other failures
+    which may be transient are retried after waiting `retry_backoff` seconds, twice as long before each following retry.
+    """
+    if (failure := result.failure) is None:
+        return None
+    if failure.kind == "oom" and attempt.gc_dont_gc:
+        LOGGER.warning("Evaluation of %s ran out of memory, retrying with garbage collection enabled", full_ref)
+        return replace(attempt, number=attempt.number + 1, gc_dont_gc=False), 0.0
+    if failure.kind not in nix_eval_jobs.nix.eval.failure.RETRYABLE or attempt.retries >= limits.retries:
+        return None
+    delay = limits.retry_backoff * 2**attempt.retries
+    LOGGER.warning("Evaluation of %s failed (%s), retrying in %.1fs", full_ref, failure.kind, delay)
+    return replace(attempt, number=attempt.number + 1, retries=attempt.retries + 1), delay
+
+
+def parse_result(
+    stats_json: bytes,
+    stdout: bytes,
+    stderr: bytes,
+    returncode: int,
+    timeout: float | None = None,
+    attempts: int = 1,
+    validation: Validation = "strict",
+) -> RawNixEvalResult:
+    """
+    Builds the result of a `nix eval` from its stats (empty if there are none), output, and exit status. `timeout` is
+    given when it was killed for running longer than it, and `attempts` is the number of times it has been attempted.
+    """
+    # stats are populated unless nix was killed before it could write them
+    stats = NixEvalStats.model_validate_json(stats_json) if stats_json else None
+    stderr_str = stderr.decode()
+    failure = None
+    if returncode != 0 or timeout is not None:
+        failure = nix_eval_jobs.nix.eval.failure.classify(stderr_str, returncode, timeout, attempts)
+        LOGGER.error("Evaluation failed (%s): %s", failure.kind, failure.message)
+        value = None
+    else:
+        value = json.loads(stdout)
+    return nix_eval_jobs.nix.eval.validation.assemble(
+        RawNixEvalResult, validation, stats=stats, stderr=stderr_str, value=value, failure=failure
+    )
+
+
+def _eval_args(full_ref: str, apply_expr: str, nix_args: Sequence[str]) -> list[str]:
+    return [
+        "nix",
+        "eval",
+        # Configuration options
+        # "--no-allow-import-from-derivation",
+        "--no-allow-unsafe-native-code-during-evaluation",
+        "--no-eval-cache",
+        "--pure-eval",
+        "--read-only",
+        *nix_args,
+        # Output format
+        "--json",
+        # Evaluation target
+        full_ref,
+        # Evaluation expression
+        "--apply",
+        apply_expr,
+    ]
+
+
+# Anonymous memory files are only supported on Linux; elsewhere, nix writes to unlinked temporary files instead.
+_HAS_MEMFD: Final[bool] = hasattr(os, "memfd_create")
+
+
+class Capture:
+    """
+    The files a `nix eval` writes its stats and stderr to.
+
+    These are anonymous memory files (see memfd_create(2)) where supported, so capturing them involves no filesystem
+    operations, and only stdout is a pipe, which is read in a single pass without polling. nix only takes a path to
+    write stats to, so it is given the stats file as a path under /dev/fd. When stats are not shown, nix does not
+    measure them at all.
+    """
+
+    def __init__(self, show_stats: bool = True, memfd: bool = _HAS_MEMFD) -> None:
+        self.stats_fd: int | None = self._create("nix-stats", memfd) if show_stats else None
+        self.stderr_fd: int = self._create("nix-stderr", memfd)
+
+    @staticmethod
+    def _create(name: str, memfd: bool) -> int:
+        if memfd:
+            return os.memfd_create(name)
+        fd, path = tempfile.mkstemp(prefix=f"{name}-")
+        os.unlink(path)
+        return fd
+
+    @property
+    def pass_fds(self) -> tuple[int, ...]:
+        return (self.stats_fd,) if self.stats_fd is not None else ()
+
+    def env(self, gc_dont_gc: bool) -> dict[str, str]:
+        env = dict(os.environ)
+        if self.stats_fd is not None:
+            env |= {"NIX_SHOW_STATS": "1", "NIX_SHOW_STATS_PATH": f"/dev/fd/{self.stats_fd}"}
+        if gc_dont_gc:
+            env["GC_DONT_GC"] = "1"
+        return env
+
+    @staticmethod
+    def _read(fd: int) -> bytes:
+        return os.pread(fd, os.fstat(fd).st_size, 0)
+
+    def read(self) -> tuple[bytes, bytes]:
+        """
+        Returns the stats, which are empty if they are not shown or nix was killed before writing them, and stderr.
+        """
+        return self._read(self.stats_fd) if self.stats_fd is not None else b"", self._read(self.stderr_fd)
+
+    def close(self) -> None:
+        if self.stats_fd is not None:
+            os.close(self.stats_fd)
+        os.close(self.stderr_fd)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+
+def _limit_memory(pid: int, limits: EvalLimits) -> None:
+    # Set from outside rather than in the child before it executes nix, which is not safe in a process with threads
+    # (such as a worker sending heartbeats). nix has barely started by the time the limit applies.
+    if limits.max_memory_bytes is None:
+        return
+    try:
+        _ = resource.prlimit(pid, resource.RLIMIT_AS, (limits.max_memory_bytes, limits.max_memory_bytes))
+    except ProcessLookupError:
+        # nix already exited.
+        pass
+
+
+def _parse_captured(
+    capture: Capture, stdout: bytes, returncode: int, timeout: float | None, attempts: int, validation: Validation
+) -> RawNixEvalResult:
+    with nix_eval_jobs.tracing.span("parse"):
+        stats_json, stderr = capture.read()
+        return parse_result(stats_json, stdout, stderr, returncode, timeout, attempts, validation)
+
+
+def run_once(
+    args: Sequence[str],
+    capture: Capture,
+    gc_dont_gc: bool = True,
+    limits: EvalLimits = EvalLimits(),
+    attempts: int = 1,
+    validation: Validation = "strict",
+) -> RawNixEvalResult:
+    """
+    Runs a `nix eval` with `args` once, capturing its stats and stderr in `capture`.
+    """
+    with nix_eval_jobs.tracing.span("spawn"):
+        proc = Popen(
+            args=args, stdout=PIPE, stderr=capture.stderr_fd, pass_fds=capture.pass_fds, env=capture.env(gc_dont_gc)
+        )
+    with proc, nix_eval_jobs.tracing.span("nix"):
+        _limit_memory(proc.pid, limits)
+        timeout = None
+        try:
+            # Without a timeout, stdout is simply read until nix closes it.
+            stdout, _ = proc.communicate(timeout=limits.timeout)
+        except TimeoutExpired:
+            proc.kill()
+            stdout, _ = proc.communicate()
+            timeout = limits.timeout
+    return _parse_captured(capture, stdout, proc.returncode, timeout, attempts, validation)
+
+
+async def run_once_async(
+    args: Sequence[str],
+    capture: Capture,
+    gc_dont_gc: bool = True,
+    limits: EvalLimits = EvalLimits(),
+    attempts: int = 1,
+    validation: Validation = "strict",
+) -> RawNixEvalResult:
+    """
+    Like `run_once`, but without blocking the event loop while nix runs.
+    """
+    with nix_eval_jobs.tracing.span("spawn"):
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=PIPE, stderr=capture.stderr_fd, pass_fds=capture.pass_fds, env=capture.env(gc_dont_gc)
+        )
+    with nix_eval_jobs.tracing.span("nix"):
+        _limit_memory(proc.pid, limits)
+        timeout = None
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), limits.timeout)
+        except TimeoutError:
+            # What nix printed to stdout before it was killed is lost along with the cancelled communicate.
+            proc.kill()
+            _ = await proc.wait()
+            stdout = b""
+            timeout = limits.timeout
+        except asyncio.CancelledError:
+            # Cancelling the task does not stop nix, so kill it rather than leave it running.
+            proc.kill()
+            _ = await proc.wait()
+            raise
+    assert proc.returncode is not None
+    return _parse_captured(capture, stdout, proc.returncode, timeout, attempts, validation)
+
+
+def _run(
+    full_ref: str,
+    apply_expr: str,
+    nix_args: Sequence[str],
+    limits: EvalLimits,
+    show_stats: bool,
+    validation: Validation,
+) -> RawNixEvalResult:
+    args = _eval_args(full_ref, apply_expr, nix_args)
+    attempt = _Attempt()
+    while True:
+        with Capture(show_stats) as capture:
+            result = run_once(args, capture, attempt.gc_dont_gc, limits, attempt.number, validation)
+        if (retry := _retry(full_ref, result, attempt, limits)) is None:
+            return result
+        attempt, delay = retry
+        time.sleep(delay)
+
+
+async def _run_async(
+    full_ref: str,
+    apply_expr: str,
+    nix_args: Sequence[str],
+    limits: EvalLimits,
+    show_stats: bool,
+    validation: Validation,
+) -> RawNixEvalResult:
+    args = _eval_args(full_ref, apply_expr, nix_args)
+    attempt = _Attempt()
+    while True:
+        with Capture(show_stats) as capture:
+            result = await run_once_async(args, capture, attempt.gc_dont_gc, limits, attempt.number, validation)
+        if (retry := _retry(full_ref, result, attempt, limits)) is None:
+            return result
+        attempt, delay = retry
+        await asyncio.sleep(delay)
+
+
+def _target(
+    flakeref: str, attr_path: Iterable[str], apply_expr: str, child_names: Sequence[str] | None = None
+) -> tuple[str, str]:
+    """
+    Returns the flake output to evaluate and the expression to apply to it, to evaluate `apply_expr` applied to the
+    value at `attr_path`, or, if `child_names` is given, to each of the named children of it.
+    """
     # TODO: Escaping of flakeref and attr_path is correct?
     full_ref: str = f"{flakeref}#{show_attr_path(attr_path)}"
-    LOGGER.info("Evaluating %s", full_ref)
-
-    kwargs = {}
-    with NamedTemporaryFile() as stats_file:
-        proc = run(
-            args=[
-                "nix",
-                "eval",
-                # Configuration options
-                # "--no-allow-import-from-derivation",
-                "--no-allow-unsafe-native-code-during-evaluation",
-                "--no-eval-cache",
-                "--pure-eval",
-                "--read-only",
-                # Output format
-                "--json",
-                # Evaluation target
-                full_ref,
-                # Evaluation expression
-                "--apply",
-                apply_expr,
-            ],
-            capture_output=True,
-            check=False,
-            env=os.environ | {"NIX_SHOW_STATS": "1", "NIX_SHOW_STATS_PATH": stats_file.name, "GC_DONT_GC": "1"},
-        )
-        # stats are always populated
-        kwargs["stats"] = NixEvalStats.model_validate_json(stats_file.read())
-        kwargs["stderr"] = proc.stderr.decode()
-        if proc.returncode != 0:
-            LOGGER.error("Evaluation failed: %s", kwargs["stderr"])
-            kwargs["value"] = None
-        else:
-            kwargs["value"] = json.loads(proc.stdout)
-
-    return RawNixEvalResult.model_validate(kwargs)
+    if child_names is None:
+        LOGGER.info("Evaluating %s", full_ref)
+        return full_ref, apply_expr
+    LOGGER.info("Evaluating %d children of %s", len(child_names), full_ref)
+    return full_ref, many_apply_expr(child_names, apply_expr)
+
+
+def eval(
+    flakeref: str,
+    attr_path: Iterable[str],
+    apply_expr: str,
+    nix_args: Sequence[str] = (),
+    limits: EvalLimits = EvalLimits(),
+    show_stats: bool = True,
+    validation: Validation = "strict",
+) -> RawNixEvalResult:
+    return _run(*_target(flakeref, attr_path, apply_expr), nix_args, limits, show_stats, validation)
+
+
+def eval_many(
+    flakeref: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+    apply_expr: str,
+    nix_args: Sequence[str] = (),
+    limits: EvalLimits = EvalLimits(),
+    show_stats: bool = True,
+    validation: Validation = "strict",
+) -> RawNixEvalResult:
+    """
+    Evaluates `apply_expr` applied to each of the children of `parent_attr_path` named by `child_names` in a single
+    `nix eval`.
+
+    On success, the value is a list with one entry per child, in order, which is null if evaluating that child threw.
+    The stats and stderr are those of the whole batch.
+    """
+    return _run(*_target(flakeref, parent_attr_path, apply_expr, child_names), nix_args, limits, show_stats, validation)
+
+
+async def eval_async(
+    flakeref: str,
+    attr_path: Iterable[str],
+    apply_expr: str,
+    nix_args: Sequence[str] = (),
+    limits: EvalLimits = EvalLimits(),
+    show_stats: bool = True,
+    validation: Validation = "strict",
+) -> RawNixEvalResult:
+    """
+    Like `eval`, but without blocking the event loop while nix runs.
+    """
+    return await _run_async(*_target(flakeref, attr_path, apply_expr), nix_args, limits, show_stats, validation)
+
+
+async def eval_many_async(
+    flakeref: str,
+    parent_attr_path: Sequence[str],
+    child_names: Sequence[str],
+    apply_expr: str,
+    nix_args: Sequence[str] = (),
+    limits: EvalLimits = EvalLimits(),
+    show_stats: bool = True,
+    validation: Validation = "strict",
+) -> RawNixEvalResult:
+    """
+    Like `eval_many`, but without blocking the event loop while nix runs.
+    """
+    return await _run_async(
+        *_target(flakeref, parent_attr_path, apply_expr, child_names), nix_args, limits, show_stats, validation
+    )
@@ -0,0 +1,208 @@
+"""
+Sessions of `nix repl` which stay alive and have requests streamed to them, for the persistent evaluator backend (see
+`nix_eval_jobs.nix.eval.evaluator.ReplEvaluator`).
+
+Unlike `nix_eval_jobs.nix.eval.raw`, the flake (and everything already forced while evaluating earlier requests) is only
+evaluated once per session, at the cost of not having per-request stats: `NIX_SHOW_STATS` is only reported when the
+process exits, so results from this backend have no stats.
+"""
+
+import json
+import os
+from collections.abc import Sequence
+from logging import Logger
+from pathlib import Path
+from queue import SimpleQueue
+from subprocess import PIPE, Popen, TimeoutExpired, run
+from threading import Thread
+from typing import IO, Any, Final
+
+import nix_eval_jobs.memory
+import nix_eval_jobs.nix.eval.failure
+import nix_eval_jobs.nix.eval.validation
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.raw import RawNixEvalResult
+from nix_eval_jobs.nix.eval.validation import Validation
+from nix_eval_jobs.nix.utilities import escape_nix_string, show_nix_string_list
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+_MANY_NIX_FUNC_EXPR: str = (Path(__file__).parent / "many.nix").read_text()
+_RESOLVE_NIX_FUNC_EXPR: str = (Path(__file__).parent / "resolve.nix").read_text()
+
+_PROMPT: str = "nix-repl> "
+
+
+def _strip_prompts(line: str) -> str:
+    # When stdin is not a terminal, the prompt is still printed (without a trailing newline), so it prefixes output.
+    line = line.strip()
+    while line.startswith(_PROMPT.strip()):
+        line = line.removeprefix(_PROMPT.strip()).lstrip()
+    return line
+
+
+def _to_repl_line(expr: str) -> str:
+    # The REPL reads a line at a time, so expressions must fit on one. Comments would swallow the rest of the line, so
+    # drop them.
+    # NOTE: This only handles comments occupying whole lines, which is all our expressions use.
+    return " ".join(line.strip() for line in expr.splitlines() if not line.lstrip().startswith("#"))
+
+
+def _parse_repl_value(line: str) -> Any:
+    # Depending on the version of Nix, :p prints strings either verbatim or as escaped Nix string literals.
+    if not (line.startswith('"') and line.endswith('"')):
+        return json.loads(line)
+
+    chars: list[str] = []
+    escaped = False
+    for char in line[1:-1]:
+        if escaped:
+            chars.append({"n": "\n", "r": "\r", "t": "\t"}.get(char, char))
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        else:
+            chars.append(char)
+    return json.loads("".join(chars))
+
+
+class NixReplError(Exception):
+    pass
+
+
+class NixReplSession:
+    """
+    A `nix repl` with a flake loaded into scope.
+
+    Requests are written to stdin one line at a time, each followed by a sentinel which is printed to stdout (as a
+    value) and to stderr (as a trace), which tells us where the output of a request ends on both streams.
+    """
+
+    def __init__(self, flakeref: str, nix_args: Sequence[str] = (), validation: Validation = "strict") -> None:
+        self.flakeref: str = flakeref
+        self._validation: Validation = validation
+        self.num_requests: int = 0
+        self._num_sentinels: int = 0
+        self._bound_exprs: dict[str, str] = {}
+        self._stderr_lines: SimpleQueue[str | None] = SimpleQueue()
+
+        system = run(
+            args=["nix", "eval", "--impure", "--raw", "--expr", "builtins.currentSystem"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+
+        LOGGER.info("Starting nix repl for %s", flakeref)
+        self._proc: Popen[str] = Popen(
+            args=[
+                "nix",
+                "repl",
+                # Configuration options
+                # "--no-allow-import-from-derivation",
+                "--no-allow-unsafe-native-code-during-evaluation",
+                "--no-eval-cache",
+                "--pure-eval",
+                "--read-only",
+                *nix_args,
+            ],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE,
+            text=True,
+            bufsize=1,
+            # NOTE: Unlike the one-shot backend, we cannot set GC_DONT_GC because the process is long-lived.
+            env=os.environ | {"NO_COLOR": "1", "TERM": "dumb"},
+        )
+        assert self._proc.stderr is not None
+        Thread(target=self._read_stderr, args=(self._proc.stderr,), daemon=True).start()
+
+        # Discard the banner and the output of loading the flake.
+        _ = self._request(f":lf {self.flakeref}")
+        _ = self._request(f"__nejSystem = {escape_nix_string(system)}")
+
+    def _read_stderr(self, stderr: IO[str]) -> None:
+        for line in stderr:
+            self._stderr_lines.put(line)
+        self._stderr_lines.put(None)
+
+    def _request(self, line: str) -> tuple[list[str], str]:
+        """
+        Sends a line to the REPL, returning the lines it printed to stdout and everything it printed to stderr.
+        """
+        assert self._proc.stdin is not None
+        assert self._proc.stdout is not None
+
+        self._num_sentinels += 1
+        sentinel = f"__nej_sentinel_{self._num_sentinels}"
+        try:
+            self._proc.stdin.write(
+                f"{line}\n:p builtins.trace {escape_nix_string(sentinel)} {escape_nix_string(sentinel)}\n"
+            )
+            self._proc.stdin.flush()
+        except OSError as e:
+            raise NixReplError(f"nix repl for {self.flakeref} is not accepting input") from e
+
+        stdout_lines: list[str] = []
+        while (stdout_line := self._proc.stdout.readline()) and _strip_prompts(stdout_line).strip('"') != sentinel:
+            if value_line := _strip_prompts(stdout_line):
+                stdout_lines.append(value_line)
+        if not stdout_line:
+            raise NixReplError(f"nix repl for {self.flakeref} exited unexpectedly")
+
+        stderr_lines: list[str] = []
+        while (stderr_line := self._stderr_lines.get()) is not None and not stderr_line.strip().endswith(sentinel):
+            stderr_lines.append(stderr_line)
+
+        return stdout_lines, "".join(stderr_lines)
+
+    def _bind(self, expr: str) -> str:
+        """
+        Binds an expression to a variable in the REPL, returning the name of the variable, so it is only parsed and
+        evaluated once per session.
+        """
+        if (name := self._bound_exprs.get(expr)) is None:
+            name = f"__nejExpr{len(self._bound_exprs)}"
+            _ = self._request(f"{name} = {_to_repl_line(expr)}")
+            self._bound_exprs[expr] = name
+        return name
+
+    def eval(
+        self,
+        attr_path: Sequence[str],
+        apply_expr: str,
+        child_names: Sequence[str] | None = None,
+    ) -> RawNixEvalResult:
+        """
+        Evaluates `apply_expr` applied to the value at `attr_path`, or, if `child_names` is given, to each of the named
+        children of the value at `attr_path` (see `nix_eval_jobs.nix.eval.raw.eval_many`).
+        """
+        self.num_requests += 1
+        func = self._bind(apply_expr)
+        if child_names is not None:
+            func = f"{self._bind(_MANY_NIX_FUNC_EXPR)} {func} {show_nix_string_list(child_names)}"
+        target = f"{self._bind(_RESOLVE_NIX_FUNC_EXPR)} outputs __nejSystem {show_nix_string_list(attr_path)}"
+        stdout_lines, stderr = self._request(f":p builtins.toJSON (({func}) ({target}))")
+        failure = None
+        if not stdout_lines:
+            failure = nix_eval_jobs.nix.eval.failure.classify(stderr, None)
+            LOGGER.error("Evaluation failed (%s): %s", failure.kind, failure.message)
+            value = None
+        else:
+            value = _parse_repl_value(stdout_lines[-1])
+        return nix_eval_jobs.nix.eval.validation.assemble(
+            RawNixEvalResult, self._validation, stats=None, stderr=stderr, value=value, failure=failure
+        )
+
+    def rss_bytes(self) -> int | None:
+        return nix_eval_jobs.memory.rss_bytes(self._proc.pid)
+
+    def close(self) -> None:
+        LOGGER.info("Stopping nix repl for %s", self.flakeref)
+        if self._proc.stdin is not None:
+            self._proc.stdin.close()
+        try:
+            _ = self._proc.wait(timeout=5.0)
+        except TimeoutExpired:
+            self._proc.kill()
+            _ = self._proc.wait()
@@ -0,0 +1,34 @@
+# Resolves an attribute path against the outputs of a flake the same way `nix eval flakeref#attrPath` does, by trying
+# the default prefixes in order and using the first one under which the attribute path exists.
+let
+  inherit (builtins) concatStringsSep head isAttrs tail;
+
+  hasAttrByPath =
+    attrPath: set:
+    attrPath == [ ] || (isAttrs set && set ? ${head attrPath} && hasAttrByPath (tail attrPath) set.${head attrPath});
+
+  getAttrFromPath = attrPath: set: builtins.foldl' (acc: name: acc.${name}) set attrPath;
+in
+outputs: system: attrPath:
+let
+  # NOTE: Candidates are checked lazily, in order, so later candidates are not evaluated if an earlier one exists.
+  firstExisting =
+    candidates:
+    if candidates == [ ] then
+      throw "flake does not provide attribute '${concatStringsSep "." attrPath}'"
+    else if hasAttrByPath (head candidates) outputs then
+      head candidates
+    else
+      firstExisting (tail candidates);
+in
+getAttrFromPath (firstExisting [
+  ([
+    "packages"
+    system
+  ] ++ attrPath)
+  ([
+    "legacyPackages"
+    system
+  ] ++ attrPath)
+  attrPath
+]) outputs
@@ -0,0 +1,28 @@
+"""
+How thoroughly evaluation results are validated as they are turned into models.
+
+Strict validation (the default) validates every model as it is built, including models nested within it, which were
+already validated when they were built themselves (see `revalidate_instances` in `ModelConfig`). Fast validation
+validates what comes from Nix once and assembles the results from already validated parts without validating them
+again, which saves a noticeable amount of CPU per result.
+"""
+
+from typing import Any, Literal, TypeVar
+
+from pydantic import BaseModel
+
+Validation = Literal["strict", "fast"]
+
+M = TypeVar("M", bound=BaseModel)
+
+
+def assemble(model: type[M], validation: Validation, **fields: Any) -> M:
+    """
+    Builds `model` from `fields`, given by field name, whose values are either validated models or plain values which
+    need no validation.
+
+    With fast validation the fields are used as is, so callers must not pass anything which has not been validated.
+    """
+    if validation == "fast":
+        return model.model_construct(**fields)
+    return model.model_validate(fields)
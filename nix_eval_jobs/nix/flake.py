@@ -0,0 +1,67 @@
+import json
+from collections.abc import Mapping
+from logging import Logger
+from subprocess import run
+from typing import Any, Final
+
+from pydantic.alias_generators import to_camel
+
+from nix_eval_jobs.extra_pydantic import ModelConfigAllowExtra, PydanticObject
+from nix_eval_jobs.logger import get_logger
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+class NixFlakeMetadata(PydanticObject, alias_generator=to_camel):
+    """
+    The subset of the output of `nix flake metadata --json` we use.
+    """
+
+    model_config = ModelConfigAllowExtra
+
+    original_url: str
+    # Newer versions of Nix call the locked URL `url`, older versions call it `lockedUrl`.
+    url: str | None = None
+    locked_url: str | None = None
+    path: str
+    revision: str | None = None
+    last_modified: int | None = None
+    locked: Mapping[str, Any]
+
+
+class LockedFlake(PydanticObject, alias_generator=to_camel):
+    flakeref: str
+    locked_flakeref: str
+    store_path: str
+    revision: str | None
+    nar_hash: str | None
+    last_modified: int | None
+
+
+def lock(flakeref: str) -> LockedFlake:
+    """
+    Resolves and locks a flake reference, fetching it into the store if necessary.
+
+    The locked reference refers to exactly one revision (and NAR hash) of the flake, so evaluating against it requires
+    neither resolving it again nor fetching it from the network, and every evaluation sees the same revision.
+    """
+    LOGGER.info("Locking %s", flakeref)
+    proc = run(
+        args=["nix", "flake", "metadata", "--json", "--no-write-lock-file", flakeref],
+        capture_output=True,
+        check=True,
+    )
+    metadata = NixFlakeMetadata.model_validate(json.loads(proc.stdout))
+    locked_flakeref = metadata.url or metadata.locked_url
+    if locked_flakeref is None:
+        raise ValueError(f"nix flake metadata did not return a locked reference for {flakeref}")
+
+    LOGGER.info("Locked %s to %s", flakeref, locked_flakeref)
+    return LockedFlake.model_validate({
+        "flakeref": flakeref,
+        "locked_flakeref": locked_flakeref,
+        "store_path": metadata.path,
+        "revision": metadata.revision,
+        "nar_hash": metadata.locked.get("narHash"),
+        "last_modified": metadata.last_modified,
+    })
@@ -23,6 +23,10 @@ def escape_nix_identifier(s: str) -> str:
         return escape_nix_string(s)
 
 
+def show_nix_string_list(strs: Iterable[str]) -> str:
+    return "[ " + " ".join(map(escape_nix_string, strs)) + " ]"
+
+
 def show_attr_path(attr_path: Iterable[str]) -> str:
     # https://github.com/NixOS/nixpkgs/blob/8f0377b2b83c3ff5d1670f2dff5e6388cc4deb84/lib/attrsets.nix#L1726-L1761
     if attr_path:
@@ -0,0 +1,320 @@
+import gzip
+import io
+import os
+import sys
+from collections.abc import Callable, Sequence
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass
+from logging import Logger
+from pathlib import Path
+from queue import SimpleQueue
+from threading import Thread
+from time import monotonic
+from typing import BinaryIO, Final, Literal, cast
+
+from pydantic.alias_generators import to_camel
+
+from nix_eval_jobs.extra_pydantic import PydanticObject
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.failure import FailureKind
+from nix_eval_jobs.nix.flake import LockedFlake
+from nix_eval_jobs.tracing import Recorder
+
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is optional.
+    zstandard = None
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+Compression = Literal["none", "gzip", "zstd"]
+
+# Size of the buffer between the writer thread and the file, so writes reach the kernel in large chunks.
+_BUFFER_SIZE: Final[int] = 2**20
+
+
+class OutputHeader(PydanticObject, alias_generator=to_camel):
+    """
+    The first line of the output, describing what was evaluated. Every following line is a result.
+    """
+
+    class OutputHeaderInfo(PydanticObject, alias_generator=to_camel):
+        flake: LockedFlake
+        attr_path: Sequence[str]
+
+    header: OutputHeaderInfo
+
+
+# Attributes which are still evaluated but no longer included, such as derivations now marked broken, are
+# "not-included"; those which are no longer there, or are no longer evaluated, are "removed".
+DiffStatus = Literal["added", "changed", "removed", "not-included"]
+
+
+class DiffRecord(PydanticObject, alias_generator=to_camel):
+    """
+    A line of the diff produced by an incremental run, describing an attribute whose derivation changed.
+    """
+
+    attr: str
+    status: DiffStatus
+    drv_path: str | None
+    previous_drv_path: str | None
+
+
+class FailureRecord(PydanticObject, alias_generator=to_camel):
+    """
+    A line of the failures written by `--failures`, describing an attribute whose evaluation failed (see
+    `nix_eval_jobs.nix.eval.failure`).
+    """
+
+    attr: str
+    attr_path: Sequence[str]
+    kind: FailureKind
+    message: str
+    attempts: int
+    # Everything nix printed to stderr, which is shared by every attribute of a batch.
+    stderr: str
+
+
+class FinishPrediction(PydanticObject, alias_generator=to_camel):
+    """
+    The time a run was predicted to take in total, predicted `elapsed` seconds into it.
+    """
+
+    elapsed: float
+    predicted_elapsed: float
+
+
+class RunStats(PydanticObject, alias_generator=to_camel):
+    """
+    Measurements of a run as a whole, written by `--run-stats` for benchmarking.
+
+    Times are in seconds and sizes in bytes. The coordinator is this process, which also runs the output writer;
+    children are the workers and every nix they ran.
+    """
+
+    elapsed: float
+    num_discovered: int
+    num_excluded: int
+    num_evaluated: int
+    num_deduplicated: int
+    num_failed: int
+    attrs_per_second: float
+    num_tasks: int
+    queue_latency_mean: float
+    queue_latency_max: float
+    task_latency_mean: float
+    task_latency_max: float
+    coordinator_cpu_time: float
+    coordinator_max_rss: int
+    children_cpu_time: float
+    children_max_rss: int
+    # The scheduling policy, and its predictions of the time the run would take, to compare with elapsed.
+    schedule_policy: str
+    finish_predictions: Sequence[FinishPrediction]
+
+
+def infer_compression(path: Path | None) -> Compression:
+    if path is not None and path.suffix == ".gz":
+        return "gzip"
+    if path is not None and path.suffix == ".zst":
+        return "zstd"
+    return "none"
+
+
+def _zstd_unavailable() -> ImportError:
+    return ImportError("zstd compression requires the zstandard package (install nix_eval_jobs[zstd])")
+
+
+def open_for_reading(path: Path) -> BinaryIO:
+    """
+    Opens an output for reading, decompressing it according to its suffix.
+    """
+    match infer_compression(path):
+        case "none":
+            return path.open("rb")
+        case "gzip":
+            return cast(BinaryIO, gzip.open(path, "rb"))
+        case "zstd":
+            if zstandard is None:
+                raise _zstd_unavailable()
+            # The decompression reader does not support reading lines, so buffer it.
+            # Outputs written across checkpoints consist of several frames.
+            reader = zstandard.ZstdDecompressor().stream_reader(path.open("rb"), read_across_frames=True, closefd=True)
+            return cast(BinaryIO, io.BufferedReader(cast(io.RawIOBase, reader), buffer_size=_BUFFER_SIZE))
+
+
+@dataclass(frozen=True, slots=True)
+class _Checkpoint:
+    on_synced: Callable[[int], None]
+
+
+class OutputWriter:
+    """
+    Writes batches of lines to an output (or stdout) from a dedicated thread, so writing, compressing, and syncing the
+    output never holds up the coordinator.
+    """
+
+    def __init__(
+        self,
+        path: Path | None,
+        compression: Compression = "none",
+        fsync_interval: float | None = None,
+        append_offset: int | None = None,
+        recorder: Recorder | None = None,
+    ) -> None:
+        """
+        When `fsync_interval` is set, the output is flushed through to disk at most that many seconds apart, so a crash
+        loses at most that much output.
+
+        When `append_offset` is set, the output is truncated to that offset (as reported at a checkpoint) and appended
+        to, rather than overwritten.
+
+        When a recorder is given, the time taken writing and syncing is added to it (see `nix_eval_jobs.tracing`).
+        """
+        self.path: Path | None = path
+        self._recorder: Recorder | None = recorder
+        self._compression: Compression = compression
+        self._fsync_interval: float | None = fsync_interval
+        self._items: SimpleQueue[Sequence[str] | _Checkpoint | None] = SimpleQueue()
+        self._error: BaseException | None = None
+
+        if path is None:
+            self._raw: BinaryIO = sys.stdout.buffer
+        elif append_offset is None:
+            self._raw = path.open("wb", buffering=_BUFFER_SIZE)
+        else:
+            self._raw = path.open("r+b", buffering=_BUFFER_SIZE)
+            _ = self._raw.truncate(append_offset)
+            _ = self._raw.seek(append_offset)
+        self._stream: BinaryIO = self._compress(self._raw, compression)
+        self._thread: Thread = Thread(target=self._run, name="output-writer", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _compress(raw: BinaryIO, compression: Compression) -> BinaryIO:
+        match compression:
+            case "none":
+                return raw
+            case "gzip":
+                # A low compression level keeps compression from becoming the bottleneck.
+                return cast(BinaryIO, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=3))
+            case "zstd":
+                if zstandard is None:
+                    raise _zstd_unavailable()
+                return zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of batches of lines and checkpoints queued but not yet written.
+        """
+        return self._items.qsize()
+
+    def _span(self, name: str) -> AbstractContextManager[None]:
+        return nullcontext() if self._recorder is None else self._recorder.span("output-writer", name)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def write(self, lines: Sequence[str]) -> None:
+        """
+        Queues lines to be written. Raises if the writer thread failed.
+        """
+        self._raise_error()
+        if lines:
+            self._items.put(lines)
+
+    def checkpoint(self, on_synced: Callable[[int], None]) -> None:
+        """
+        Queues a checkpoint: once every line queued before it is on disk, `on_synced` is called from the writer thread
+        with the offset in the output after those lines.
+
+        Compressed outputs end their current gzip member or zstd frame at a checkpoint, so the output can be truncated
+        to the offset and appended to.
+        """
+        self._raise_error()
+        self._items.put(_Checkpoint(on_synced))
+
+    def _sync_raw(self) -> None:
+        self._raw.flush()
+        if self.path is not None:
+            os.fsync(self._raw.fileno())
+
+    def _sync(self) -> None:
+        if self._stream is not self._raw:
+            self._stream.flush()
+        self._sync_raw()
+
+    def _end_frame(self) -> int:
+        """
+        Ends the current gzip member or zstd frame and syncs the output, returning the offset after it.
+        """
+        if self._stream is self._raw:
+            self._sync_raw()
+            return self._raw.tell()
+
+        # Closing the compressed stream finishes the member or frame without closing the underlying file. The offset
+        # must be taken before the next one is started, since starting it may write its header.
+        self._stream.close()
+        self._sync_raw()
+        offset = self._raw.tell()
+        self._stream = self._compress(self._raw, self._compression)
+        return offset
+
+    def _drain(self) -> None:
+        last_sync = monotonic()
+        done = False
+        while not done:
+            # Gather every batch already waiting so they are written together.
+            items = [self._items.get()]
+            while not self._items.empty():
+                items.append(self._items.get())
+
+            lines: list[str] = []
+            for item in items:
+                match item:
+                    case None:
+                        done = True
+                    case _Checkpoint(on_synced=on_synced):
+                        self._write(lines)
+                        lines.clear()
+                        with self._span("checkpoint"):
+                            offset = self._end_frame()
+                        last_sync = monotonic()
+                        on_synced(offset)
+                    case _:
+                        lines.extend(item)
+            self._write(lines)
+
+            if self._fsync_interval is not None and monotonic() - last_sync >= self._fsync_interval:
+                with self._span("sync"):
+                    self._sync()
+                last_sync = monotonic()
+
+    def _write(self, lines: Sequence[str]) -> None:
+        if lines:
+            with self._span("write"):
+                _ = self._stream.write("".join(f"{line}\n" for line in lines).encode())
+
+    def _run(self) -> None:
+        try:
+            self._drain()
+        except BaseException as e:
+            LOGGER.error("Failed to write output: %s", e)
+            self._error = e
+
+    def close(self) -> None:
+        """
+        Writes everything queued, then flushes and closes the output.
+        """
+        self._items.put(None)
+        self._thread.join()
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._sync_raw()
+        if self.path is not None:
+            self._raw.close()
+        self._raise_error()
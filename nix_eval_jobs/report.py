@@ -0,0 +1,181 @@
+"""
+Aggregation of the evaluation stats of a run into a profile of where evaluation time and memory go.
+
+When the cost of an attribute was measured against a baseline (see `--baseline`), the mean difference from the baseline
+is used. Otherwise, stats of a batch (see `--batch-size`) are shared equally between the attributes evaluated in it.
+Results without stats (such as those from the repl backend) are skipped.
+"""
+
+import json
+from collections.abc import Iterable, Mapping, Sequence
+from dataclasses import dataclass
+from heapq import nlargest
+from pathlib import Path
+from typing import Any, Final, TextIO
+
+from pydantic.alias_generators import to_camel
+from rich.console import Console
+from rich.table import Table
+
+from nix_eval_jobs.extra_pydantic import PydanticObject
+from nix_eval_jobs.nix.utilities import show_attr_path
+from nix_eval_jobs.output import OutputHeader, open_for_reading
+
+# The metrics reported, mapped to the path of keys leading to them in the stats.
+METRICS: Final[Mapping[str, Sequence[str]]] = {
+    "cpuTime": ["cpuTime"],
+    "nrThunks": ["nrThunks"],
+    "gc.heapSize": ["gc", "heapSize"],
+    "values.bytes": ["values", "bytes"],
+}
+
+PERCENTILES: Final[Sequence[int]] = [50, 90, 99]
+
+
+@dataclass(frozen=True, slots=True)
+class AttrCost:
+    attr_path: Sequence[str]
+    costs: Mapping[str, float]
+
+
+class ProfileEntry(PydanticObject, alias_generator=to_camel):
+    attr: str
+    value: float
+
+
+class MetricProfile(PydanticObject, alias_generator=to_camel):
+    total: float
+    max: float
+    # Keyed by the percentile, as in "p90".
+    percentiles: Mapping[str, float]
+    top_attrs: Sequence[ProfileEntry]
+    # Attribute sets (other than the root) ranked by the sum of the costs of the attributes within them.
+    top_subtrees: Sequence[ProfileEntry]
+
+
+class ProfileReport(PydanticObject, alias_generator=to_camel):
+    num_records: int
+    num_with_stats: int
+    metrics: Mapping[str, MetricProfile]
+
+
+def _metric(stats: Mapping[str, Any], keys: Sequence[str]) -> float:
+    value: Any = stats
+    for key in keys:
+        value = value[key]
+    return float(value)
+
+
+def load_costs(path: Path) -> tuple[OutputHeader, int, list[AttrCost]]:
+    """
+    Reads the output of a run, returning its header, the number of records, and the cost of each attribute with stats.
+    """
+    num_records = 0
+    costs: list[AttrCost] = []
+    with open_for_reading(path) as output:
+        header = OutputHeader.model_validate_json(output.readline())
+        for line in output:
+            num_records += 1
+            record: dict[str, Any] = json.loads(line)
+            if (cost := record.get("cost")) is not None:
+                metrics = {name: cost["delta"][name]["mean"] for name in METRICS}
+            elif (stats := record["stats"]) is not None:
+                batch_size: int = record.get("batchSize", 1)
+                metrics = {name: _metric(stats, keys) / batch_size for name, keys in METRICS.items()}
+            else:
+                continue
+            costs.append(AttrCost(attr_path=record["value"]["attrPath"], costs=metrics))
+    return header, num_records, costs
+
+
+def _percentile(sorted_values: Sequence[float], percentile: int) -> float:
+    # Nearest-rank percentile.
+    rank = max(1, -(-percentile * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def _subtree_totals(costs: Iterable[AttrCost], metric: str, root_depth: int) -> dict[str, float]:
+    totals: dict[str, float] = {}
+    for cost in costs:
+        # Every proper prefix of the attribute path below the root is a subtree containing the attribute.
+        for depth in range(root_depth + 1, len(cost.attr_path)):
+            subtree = show_attr_path(cost.attr_path[:depth])
+            totals[subtree] = totals.get(subtree, 0.0) + cost.costs[metric]
+    return totals
+
+
+def build_report(
+    root_attr_path: Sequence[str], num_records: int, costs: Sequence[AttrCost], top: int = 20
+) -> ProfileReport:
+    root_depth = len(root_attr_path)
+    metrics: dict[str, MetricProfile] = {}
+    for metric in METRICS:
+        values = sorted(cost.costs[metric] for cost in costs)
+        subtree_totals = _subtree_totals(costs, metric, root_depth)
+        metrics[metric] = MetricProfile(
+            total=sum(values),
+            max=values[-1] if values else 0.0,
+            percentiles={
+                f"p{percentile}": _percentile(values, percentile) if values else 0.0 for percentile in PERCENTILES
+            },
+            top_attrs=[
+                ProfileEntry(attr=show_attr_path(cost.attr_path), value=cost.costs[metric])
+                for cost in nlargest(top, costs, key=lambda cost: cost.costs[metric])
+            ],
+            top_subtrees=[
+                ProfileEntry(attr=subtree, value=subtree_totals[subtree])
+                for subtree in nlargest(top, subtree_totals, key=subtree_totals.__getitem__)
+            ],
+        )
+    return ProfileReport(num_records=num_records, num_with_stats=len(costs), metrics=metrics)
+
+
+def write_folded(costs: Iterable[AttrCost], metric: str, folded_file: TextIO) -> None:
+    """
+    Writes the costs in the folded stacks format read by flame graph tools, with one stack per attribute path.
+
+    Flame graphs need integer weights, so CPU time is written in microseconds.
+    """
+    scale = 1e6 if metric == "cpuTime" else 1.0
+    for cost in costs:
+        # Semicolons separate frames, so they cannot appear within one.
+        stack = ";".join(name.replace(";", ":") for name in cost.attr_path)
+        print(f"{stack} {round(cost.costs[metric] * scale)}", file=folded_file)
+
+
+def _show(metric: str, value: float) -> str:
+    if metric == "cpuTime":
+        return f"{value:.3f}s"
+    if metric.endswith(("bytes", "Size")):
+        return f"{value / 2**20:.1f} MiB"
+    return f"{value:,.0f}"
+
+
+def print_report(report: ProfileReport, console: Console) -> None:
+    summary = Table(title=f"Evaluation profile ({report.num_with_stats} of {report.num_records} records with stats)")
+    summary.add_column("Metric")
+    summary.add_column("Total", justify="right")
+    for percentile in PERCENTILES:
+        summary.add_column(f"p{percentile}", justify="right")
+    summary.add_column("Max", justify="right")
+    for metric, profile in report.metrics.items():
+        summary.add_row(
+            metric,
+            _show(metric, profile.total),
+            *(_show(metric, profile.percentiles[f"p{percentile}"]) for percentile in PERCENTILES),
+            _show(metric, profile.max),
+        )
+    console.print(summary)
+
+    for metric, profile in report.metrics.items():
+        for title, entries in (("attributes", profile.top_attrs), ("attribute sets", profile.top_subtrees)):
+            if not entries:
+                continue
+            table = Table(title=f"Top {len(entries)} {title} by {metric}")
+            table.add_column("Attribute")
+            table.add_column(metric, justify="right")
+            table.add_column("Share", justify="right")
+            for entry in entries:
+                share = entry.value / profile.total if profile.total else 0.0
+                table.add_row(entry.attr, _show(metric, entry.value), f"{share:.1%}")
+            console.print(table)
@@ -0,0 +1,107 @@
+"""
+Memory-aware admission of evaluations.
+
+With `GC_DONT_GC=1`, every `nix eval` grows until it exits, so the number of evaluations which can safely run at once
+depends on what is being evaluated. Rather than relying only on the number of jobs, the admission controller tracks the
+resident set size of the evaluators each worker runs and holds back new evaluations when starting one would exceed the
+budget.
+"""
+
+import os
+import signal
+from collections.abc import Iterable
+from dataclasses import dataclass
+from logging import Logger
+from time import monotonic
+from typing import Final
+
+import nix_eval_jobs.memory
+from nix_eval_jobs.logger import get_logger
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class MemoryLimits:
+    # Total resident set size allowed for all running evaluations.
+    max_bytes: int | None = None
+    # Memory the system must have available after starting an evaluation.
+    min_available_bytes: int | None = None
+    # Resident set size above which a single evaluation is killed (and retried by the worker with GC enabled).
+    max_eval_bytes: int | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes is not None or self.min_available_bytes is not None or self.max_eval_bytes is not None
+
+
+class AdmissionController:
+    def __init__(self, limits: MemoryLimits, sample_interval: float = 0.25) -> None:
+        self.limits: MemoryLimits = limits
+        self._sample_interval: float = sample_interval
+        self._last_sample: float = float("-inf")
+        # Resident set size of the evaluators of each worker as of the last sample.
+        self._running_bytes: int = 0
+        self._available_bytes: int | None = None
+        # Largest resident set size of the evaluators of a single worker seen so far, used as the estimate of how much
+        # memory a new evaluation needs.
+        self._estimate_bytes: int = 0
+        # Memory set aside for evaluations admitted since the last sample, which the sample could not have seen.
+        self._reserved_bytes: int = 0
+
+    def sample(self, worker_pids: Iterable[int]) -> None:
+        """
+        Measures the evaluators run by each worker, killing any which exceed the per-evaluation limit.
+
+        Samples are rate limited, so this is cheap to call often.
+        """
+        if (now := monotonic()) - self._last_sample < self._sample_interval:
+            return
+        self._last_sample = now
+
+        procs = nix_eval_jobs.memory.processes()
+        self._running_bytes = 0
+        for worker_pid in worker_pids:
+            evaluators = nix_eval_jobs.memory.descendants(procs, worker_pid)
+            worker_bytes = sum(evaluator.rss_bytes for evaluator in evaluators)
+            self._running_bytes += worker_bytes
+            self._estimate_bytes = max(self._estimate_bytes, worker_bytes)
+
+            if self.limits.max_eval_bytes is None:
+                continue
+            for evaluator in evaluators:
+                if evaluator.rss_bytes > self.limits.max_eval_bytes:
+                    LOGGER.warning(
+                        "Killing evaluator %d using %d MiB, which exceeds the limit of %d MiB",
+                        evaluator.pid,
+                        evaluator.rss_bytes // 2**20,
+                        self.limits.max_eval_bytes // 2**20,
+                    )
+                    try:
+                        os.kill(evaluator.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+
+        self._available_bytes = nix_eval_jobs.memory.available_bytes()
+        self._reserved_bytes = 0
+
+    def admit(self, num_running: int) -> bool:
+        """
+        Returns whether a new evaluation may start given `num_running` evaluations are already running, reserving
+        memory for it if so.
+
+        An evaluation is always admitted when none are running, so the run makes progress even if a single evaluation
+        exceeds the budget.
+        """
+        needed_bytes = self._reserved_bytes + self._estimate_bytes
+        if num_running > 0:
+            if self.limits.max_bytes is not None and self._running_bytes + needed_bytes > self.limits.max_bytes:
+                return False
+            if (
+                self.limits.min_available_bytes is not None
+                and self._available_bytes is not None
+                and self._available_bytes - needed_bytes < self.limits.min_available_bytes
+            ):
+                return False
+        self._reserved_bytes += self._estimate_bytes
+        return True
@@ -0,0 +1,158 @@
+"""
+A coordinator which runs tasks itself, in an event loop, instead of in worker processes.
+
+Worker processes spend nearly all their time blocked waiting on a `nix eval`, yet each is a full Python interpreter
+which must be sent tasks and send back results. Here, every `nix eval` is a child of the coordinator, started with
+`asyncio.create_subprocess_exec`, and up to `max_concurrency` run at once; parsing results, walking the attribute tree,
+and handing results to the output writer all happen in the same process.
+
+The event loop only runs while the coordinator is stepped, which the main loop does continuously, so the progress bar
+and checkpoints are driven exactly as with `Coordinator`.
+"""
+
+import asyncio
+import heapq
+import time
+from collections.abc import Iterable, Sequence
+from dataclasses import replace
+from logging import Logger
+from typing import Final
+
+import nix_eval_jobs.nix.eval.info
+import nix_eval_jobs.scheduler.worker
+import nix_eval_jobs.tracing
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.cache import EvalCache
+from nix_eval_jobs.nix.eval.evaluator import AsyncEvaluator, AsyncSubprocessEvaluator
+from nix_eval_jobs.scheduler.checkpoint import Checkpoint
+from nix_eval_jobs.scheduler.coordinator import CoordinatorBase
+from nix_eval_jobs.scheduler.dedup import Deduplicator
+from nix_eval_jobs.scheduler.exclusion import ExclusionMatcher
+from nix_eval_jobs.scheduler.incremental import PreviousRun
+from nix_eval_jobs.scheduler.messages import Task, TaskResult
+from nix_eval_jobs.scheduler.policy import Frontier
+from nix_eval_jobs.scheduler.worker import WorkerOptions
+from nix_eval_jobs.tracing import Recorder, TaskTrace
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+class AsyncCoordinator(CoordinatorBase):
+    def __init__(
+        self,
+        options: WorkerOptions,
+        max_concurrency: int,
+        previous: PreviousRun | None = None,
+        refresh_changed: bool = False,
+        resume_from: Checkpoint | None = None,
+        frontier: Frontier | None = None,
+        dedup: Deduplicator | None = None,
+        recorder: Recorder | None = None,
+    ) -> None:
+        """
+        Runs up to `max_concurrency` evaluations at once (see `CoordinatorBase` for the other arguments).
+
+        Twice as many tasks as evaluations are started, so a task is ready to evaluate as soon as another's evaluation
+        completes; tasks wait for their turn to evaluate on the evaluator.
+
+        Each running task is given a lane, the lowest one free, which stands in for a worker in the spans it records.
+        """
+        super().__init__(options.root_attr_path, previous, refresh_changed, resume_from, frontier, dedup, recorder)
+        self._options: WorkerOptions = options
+        self._max_running: int = 2 * max_concurrency
+        self._loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self._evaluator: AsyncEvaluator = AsyncSubprocessEvaluator(options.evaluator_options, max_concurrency)
+        self._exclusions: ExclusionMatcher = options.exclusion_matcher()
+        self._cache: EvalCache | None = (
+            EvalCache(options.cache, options.cache_context(self._evaluator.capabilities.stats))
+            if options.cache is not None
+            else None
+        )
+        self._running: dict[asyncio.Task[TaskResult], Task] = {}
+        self._lanes: dict[asyncio.Task[TaskResult], int] = {}
+        self._free_lanes: list[int] = list(range(self._max_running))
+
+    def _in_flight(self) -> Iterable[Task]:
+        return self._running.values()
+
+    async def _process_task(self, task: Task) -> TaskResult:
+        # Like nix_eval_jobs.scheduler.worker.process_task.
+        options = self._options
+        with nix_eval_jobs.tracing.span("evaluate"):
+            infos = await nix_eval_jobs.nix.eval.info.get_info_many_async(
+                options.flakeref,
+                task.parent_attr_path,
+                task.child_names,
+                self._evaluator,
+                self._cache,
+                options.probe_scopes,
+                options.evaluator_options.validation,
+            )
+        listed_attr_names: dict[str, Sequence[str]] = {}
+        for info in infos:
+            nix_eval_jobs.scheduler.worker.force_root_recursion(options, info)
+            if nix_eval_jobs.scheduler.worker.needs_attr_names(task, info):
+                with nix_eval_jobs.tracing.span("attr-names"):
+                    listed_attr_names[info.value.attr] = (
+                        await nix_eval_jobs.nix.eval.info.attr_names_async(
+                            options.flakeref,
+                            info.value.attr_path,
+                            self._evaluator,
+                            self._cache,
+                            options.evaluator_options.validation,
+                        )
+                    ).value
+
+        with nix_eval_jobs.tracing.span("build"):
+            return nix_eval_jobs.scheduler.worker.build_result(
+                options, task, infos, listed_attr_names, self._exclusions, self._evaluator.capabilities.batching
+            )
+
+    async def _process_task_traced(self, task: Task, lane: int) -> TaskResult:
+        # Like nix_eval_jobs.scheduler.worker.process_task_traced. Each asyncio task runs in a copy of the context, so
+        # the spans of tasks running at once are kept apart.
+        with nix_eval_jobs.tracing.recording(self._options.record_spans) as spans:
+            with nix_eval_jobs.tracing.span("task"):
+                result = await self._process_task(task)
+        if not self._options.record_spans:
+            return result
+        return replace(result, trace=TaskTrace(f"asyncio lane {lane}", spans, time.time()))
+
+    def _dispatch(self) -> None:
+        while self._frontier and len(self._running) < self._max_running:
+            task = self._frontier.pop()
+            lane = heapq.heappop(self._free_lanes)
+            running = self._loop.create_task(self._process_task_traced(task, lane))
+            self._running[running] = task
+            self._lanes[running] = lane
+            self._started(task)
+
+    def step(self, timeout: float | None) -> list[str]:
+        """
+        Starts tasks and runs the event loop for up to `timeout` seconds until tasks complete, returning the results of
+        every task completed.
+        """
+        self._dispatch()
+        if not self._running:
+            return []
+        completed, _ = self._loop.run_until_complete(
+            asyncio.wait(self._running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        )
+        results: list[str] = []
+        for completed_task in completed:
+            heapq.heappush(self._free_lanes, self._lanes.pop(completed_task))
+            # Exceptions raised by a task are raised here, ending the run, as a failed worker does.
+            results.extend(self._completed(self._running.pop(completed_task), completed_task.result()))
+        self._dispatch()
+        return results
+
+    def shutdown(self) -> None:
+        for running in self._running:
+            _ = running.cancel()
+        if self._running:
+            # Let the cancelled tasks kill and reap their evaluations.
+            _ = self._loop.run_until_complete(asyncio.wait(self._running))
+        self._evaluator.close()
+        self._loop.close()
+        if self._cache is not None:
+            self._cache.close()
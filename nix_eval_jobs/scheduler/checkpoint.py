@@ -0,0 +1,59 @@
+"""
+Checkpoints of the scheduler, from which an interrupted run can be resumed.
+
+A checkpoint records every task not yet completed, the counters, and the offset of the output after the results of every
+completed task. Since a task's results are only written once it completes, the tasks in flight when the checkpoint was
+taken are simply evaluated again on resumption, and the output is truncated to the offset before it is appended to.
+"""
+
+import os
+from collections.abc import Mapping, Sequence
+from logging import Logger
+from pathlib import Path
+from typing import Final
+
+from pydantic.alias_generators import to_camel
+
+from nix_eval_jobs.extra_pydantic import PydanticObject
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.output import Compression, OutputHeader
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+class Checkpoint(PydanticObject, alias_generator=to_camel):
+    class PendingTask(PydanticObject, alias_generator=to_camel):
+        parent_attr_path: Sequence[str]
+        child_names: Sequence[str]
+
+    # The header of the output, which records the locked flake being evaluated.
+    header: OutputHeader
+    compression: Compression
+    output_offset: int
+    num_discovered: int
+    num_excluded: int
+    num_evaluated: int
+    num_deduplicated: int = 0
+    num_failed: int = 0
+    pending: Sequence[PendingTask]
+    # The canonical attributes seen by the deduplicator (see nix_eval_jobs.scheduler.dedup), keyed by derivation path
+    # and by scope fingerprint, so aliases of attributes written before the checkpoint stay aliases.
+    canonical_drv_paths: Mapping[str, str] = {}
+    canonical_scopes: Mapping[str, str] = {}
+
+
+def save(path: Path, checkpoint: Checkpoint) -> None:
+    """
+    Atomically replaces the checkpoint at `path`, so an interruption while saving leaves the previous checkpoint intact.
+    """
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open("w", encoding="utf-8") as tmp_file:
+        _ = tmp_file.write(checkpoint.model_dump_json(by_alias=True, indent=None))
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    _ = tmp_path.replace(path)
+    LOGGER.info("Saved a checkpoint with %d pending tasks to %s", len(checkpoint.pending), path)
+
+
+def load(path: Path) -> Checkpoint:
+    return Checkpoint.model_validate_json(path.read_bytes())
@@ -0,0 +1,478 @@
+"""
+The coordinator owns the frontier of attribute paths to evaluate and every counter, and runs tasks: `Coordinator` hands
+them to worker processes over a dedicated pipe per worker, while `AsyncCoordinator` (see
+`nix_eval_jobs.scheduler.async_coordinator`) runs them in an event loop in this process.
+
+Because only the coordinator mutates its state, updates are race-free, and termination is detected exactly: the run is
+complete once the frontier is empty and no task is in flight.
+"""
+
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from logging import Logger
+from multiprocessing import Process
+from multiprocessing.connection import Connection, Pipe, wait
+from time import monotonic, time
+from typing import Final
+
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.output import Compression, DiffRecord, FinishPrediction, OutputHeader
+from nix_eval_jobs.scheduler.admission import AdmissionController, MemoryLimits
+from nix_eval_jobs.scheduler.checkpoint import Checkpoint
+from nix_eval_jobs.scheduler.dedup import Deduplicator
+from nix_eval_jobs.scheduler.incremental import PreviousRun
+from nix_eval_jobs.scheduler.messages import EvalRecord, Task, TaskResult, WorkerFailed
+from nix_eval_jobs.scheduler.policy import FifoFrontier, Frontier
+from nix_eval_jobs.scheduler.worker import WorkerOptions, worker_loop
+from nix_eval_jobs.tracing import Recorder, Span
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+# Seconds between samples of the predicted time the run will take.
+_PREDICTION_INTERVAL: Final[float] = 1.0
+
+# Fractions of the run at which predictions are reported.
+_PREDICTION_FRACTIONS: Final[Sequence[float]] = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+@dataclass(slots=True)
+class Counts:
+    discovered: int = 0
+    excluded: int = 0
+    evaluated: int = 0
+    # Results reused from a previous run.
+    reused: int = 0
+    # Attributes not evaluated because they are below an alias (see nix_eval_jobs.scheduler.dedup).
+    deduplicated: int = 0
+    # Attributes whose evaluation failed, which are also counted as evaluated.
+    failed: int = 0
+
+
+@dataclass(slots=True)
+class Latency:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+@dataclass(slots=True)
+class _Worker:
+    process: Process
+    conn: Connection
+    # Tasks sent to the worker which it has not yet completed, in the order they were sent.
+    in_flight: deque[Task]
+
+
+class WorkerError(Exception):
+    pass
+
+
+class CoordinatorBase(ABC):
+    """
+    The state shared by every way of running tasks: the frontier, the counters, and the comparison with a previous
+    run. Subclasses decide how tasks are run.
+    """
+
+    def __init__(
+        self,
+        root_attr_path: Sequence[str],
+        previous: PreviousRun | None = None,
+        refresh_changed: bool = False,
+        resume_from: Checkpoint | None = None,
+        frontier: Frontier | None = None,
+        dedup: Deduplicator | None = None,
+        recorder: Recorder | None = None,
+    ) -> None:
+        """
+        Seeds the frontier with the root attribute path. Tasks are started in the order decided by `frontier` (see
+        `nix_eval_jobs.scheduler.policy`), by default the order they were discovered in. When `dedup` is given, aliases
+        of attributes already seen are not recursed into (see `nix_eval_jobs.scheduler.dedup`).
+
+        When a previous run is given, results for attributes whose derivation path is unchanged are taken from it
+        instead, and the differences are recorded (see `diff`). If `refresh_changed` is set, added and changed
+        attributes are evaluated again on their own, which is useful when they were discovered in batches but
+        per-attribute stats are wanted.
+
+        When a checkpoint is given, the frontier and counters are restored from it instead of starting from the root.
+
+        When a recorder is given, the time each task waits in the frontier, the spans workers record for it, and the
+        time taken to handle its result are added to it (see `nix_eval_jobs.tracing`). Workers only record spans if
+        told to by their options.
+        """
+        self.counts: Counts = Counts(discovered=1)
+        # Time tasks spend in the frontier before being started, and from being started to completion.
+        self.queue_latency: Latency = Latency()
+        self.task_latency: Latency = Latency()
+        self._enqueued_at: dict[int, float] = {}
+        self._started_at: dict[int, float] = {}
+        self._frontier: Frontier = frontier if frontier is not None else FifoFrontier()
+        self._dedup: Deduplicator = dedup if dedup is not None else Deduplicator("none")
+        self._start: float = monotonic()
+        # The predicted time the run will take, sampled as it goes, keyed by the time it was predicted at.
+        self._predictions: list[tuple[float, float]] = []
+        self._num_tasks: int = 0
+        self._previous: PreviousRun | None = previous
+        self._refresh_changed: bool = refresh_changed
+        self._seen_attrs: set[str] = set()
+        self._diff: list[DiffRecord] = []
+        # Failure records not yet taken (see take_failures).
+        self._failures: list[str] = []
+        self._recorder: Recorder | None = recorder
+        if resume_from is None:
+            self._enqueue(root_attr_path[:-1], root_attr_path[-1:])
+        else:
+            self.counts = Counts(
+                discovered=resume_from.num_discovered,
+                excluded=resume_from.num_excluded,
+                evaluated=resume_from.num_evaluated,
+                deduplicated=resume_from.num_deduplicated,
+                failed=resume_from.num_failed,
+            )
+            self._dedup.restore(resume_from.canonical_drv_paths, resume_from.canonical_scopes)
+            for pending in resume_from.pending:
+                self._enqueue(pending.parent_attr_path, pending.child_names)
+
+    def _enqueue(self, parent_attr_path: Sequence[str], child_names: Sequence[str], refresh: bool = False) -> None:
+        self._frontier.push(Task(self._num_tasks, parent_attr_path, child_names, refresh))
+        self._enqueued_at[self._num_tasks] = monotonic()
+        self._num_tasks += 1
+
+    def _reconcile(self, record: EvalRecord) -> str | None:
+        """
+        Compares a result with the previous run, returning the line to output for it now, if any.
+        """
+        if self._previous is None or record.failure is not None:
+            # Attributes which failed are neither reused nor compared, so they are reported as removed if the previous
+            # run included them.
+            return record.line
+
+        self._seen_attrs.add(record.attr)
+        previously_included, previous_drv_path = self._previous.drv_path(record.attr)
+        if previously_included and previous_drv_path == record.drv_path:
+            self.counts.reused += 1
+            return self._previous.read_line(record.attr)
+
+        self._diff.append(
+            DiffRecord(
+                attr=record.attr,
+                status="changed" if previously_included else "added",
+                drv_path=record.drv_path,
+                previous_drv_path=previous_drv_path,
+            )
+        )
+        if self._refresh_changed:
+            self._enqueue(record.attr_path[:-1], record.attr_path[-1:], refresh=True)
+            return None
+        return record.line
+
+    def _reconcile_not_included(self, attr: str) -> None:
+        """
+        Compares an attribute which was evaluated but is not included with the previous run, which may have included
+        it.
+        """
+        if self._previous is None:
+            return
+        previously_included, previous_drv_path = self._previous.drv_path(attr)
+        if previously_included:
+            self._seen_attrs.add(attr)
+            self._diff.append(
+                DiffRecord(attr=attr, status="not-included", drv_path=None, previous_drv_path=previous_drv_path)
+            )
+
+    def take_failures(self) -> list[str]:
+        """
+        Returns the failure records of the attributes which failed since the last call.
+        """
+        failures, self._failures = self._failures, []
+        return failures
+
+    def diff(self) -> list[DiffRecord]:
+        """
+        Returns the differences from the previous run, sorted by attribute. Only meaningful once the run is done.
+        """
+        if self._previous is None:
+            return []
+        return sorted([*self._diff, *self._previous.removed(self._seen_attrs)], key=lambda record: record.attr)
+
+    @property
+    def policy(self) -> str:
+        return self._frontier.policy
+
+    def _predict(self) -> None:
+        elapsed = monotonic() - self._start
+        if self._predictions and elapsed - self._predictions[-1][0] < _PREDICTION_INTERVAL:
+            return
+        if (predicted_elapsed := self._frontier.predict_elapsed(elapsed)) is not None:
+            self._predictions.append((elapsed, predicted_elapsed))
+
+    def finish_predictions(self, elapsed: float) -> list[FinishPrediction]:
+        """
+        Returns the predictions made closest to fixed fractions of a run which took `elapsed` seconds, to compare with
+        the time it actually took.
+        """
+        if not self._predictions:
+            return []
+        predictions: dict[float, FinishPrediction] = {}
+        for fraction in _PREDICTION_FRACTIONS:
+            at, predicted_elapsed = min(
+                self._predictions, key=lambda prediction: abs(prediction[0] - fraction * elapsed)
+            )
+            predictions[at] = FinishPrediction(elapsed=at, predicted_elapsed=predicted_elapsed)
+        return list(predictions.values())
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of tasks in the frontier, waiting to be started.
+        """
+        return len(self._frontier)
+
+    @property
+    def num_in_flight(self) -> int:
+        """
+        The number of tasks started but not completed.
+        """
+        return len(self._started_at)
+
+    @property
+    def deduplicating(self) -> bool:
+        return self._dedup.mode != "none"
+
+    @property
+    def incremental(self) -> bool:
+        return self._previous is not None
+
+    @abstractmethod
+    def _in_flight(self) -> Iterable[Task]:
+        """
+        Returns the tasks which have been started but not completed.
+        """
+
+    @property
+    def done(self) -> bool:
+        return not self._frontier and not any(True for _ in self._in_flight())
+
+    def checkpoint(self, header: OutputHeader, compression: Compression) -> Checkpoint:
+        """
+        Returns a checkpoint of the current state. Its output offset is zero until the output is synced and the offset
+        after every result returned so far is known.
+
+        Tasks in flight are recorded as pending, since their results have not been returned.
+        """
+        assert self._previous is None, "incremental runs cannot be checkpointed"
+        pending = [*self._in_flight(), *self._frontier]
+        canonical_drv_paths, canonical_scopes = self._dedup.canonical()
+        return Checkpoint(
+            header=header,
+            compression=compression,
+            output_offset=0,
+            num_discovered=self.counts.discovered,
+            num_excluded=self.counts.excluded,
+            num_evaluated=self.counts.evaluated,
+            num_deduplicated=self.counts.deduplicated,
+            num_failed=self.counts.failed,
+            pending=[
+                Checkpoint.PendingTask(parent_attr_path=task.parent_attr_path, child_names=task.child_names)
+                for task in pending
+            ],
+            canonical_drv_paths=canonical_drv_paths,
+            canonical_scopes=canonical_scopes,
+        )
+
+    def _requeue(self, task: Task) -> None:
+        """
+        Returns a task which was started but will not complete, such as one sent to a worker which was lost, to the
+        frontier.
+        """
+        del self._started_at[task.task_id]
+        self._enqueued_at[task.task_id] = monotonic()
+        self._frontier.requeue(task)
+
+    def _started(self, task: Task) -> None:
+        now = monotonic()
+        waited = now - self._enqueued_at.pop(task.task_id)
+        self.queue_latency.add(waited)
+        self._started_at[task.task_id] = now
+        if self._recorder is not None:
+            # Many tasks wait at once.
+            self._recorder.add("frontier", Span("queue", time() - waited, waited), overlapping=True)
+
+    def _completed(self, task: Task, message: TaskResult) -> list[str]:
+        """
+        Updates the state with the result of a task, returning the lines to output for it.
+        """
+        assert task.task_id == message.task_id
+        if self._recorder is None:
+            return self._handle_result(task, message)
+        if message.trace is not None:
+            self._recorder.add_task(message.trace)
+        with self._recorder.span("coordinator", "complete"):
+            return self._handle_result(task, message)
+
+    def _handle_result(self, task: Task, message: TaskResult) -> list[str]:
+        self.task_latency.add(monotonic() - self._started_at.pop(task.task_id))
+        message, num_deduplicated = self._dedup.deduplicate(message)
+        self._frontier.completed(task, message)
+        self._predict()
+        for record in message.results:
+            if record.failure is not None:
+                self.counts.failed += 1
+                self._failures.append(record.failure)
+        if task.refresh:
+            # These attributes were already counted and compared with the previous run when discovered.
+            return [record.line for record in message.results]
+
+        self.counts.discovered += message.num_discovered
+        self.counts.excluded += message.num_excluded
+        self.counts.evaluated += message.num_evaluated
+        self.counts.deduplicated += num_deduplicated
+        for attr in message.not_included:
+            self._reconcile_not_included(attr)
+        for parent_attr_path, child_names in message.discovered:
+            self._enqueue(parent_attr_path, child_names)
+        return [line for record in message.results if (line := self._reconcile(record)) is not None]
+
+    @abstractmethod
+    def step(self, timeout: float | None) -> list[str]:
+        """
+        Starts tasks from the frontier and blocks for up to `timeout` seconds until tasks complete, returning the
+        results of every task completed.
+        """
+
+    @abstractmethod
+    def shutdown(self) -> None: ...
+
+
+class Coordinator(CoordinatorBase):
+    """
+    Runs tasks in worker processes, each of which is handed tasks over a dedicated pipe.
+    """
+
+    def __init__(
+        self,
+        options: WorkerOptions,
+        num_workers: int,
+        max_in_flight_per_worker: int = 2,
+        memory_limits: MemoryLimits | None = None,
+        previous: PreviousRun | None = None,
+        refresh_changed: bool = False,
+        resume_from: Checkpoint | None = None,
+        frontier: Frontier | None = None,
+        dedup: Deduplicator | None = None,
+        recorder: Recorder | None = None,
+    ) -> None:
+        """
+        Starts `num_workers` workers (see `CoordinatorBase` for the other arguments).
+
+        Each worker is sent up to `max_in_flight_per_worker` tasks at a time so it can start on its next task without
+        waiting for a round trip to the coordinator. When memory limits are given, workers are instead sent one task at
+        a time, so that sending a task is what starts an evaluation, and tasks are only sent when admitted.
+        """
+        super().__init__(options.root_attr_path, previous, refresh_changed, resume_from, frontier, dedup, recorder)
+        self._admission: AdmissionController | None = None
+        if memory_limits is not None and memory_limits.enabled:
+            self._admission = AdmissionController(memory_limits)
+            max_in_flight_per_worker = 1
+        self._max_in_flight_per_worker: int = max_in_flight_per_worker
+
+        self._workers: list[_Worker] = []
+        for _ in range(num_workers):
+            conn, worker_conn = Pipe(duplex=True)
+            process = Process(target=worker_loop, args=(worker_conn, options), daemon=True)
+            process.start()
+            worker_conn.close()
+            self._workers.append(_Worker(process, conn, deque()))
+
+    def _in_flight(self) -> Iterable[Task]:
+        return (task for worker in self._workers for task in worker.in_flight)
+
+    def _dispatch(self) -> None:
+        if self._admission is not None:
+            self._admission.sample(worker.process.pid for worker in self._workers if worker.process.pid is not None)
+
+        while self._frontier:
+            worker = min(self._workers, key=lambda worker: len(worker.in_flight))
+            if len(worker.in_flight) >= self._max_in_flight_per_worker:
+                break
+            if self._admission is not None and not self._admission.admit(
+                sum(1 for worker in self._workers if worker.in_flight)
+            ):
+                break
+            task = self._frontier.pop()
+            worker.in_flight.append(task)
+            try:
+                worker.conn.send(task)
+            except OSError as e:
+                raise self._exited(worker) from e
+            self._started(task)
+
+    @staticmethod
+    def _exited(worker: _Worker) -> WorkerError:
+        """
+        Returns the error for a worker which exited, with its traceback if it failed.
+
+        A worker which fails sends why before it exits, possibly after results, which no longer matter.
+        """
+        try:
+            while worker.conn.poll():
+                if isinstance(message := worker.conn.recv(), WorkerFailed):
+                    return WorkerError(f"Worker {worker.process.pid} failed:\n{message.traceback}")
+        except (EOFError, OSError):
+            pass
+        return WorkerError(f"Worker {worker.process.pid} exited unexpectedly")
+
+    def _complete(self, worker: _Worker, message: TaskResult | WorkerFailed) -> Sequence[str]:
+        match message:
+            case WorkerFailed(traceback=traceback):
+                raise WorkerError(f"Worker {worker.process.pid} failed:\n{traceback}")
+            case TaskResult():
+                return self._completed(worker.in_flight.popleft(), message)
+
+    def step(self, timeout: float | None) -> list[str]:
+        """
+        Dispatches work to idle workers and blocks for up to `timeout` seconds until workers complete tasks, returning
+        the results of every task completed.
+
+        Every message already waiting on a ready pipe is drained, so completions arriving in bursts are handled in one
+        step.
+        """
+        self._dispatch()
+        results: list[str] = []
+        busy = {worker.conn: worker for worker in self._workers if worker.in_flight}
+        for conn in wait(list(busy), timeout=timeout):
+            assert isinstance(conn, Connection)
+            worker = busy[conn]
+            try:
+                # The pipe is ready, so the first receive does not block.
+                results.extend(self._complete(worker, conn.recv()))
+                while worker.in_flight and conn.poll():
+                    results.extend(self._complete(worker, conn.recv()))
+            except EOFError as e:
+                raise WorkerError(f"Worker {worker.process.pid} exited unexpectedly") from e
+        self._dispatch()
+        return results
+
+    def shutdown(self) -> None:
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=10.0)
+            if worker.process.is_alive():
+                LOGGER.warning("Worker %d did not exit, killing it", worker.process.pid)
+                worker.process.kill()
+                worker.process.join()
+            worker.conn.close()
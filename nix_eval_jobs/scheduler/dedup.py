@@ -0,0 +1,136 @@
+"""
+Deduplication of attributes which are aliases of others.
+
+nixpkgs exposes the same derivation under many attribute paths, and the same scope under several names. The first
+attribute seen with a derivation path, or the first scope seen with a fingerprint, is canonical; every other one is an
+alias of it:
+
+- the result of an alias of a derivation is replaced by an alias record, and it is not recursed into, and
+- an alias of a scope is not recursed into, and an alias record is written for it instead of the results below it.
+
+An alias record has the shape of a result, without stats, whose value has `aliasOf` set to the canonical attribute.
+Which attribute is canonical depends on the order attributes are evaluated in, which varies between runs.
+
+Scopes are fingerprinted by the names of their children and the derivation path of one of them (see info.nix), which is
+cheap to compute alongside the names. Scopes which have no derivation among their first few children are never
+deduplicated.
+"""
+
+import hashlib
+import json
+from collections.abc import Mapping, Sequence
+from dataclasses import replace
+from logging import Logger
+from typing import Any, Final, Literal
+
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.utilities import show_attr_path
+from nix_eval_jobs.scheduler.messages import EvalRecord, TaskResult
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+# What to deduplicate: nothing, aliases of derivations, or aliases of derivations and of scopes.
+DedupMode = Literal["none", "derivations", "scopes"]
+
+
+def fingerprint(attr_names: Sequence[str], probe_drv_path: str) -> str:
+    """
+    Returns the fingerprint of a scope with children named `attr_names`, one of which has the derivation path
+    `probe_drv_path`.
+    """
+    digest = hashlib.sha256()
+    for name in attr_names:
+        digest.update(name.encode())
+        digest.update(b"\0")
+    digest.update(probe_drv_path.encode())
+    return digest.hexdigest()
+
+
+def _dumps(record: dict[str, Any]) -> str:
+    # Minified, like the other results.
+    return json.dumps(record, separators=(",", ":"))
+
+
+def _derivation_alias(record: EvalRecord, canonical: str) -> str:
+    value: dict[str, Any] = json.loads(record.line)["value"]
+    return _dumps({"stats": None, "stderr": "", "value": value | {"aliasOf": canonical}})
+
+
+def _scope_alias(attr_path: Sequence[str], canonical: str) -> str:
+    return _dumps({
+        "stats": None,
+        "stderr": "",
+        "value": {
+            "attr": show_attr_path(attr_path),
+            "attrPath": list(attr_path),
+            "include": False,
+            "name": None,
+            "drvPath": None,
+            "system": None,
+            "recurse": True,
+            "aliasOf": canonical,
+        },
+    })
+
+
+class Deduplicator:
+    def __init__(self, mode: DedupMode) -> None:
+        self.mode: DedupMode = mode
+        # Canonical attributes, keyed by derivation path and by the fingerprint of the scope.
+        self._drv_paths: dict[str, str] = {}
+        self._scopes: dict[str, str] = {}
+
+    def canonical(self) -> tuple[dict[str, str], dict[str, str]]:
+        """
+        Returns copies of the canonical attributes seen so far, keyed by derivation path and by scope fingerprint, to
+        be saved in a checkpoint.
+        """
+        return dict(self._drv_paths), dict(self._scopes)
+
+    def restore(self, drv_paths: Mapping[str, str], scopes: Mapping[str, str]) -> None:
+        """
+        Restores the canonical attributes saved in a checkpoint, whose results were already written.
+        """
+        self._drv_paths = dict(drv_paths)
+        self._scopes = dict(scopes)
+
+    def deduplicate(self, result: TaskResult) -> tuple[TaskResult, int]:
+        """
+        Returns the result with the results of aliases replaced by alias records and the children of aliases dropped,
+        along with the number of children dropped.
+        """
+        if self.mode == "none":
+            return result, 0
+
+        # Aliases found in this result, keyed by attribute path, mapped to the canonical attribute.
+        aliases: dict[tuple[str, ...], str] = {}
+        results: list[EvalRecord] = []
+        for record in result.results:
+            canonical = record.attr
+            if record.drv_path is not None:
+                canonical = self._drv_paths.setdefault(record.drv_path, record.attr)
+            if canonical == record.attr:
+                results.append(record)
+            else:
+                aliases[tuple(record.attr_path)] = canonical
+                results.append(replace(record, line=_derivation_alias(record, canonical)))
+
+        for attr_path, scope_fingerprint in result.fingerprints:
+            attr = show_attr_path(attr_path)
+            canonical = self._scopes.setdefault(scope_fingerprint, attr)
+            if canonical != attr and tuple(attr_path) not in aliases:
+                aliases[tuple(attr_path)] = canonical
+                results.append(EvalRecord(attr, attr_path, None, _scope_alias(attr_path, canonical)))
+
+        if not aliases:
+            return result, 0
+
+        discovered: list[tuple[Sequence[str], Sequence[str]]] = []
+        num_dropped = 0
+        for parent_attr_path, child_names in result.discovered:
+            if (canonical := aliases.get(tuple(parent_attr_path))) is not None:
+                LOGGER.debug("Not recursing into %s, an alias of %s", show_attr_path(parent_attr_path), canonical)
+                num_dropped += len(child_names)
+            else:
+                discovered.append((parent_attr_path, child_names))
+        return replace(result, results=results, discovered=discovered), num_dropped
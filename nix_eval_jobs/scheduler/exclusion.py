@@ -0,0 +1,163 @@
+"""
+Exclusion of attributes from evaluation.
+
+Rules are relative to the root attribute path, which is never excluded itself:
+
+- top-level names exclude attributes directly below the root with those names,
+- any-level names exclude attributes anywhere below the root with those names,
+- prefixes exclude the attributes at those (full) attribute paths, and
+- globs exclude attributes whose attribute path, as shown by `show_attr_path`, matches them.
+
+Excluding an attribute excludes everything below it, since it is never recursed into. Rules are applied as children are
+discovered, so excluded children are never made into tasks. The walk is top-down, so by the time an attribute is
+checked every attribute above it has passed, and only the attribute itself needs to be matched: its name against the
+name sets, its path against a trie of the prefixes, and its shown path against a single regular expression compiled from
+every glob.
+"""
+
+import re
+from collections.abc import Sequence
+from fnmatch import translate
+from logging import Logger
+from pathlib import Path
+from typing import Final, Self
+
+from pydantic.alias_generators import to_camel
+
+from nix_eval_jobs.extra_pydantic import PydanticObject
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.utilities import show_attr_path
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+class ExclusionRules(PydanticObject, alias_generator=to_camel):
+    top_level: Sequence[str] = []
+    any_level: Sequence[str] = []
+    prefixes: Sequence[Sequence[str]] = []
+    globs: Sequence[str] = []
+
+    @classmethod
+    def load(cls, path: Path) -> Self:
+        return cls.model_validate_json(path.read_bytes())
+
+    def extend(self, any_level: Sequence[str] = (), globs: Sequence[str] = ()) -> Self:
+        return self.model_copy(update={"any_level": [*self.any_level, *any_level], "globs": [*self.globs, *globs]})
+
+
+# The exclusions of nixpkgs' release tooling.
+DEFAULT_EXCLUSIONS: Final[ExclusionRules] = ExclusionRules(
+    # Originally excludedAtTopLevel
+    #
+    # No release package attrpath may have any of these attrnames as
+    # its initial component.
+    #
+    # If you can find a way to remove any of these entries without
+    # causing CI to fail, please do so.
+    #
+    top_level=[
+        "AAAAAASomeThingsFailToEvaluate",
+        #  spliced packagesets
+        "__splicedPackages",
+        "pkgsBuildBuild",
+        "pkgsBuildHost",
+        "pkgsBuildTarget",
+        "pkgsHostHost",
+        "pkgsHostTarget",
+        "pkgsTargetTarget",
+        "buildPackages",
+        "targetPackages",
+        # cross packagesets
+        "pkgsLLVM",
+        "pkgsMusl",
+        "pkgsStatic",
+        "pkgsCross",
+        "pkgsx86_64Darwin",
+        "pkgsi686Linux",
+        "pkgsLinux",
+        "pkgsExtraHardening",
+    ],
+    # Originally excludedAtAnyLevel
+    #
+    # No release package attrname may have any of these at a component
+    # anywhere in its attrpath.  These are the names of gigantic
+    # top-level attrsets that have leaked into so many sub-packagesets
+    # that it's easier to simply exclude them entirely.
+    #
+    # If you can find a way to remove any of these entries without
+    # causing CI to fail, please do so.
+    #
+    any_level=[
+        "lib",
+        "override",
+        "__functor",
+        "__functionArgs",
+        "__splicedPackages",
+        "newScope",
+        "scope",
+        "pkgs",
+        "callPackage",
+        "mkDerivation",
+        "overrideDerivation",
+        "overrideScope",
+        "overrideScope'",
+        # Special case: lib/types.nix leaks into a lot of nixos-related
+        # derivations, and does not eval deeply.
+        "type",
+    ],
+)
+
+
+class _TrieNode:
+    __slots__ = ("children", "excluded")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _TrieNode] = {}
+        self.excluded: bool = False
+
+
+class ExclusionMatcher:
+    def __init__(self, rules: ExclusionRules, root_attr_path: Sequence[str]) -> None:
+        self._root_depth: int = len(root_attr_path)
+        self._top_level: frozenset[str] = frozenset(rules.top_level)
+        self._any_level: frozenset[str] = frozenset(rules.any_level)
+        self._prefixes: _TrieNode = _TrieNode()
+        for prefix in rules.prefixes:
+            node = self._prefixes
+            for name in prefix:
+                node = node.children.setdefault(name, _TrieNode())
+            node.excluded = True
+        self._globs: re.Pattern[str] | None = (
+            re.compile("|".join(f"(?:{translate(glob)})" for glob in rules.globs)) if rules.globs else None
+        )
+
+    def _matches_prefix(self, attr_path: Sequence[str]) -> bool:
+        node = self._prefixes
+        for name in attr_path:
+            if (child := node.children.get(name)) is None:
+                return False
+            node = child
+        return node.excluded
+
+    def is_excluded(self, parent_attr_path: Sequence[str], name: str) -> bool:
+        """
+        Returns whether the child `name` of `parent_attr_path`, which is not itself excluded, is excluded.
+        """
+        depth = len(parent_attr_path) + 1
+        if depth <= self._root_depth:
+            return False
+        excluded = (
+            name in self._any_level
+            or (depth == self._root_depth + 1 and name in self._top_level)
+            or (self._prefixes.children and self._matches_prefix([*parent_attr_path, name]))
+            or (self._globs is not None and self._globs.match(show_attr_path([*parent_attr_path, name])) is not None)
+        )
+        if excluded:
+            LOGGER.debug("Excluding attribute %s", show_attr_path([*parent_attr_path, name]))
+        return bool(excluded)
+
+    def filter(self, parent_attr_path: Sequence[str], child_names: Sequence[str]) -> list[str]:
+        """
+        Returns the children of `parent_attr_path` named by `child_names` which are not excluded, in order.
+        """
+        return [name for name in child_names if not self.is_excluded(parent_attr_path, name)]
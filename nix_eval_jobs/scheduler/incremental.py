@@ -0,0 +1,78 @@
+"""
+Support for incremental runs, which reuse the results of a previous run for attributes whose derivation is unchanged.
+"""
+
+import json
+from collections.abc import Iterable
+from logging import Logger
+from pathlib import Path
+from typing import Final
+
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.output import DiffRecord, OutputHeader, infer_compression, open_for_reading
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+class PreviousRun:
+    """
+    The output of a previous run, indexed by attribute.
+
+    Only the derivation path and the offset of each record are kept in memory; records are read back from the file when
+    they are reused. Compressed outputs cannot be read from an offset, so their records are kept in memory instead.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        self._file = open_for_reading(path)
+        seekable = infer_compression(path) == "none"
+        self.header: OutputHeader = OutputHeader.model_validate_json(self._file.readline())
+        # Map from attribute to derivation path and either the offset of its record or the record itself.
+        self._records: dict[str, tuple[str | None, int | bytes]] = {}
+        # Attributes which failed are evaluated again, so they are only counted.
+        self.num_failed: int = 0
+        while line := self._file.readline():
+            record = json.loads(line)
+            if "failure" in record:
+                self.num_failed += 1
+                continue
+            value = record["value"]
+            self._records[value["attr"]] = (value["drvPath"], self._file.tell() - len(line) if seekable else line)
+        LOGGER.info("Loaded %d records and %d failures from %s", len(self._records), self.num_failed, path)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def drv_path(self, attr: str) -> tuple[bool, str | None]:
+        """
+        Returns whether the previous run included the attribute, and if so, its derivation path.
+        """
+        if (record := self._records.get(attr)) is None:
+            return False, None
+        return True, record[0]
+
+    def read_line(self, attr: str) -> str:
+        match self._records[attr][1]:
+            case int(offset):
+                _ = self._file.seek(offset)
+                line = self._file.readline()
+            case bytes(line):
+                pass
+        return line.decode().rstrip("\n")
+
+    def read_lines(self) -> Iterable[str]:
+        for attr in self._records:
+            yield self.read_line(attr)
+
+    def removed(self, seen_attrs: Iterable[str]) -> list[DiffRecord]:
+        """
+        Returns diff records for the attributes included by the previous run which are not in `seen_attrs`.
+        """
+        removed_attrs = self._records.keys() - set(seen_attrs)
+        return [
+            DiffRecord(attr=attr, status="removed", drv_path=None, previous_drv_path=self._records[attr][0])
+            for attr in removed_attrs
+        ]
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,73 @@
+"""
+Messages exchanged between the coordinator and its workers.
+
+These are sent for every task, so they are plain dataclasses rather than Pydantic models to keep (de)serialization
+cheap.
+"""
+
+from collections.abc import Sequence
+from dataclasses import dataclass
+
+from nix_eval_jobs.tracing import TaskTrace
+
+
+@dataclass(frozen=True, slots=True)
+class Task:
+    """
+    A chunk of sibling attribute paths to evaluate, given as the parent attribute path and the names of the children.
+    """
+
+    task_id: int
+    parent_attr_path: Sequence[str]
+    child_names: Sequence[str]
+    # Whether this re-evaluates attributes which were already discovered, in which case the worker does not recurse.
+    refresh: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class EvalRecord:
+    """
+    The result for an included attribute, along with what the coordinator needs to know about it without parsing it.
+    """
+
+    attr: str
+    attr_path: Sequence[str]
+    drv_path: str | None
+    # Minified JSON.
+    line: str
+    # The failure record for the attribute (see nix_eval_jobs.output.FailureRecord) as minified JSON, if evaluating it
+    # failed.
+    failure: str | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class TaskResult:
+    """
+    The completion of a task, carrying everything the worker produced so the coordinator can update its state at once.
+    """
+
+    task_id: int
+    # A record for each included attribute.
+    results: Sequence[EvalRecord]
+    # Newly discovered chunks of children, already split by batch size.
+    discovered: Sequence[tuple[Sequence[str], Sequence[str]]]
+    num_discovered: int
+    num_excluded: int
+    num_evaluated: int
+    # The fingerprint of each scope recursed into which has one (see nix_eval_jobs.scheduler.dedup), keyed by its
+    # attribute path.
+    fingerprints: Sequence[tuple[Sequence[str], str]] = ()
+    # The spans recorded while processing the task, if spans are recorded (see nix_eval_jobs.tracing).
+    trace: TaskTrace | None = None
+    # Attributes evaluated which are not included and did not fail, if asked for (see
+    # nix_eval_jobs.scheduler.worker.WorkerOptions.report_not_included).
+    not_included: Sequence[str] = ()
+
+
+@dataclass(frozen=True, slots=True)
+class WorkerFailed:
+    """
+    Sent by a worker which raised an exception, just before it exits.
+    """
+
+    traceback: str
@@ -0,0 +1,202 @@
+"""
+Policies deciding the order in which tasks in the frontier are started.
+
+`fifo` starts tasks in the order they were discovered, which walks the attribute tree breadth first. An attribute set
+with a large subtree discovered late then becomes a long tail, evaluated by a few workers while the others are idle.
+The other policies estimate the work below each task and start the largest first (the longest-processing-time-first
+rule, which keeps the time to finish close to the best possible), leaving cheap leaves to fill the gaps at the end:
+
+- `fan-out` estimates the number of attributes below each child from how many children the attributes at each depth
+  have had so far in the run, so tasks at depths which tend to recurse are started before leaves.
+- `cost` estimates the CPU time of the attributes below each child from the stats in the output of a previous run (see
+  `nix_eval_jobs.report.load_costs`). Attributes the previous run did not evaluate are assumed to cost the mean.
+
+Every policy also predicts when the run will finish: the work estimated for the tasks not yet completed, divided by the
+rate at which estimated work has been completed so far. The work a task completes is its estimate less the estimates
+of the tasks it discovers, so the prediction does not depend on the unit of the estimates.
+"""
+
+import heapq
+from abc import ABC, abstractmethod
+from collections.abc import Iterator, Mapping, Sequence
+from itertools import starmap
+from logging import Logger
+from pathlib import Path
+from typing import Final, Literal, Self
+
+import nix_eval_jobs.report
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.scheduler.messages import Task, TaskResult
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+SchedulingPolicy = Literal["fifo", "fan-out", "cost"]
+
+POLICIES: Final[Sequence[SchedulingPolicy]] = ["fifo", "fan-out", "cost"]
+
+# Depths below which the fan-out policy stops extrapolating the size of subtrees.
+_MAX_DEPTH: Final[int] = 32
+
+
+class Frontier(ABC):
+    """
+    The tasks which have been discovered but not started, along with the estimated work of every task which has not
+    completed.
+    """
+
+    policy: SchedulingPolicy
+    # Whether to start the task with the largest estimate first, rather than in the order tasks were discovered. Ties
+    # are broken in the order tasks were discovered.
+    largest_first: bool = True
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, int, Task]] = []
+        self._estimates: dict[int, float] = {}
+        self._remaining: float = 0.0
+        self._completed: float = 0.0
+
+    @abstractmethod
+    def estimate(self, parent_attr_path: Sequence[str], child_names: Sequence[str]) -> float:
+        """
+        Returns the estimated work of evaluating the children of `parent_attr_path` named by `child_names` and
+        everything below them.
+        """
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __iter__(self) -> Iterator[Task]:
+        return (task for _, _, task in self._heap)
+
+    def _insert(self, task: Task) -> None:
+        estimate = self._estimates[task.task_id]
+        heapq.heappush(self._heap, (-estimate if self.largest_first else 0.0, task.task_id, task))
+
+    def push(self, task: Task) -> None:
+        estimate = self.estimate(task.parent_attr_path, task.child_names)
+        self._estimates[task.task_id] = estimate
+        self._remaining += estimate
+        self._insert(task)
+
+    def requeue(self, task: Task) -> None:
+        """
+        Returns a task which was started but will not complete to the frontier, as it was when first pushed.
+        """
+        self._insert(task)
+
+    def pop(self) -> Task:
+        """
+        Removes and returns the task to start next.
+        """
+        return heapq.heappop(self._heap)[2]
+
+    def completed(self, task: Task, result: TaskResult) -> None:
+        """
+        Accounts for the completion of a task. Called before the tasks it discovered are pushed.
+        """
+        estimate = self._estimates.pop(task.task_id)
+        self._remaining -= estimate
+        discovered = sum(starmap(self.estimate, result.discovered))
+        self._completed += max(0.0, estimate - discovered)
+
+    def predict_elapsed(self, elapsed: float) -> float | None:
+        """
+        Returns the predicted time the run will take in total, given it has taken `elapsed` seconds so far, or None if
+        no work has been completed to predict from.
+        """
+        if self._completed <= 0.0 or elapsed <= 0.0:
+            return None
+        return elapsed + max(0.0, self._remaining) * elapsed / self._completed
+
+
+class FanOutFrontier(Frontier):
+    policy: SchedulingPolicy = "fan-out"
+
+    def __init__(self) -> None:
+        super().__init__()
+        # Keyed by the length of attribute paths: the number of attributes evaluated, and of children they had.
+        self._num_evaluated: dict[int, int] = {}
+        self._num_children: dict[int, int] = {}
+        # The estimated number of attributes at and below an attribute, keyed by the length of its attribute path.
+        self._subtree_sizes: dict[int, float] = {}
+
+    def _subtree_size(self, depth: int) -> float:
+        if (size := self._subtree_sizes.get(depth)) is not None:
+            return size
+        # Depths not yet seen are assumed to be leaves.
+        size = 1.0
+        for level in reversed(range(depth, depth + _MAX_DEPTH)):
+            if num_evaluated := self._num_evaluated.get(level, 0):
+                size = 1.0 + self._num_children.get(level, 0) / num_evaluated * size
+            else:
+                size = 1.0
+        self._subtree_sizes[depth] = size
+        return size
+
+    def estimate(self, parent_attr_path: Sequence[str], child_names: Sequence[str]) -> float:
+        return len(child_names) * self._subtree_size(len(parent_attr_path) + 1)
+
+    def completed(self, task: Task, result: TaskResult) -> None:
+        super().completed(task, result)
+        if task.refresh:
+            return
+        depth = len(task.parent_attr_path) + 1
+        self._num_evaluated[depth] = self._num_evaluated.get(depth, 0) + result.num_evaluated
+        self._num_children[depth] = self._num_children.get(depth, 0) + result.num_discovered - result.num_excluded
+        self._subtree_sizes.clear()
+
+
+class FifoFrontier(FanOutFrontier):
+    """
+    Starts tasks in the order they were discovered, using the estimates of the fan-out policy only for predictions.
+    """
+
+    policy: SchedulingPolicy = "fifo"
+    largest_first: bool = False
+
+
+class CostFrontier(Frontier):
+    policy: SchedulingPolicy = "cost"
+
+    def __init__(self, subtree_costs: Mapping[tuple[str, ...], float], mean_cost: float) -> None:
+        """
+        `subtree_costs` is the total cost of the attributes at and below each attribute path, and `mean_cost` the cost
+        assumed for attributes not in it.
+        """
+        super().__init__()
+        self._subtree_costs: Mapping[tuple[str, ...], float] = subtree_costs
+        self._mean_cost: float = mean_cost
+
+    @classmethod
+    def load(cls, output_path: Path) -> Self:
+        """
+        Estimates costs from the CPU time of each attribute in the output of a previous run.
+        """
+        _, _, costs = nix_eval_jobs.report.load_costs(output_path)
+        subtree_costs: dict[tuple[str, ...], float] = {}
+        for cost in costs:
+            cpu_time = cost.costs["cpuTime"]
+            attr_path = tuple(cost.attr_path)
+            for depth in range(len(attr_path) + 1):
+                subtree_costs[attr_path[:depth]] = subtree_costs.get(attr_path[:depth], 0.0) + cpu_time
+        mean_cost = subtree_costs.get((), 0.0) / len(costs) if costs else 1.0
+        LOGGER.info("Loaded the costs of %d attributes from %s", len(costs), output_path)
+        return cls(subtree_costs, mean_cost)
+
+    def estimate(self, parent_attr_path: Sequence[str], child_names: Sequence[str]) -> float:
+        parent = tuple(parent_attr_path)
+        return sum(self._subtree_costs.get((*parent, child_name), self._mean_cost) for child_name in child_names)
+
+
+def create(policy: SchedulingPolicy, costs_path: Path | None = None) -> Frontier:
+    """
+    Creates an empty frontier ordered by `policy`. The cost policy needs the output of a previous run in `costs_path`.
+    """
+    match policy:
+        case "fifo":
+            return FifoFrontier()
+        case "fan-out":
+            return FanOutFrontier()
+        case "cost":
+            assert costs_path is not None, "the cost policy needs the output of a previous run"
+            return CostFrontier.load(costs_path)
@@ -0,0 +1,347 @@
+"""
+A coordinator which serves tasks to workers over TCP, so a run can be spread across several machines.
+
+Workers connect to the coordinator (see `run_worker`), which sends them the options of the run, and are then handed
+tasks exactly like the workers of `Coordinator`: up to `max_in_flight_per_worker` at a time, each completed with a
+`TaskResult` evaluated by `worker_loop`. Workers may connect at any point in the run.
+
+Each worker also sends a heartbeat every `heartbeat_interval` seconds from a thread of its own, which keeps sending
+while the worker waits on `nix`. A worker which fails, disconnects, or sends nothing for `_HEARTBEAT_TIMEOUT_INTERVALS`
+heartbeat intervals, is lost: the tasks it had in flight are returned to the frontier and handed to other workers.
+Results of a lost worker which arrive later are never read, so no task is completed twice.
+
+Connections use `multiprocessing.connection`, which authenticates both ends with a shared key before anything is
+unpickled. Anyone who has the key can run code on the coordinator and on every worker, so it must be kept secret, and
+traffic is not encrypted.
+"""
+
+import multiprocessing.connection
+import sys
+import time
+from collections import deque
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass, replace
+from logging import Logger
+from multiprocessing import AuthenticationError, Process
+from multiprocessing.connection import Client, Connection, Listener, wait
+from queue import SimpleQueue
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Final
+
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.cache import CacheOptions
+from nix_eval_jobs.scheduler.checkpoint import Checkpoint
+from nix_eval_jobs.scheduler.coordinator import CoordinatorBase
+from nix_eval_jobs.scheduler.dedup import Deduplicator
+from nix_eval_jobs.scheduler.incremental import PreviousRun
+from nix_eval_jobs.scheduler.messages import Task, TaskResult, WorkerFailed
+from nix_eval_jobs.scheduler.policy import Frontier
+from nix_eval_jobs.scheduler.worker import WorkerOptions, worker_loop
+from nix_eval_jobs.tracing import Recorder
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+# Number of heartbeat intervals without a message after which a worker is considered lost.
+_HEARTBEAT_TIMEOUT_INTERVALS: Final[float] = 3.0
+
+# Seconds between attempts to connect to a coordinator which is not yet listening.
+_CONNECT_RETRY_INTERVAL: Final[float] = 1.0
+
+Address = tuple[str, int]
+
+
+def parse_address(address: str) -> Address:
+    """
+    Parses an address given as HOST:PORT. IPv6 hosts are given in brackets, as in [::1]:8000.
+    """
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"{address} is not of the form HOST:PORT")
+    return host.removeprefix("[").removesuffix("]"), int(port)
+
+
+def _inet_address(address: object) -> Address:
+    # multiprocessing.connection types addresses loosely, since it also supports Unix sockets and named pipes.
+    match address:
+        case (str() as host, int() as port):
+            return host, port
+        case _:
+            raise TypeError(f"{address!r} is not an internet address")
+
+
+def _show_address(address: Address) -> str:
+    host, port = address
+    return f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+
+
+@dataclass(frozen=True, slots=True)
+class Welcome:
+    """
+    Sent by the coordinator to each worker once it connects.
+    """
+
+    options: WorkerOptions
+    # Seconds between heartbeats the worker should send.
+    heartbeat_interval: float
+
+
+@dataclass(frozen=True, slots=True)
+class Heartbeat:
+    """
+    Sent by each worker periodically, so the coordinator can tell it is still alive while it evaluates.
+    """
+
+
+@dataclass(slots=True)
+class _RemoteWorker:
+    conn: Connection
+    address: Address
+    # Tasks sent to the worker which it has not yet completed, in the order they were sent.
+    in_flight: deque[Task]
+    # When the worker last sent a message.
+    last_seen: float
+
+
+class RemoteCoordinator(CoordinatorBase):
+    """
+    Runs tasks in workers which connect over TCP, on this machine or others.
+    """
+
+    def __init__(
+        self,
+        options: WorkerOptions,
+        address: Address,
+        authkey: bytes,
+        num_local_workers: int,
+        heartbeat_interval: float = 5.0,
+        max_in_flight_per_worker: int = 2,
+        previous: PreviousRun | None = None,
+        refresh_changed: bool = False,
+        resume_from: Checkpoint | None = None,
+        frontier: Frontier | None = None,
+        dedup: Deduplicator | None = None,
+        recorder: Recorder | None = None,
+    ) -> None:
+        """
+        Listens for workers on `address` (see `CoordinatorBase` for the other arguments), and starts
+        `num_local_workers` workers on this machine which connect like any other.
+
+        Workers do not use the cache of the coordinator, since its path may not exist where they run; the local workers
+        do, and other workers are given their own with `nix-eval-jobs-python worker --cache`.
+        """
+        super().__init__(options.root_attr_path, previous, refresh_changed, resume_from, frontier, dedup, recorder)
+        self._welcome: Welcome = Welcome(replace(options, cache=None), heartbeat_interval)
+        self._heartbeat_timeout: float = _HEARTBEAT_TIMEOUT_INTERVALS * heartbeat_interval
+        self._max_in_flight_per_worker: int = max_in_flight_per_worker
+        self._workers: list[_RemoteWorker] = []
+        # Workers which connected since the last step, handed over by the thread accepting connections.
+        self._connected: SimpleQueue[_RemoteWorker] = SimpleQueue()
+
+        # Workers are authenticated by `_welcome_worker` rather than by the listener, so a client which connects but
+        # never completes the handshake cannot hold up accepting others.
+        self._authkey: bytes = authkey
+        self._closed: Event = Event()
+        self._listener: Listener = Listener(address, family="AF_INET")
+        self.address: Address = _inet_address(self._listener.address)
+        LOGGER.info("Listening for workers on %s", _show_address(self.address))
+
+        # Local workers are forked before the accepting thread is started, so they do not inherit it.
+        self._processes: list[Process] = []
+        for _ in range(num_local_workers):
+            process = Process(target=run_worker, args=(self.address, authkey, options.cache), daemon=True)
+            process.start()
+            self._processes.append(process)
+
+        # Accepting blocks, so it is done off the main loop, and each connection is authenticated in a thread of its
+        # own since that takes round trips with a client which may never answer. The threads are daemons since closing
+        # the listener does not interrupt a pending accept.
+        Thread(target=self._accept_loop, name="accept-workers", daemon=True).start()
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError as e:
+                if self._closed.is_set():
+                    return
+                LOGGER.warning("Failed to accept a connection: %s", e)
+                continue
+            address = _inet_address(self._listener.last_accepted)
+            Thread(
+                target=self._welcome_worker, args=(conn, address), name=f"welcome-{_show_address(address)}", daemon=True
+            ).start()
+
+    def _welcome_worker(self, conn: Connection, address: Address) -> None:
+        """
+        Authenticates a client which connected and sends it the welcome, handing it over to the main loop as a worker.
+        Clients which fail to do so, such as port scanners, are disconnected.
+        """
+        try:
+            multiprocessing.connection.deliver_challenge(conn, self._authkey)
+            multiprocessing.connection.answer_challenge(conn, self._authkey)
+            conn.send(self._welcome)
+        except AuthenticationError:
+            LOGGER.warning("Rejected %s, which failed to authenticate", _show_address(address))
+            conn.close()
+            return
+        except Exception as e:
+            LOGGER.warning(
+                "%s disconnected before it was welcomed: %s", _show_address(address), str(e) or type(e).__name__
+            )
+            conn.close()
+            return
+        self._connected.put(_RemoteWorker(conn, address, deque(), monotonic()))
+
+    def _in_flight(self) -> Iterable[Task]:
+        return (task for worker in self._workers for task in worker.in_flight)
+
+    def _lose(self, worker: _RemoteWorker, reason: str) -> None:
+        """
+        Disconnects from a worker and returns the tasks it had in flight to the frontier.
+        """
+        LOGGER.warning(
+            "Lost worker %s (%s), reassigning its %d tasks",
+            _show_address(worker.address),
+            reason,
+            len(worker.in_flight),
+        )
+        worker.conn.close()
+        self._workers.remove(worker)
+        for task in worker.in_flight:
+            self._requeue(task)
+        if not self._workers:
+            LOGGER.warning("No workers are connected, waiting for workers to connect")
+
+    def _admit_connected(self) -> None:
+        while not self._connected.empty():
+            worker = self._connected.get()
+            LOGGER.info("Worker %s connected", _show_address(worker.address))
+            self._workers.append(worker)
+
+    def _dispatch(self) -> None:
+        while self._frontier and self._workers:
+            worker = min(self._workers, key=lambda worker: len(worker.in_flight))
+            if len(worker.in_flight) >= self._max_in_flight_per_worker:
+                break
+            task = self._frontier.pop()
+            worker.in_flight.append(task)
+            self._started(task)
+            try:
+                worker.conn.send(task)
+            except OSError as e:
+                self._lose(worker, str(e))
+
+    def _complete(self, worker: _RemoteWorker, message: TaskResult | WorkerFailed | Heartbeat) -> Sequence[str]:
+        worker.last_seen = monotonic()
+        match message:
+            case Heartbeat():
+                return []
+            case WorkerFailed(traceback=traceback):
+                # Other workers can still evaluate its tasks, unlike in the local coordinator where every worker runs
+                # the same way and would fail the same way.
+                self._lose(worker, f"failed:\n{traceback}")
+                return []
+            case TaskResult():
+                return self._completed(worker.in_flight.popleft(), message)
+
+    def _receive(self, worker: _RemoteWorker) -> list[str]:
+        """
+        Returns the results of every message waiting from a worker, losing it if it disconnected.
+        """
+        results: list[str] = []
+        try:
+            # The connection is ready, so the first receive does not block.
+            results.extend(self._complete(worker, worker.conn.recv()))
+            # A worker which failed was lost, closing its connection.
+            while not worker.conn.closed and worker.conn.poll():
+                results.extend(self._complete(worker, worker.conn.recv()))
+        except (EOFError, OSError) as e:
+            self._lose(worker, str(e) or "disconnected")
+        return results
+
+    def step(self, timeout: float | None) -> list[str]:
+        """
+        Dispatches work to idle workers and blocks for up to `timeout` seconds until workers send messages, returning
+        the results of every task completed. Workers which disconnected or stopped sending heartbeats are lost.
+        """
+        self._admit_connected()
+        self._dispatch()
+        results: list[str] = []
+        workers = {worker.conn: worker for worker in self._workers}
+        if workers:
+            for conn in wait(list(workers), timeout=timeout):
+                assert isinstance(conn, Connection)
+                results.extend(self._receive(workers[conn]))
+        elif timeout is not None:
+            time.sleep(timeout)
+
+        now = monotonic()
+        for worker in [worker for worker in self._workers if now - worker.last_seen > self._heartbeat_timeout]:
+            self._lose(worker, f"no heartbeat for {now - worker.last_seen:.1f}s")
+        self._dispatch()
+        return results
+
+    def shutdown(self) -> None:
+        self._admit_connected()
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.conn.close()
+        self._closed.set()
+        self._listener.close()
+        for process in self._processes:
+            process.join(timeout=10.0)
+            if process.is_alive():
+                LOGGER.warning("Worker %d did not exit, killing it", process.pid)
+                process.kill()
+                process.join()
+
+
+def _connect(address: Address, authkey: bytes, connect_timeout: float) -> Connection:
+    deadline = monotonic() + connect_timeout
+    while True:
+        try:
+            return Client(address, family="AF_INET", authkey=authkey)
+        except ConnectionRefusedError:
+            if monotonic() >= deadline:
+                raise
+            time.sleep(_CONNECT_RETRY_INTERVAL)
+
+
+def _send_heartbeats(conn: Connection, send_lock: Lock, interval: float, stop: Event) -> None:
+    while not stop.wait(interval):
+        try:
+            with send_lock:
+                conn.send(Heartbeat())
+        except OSError:
+            return
+
+
+def run_worker(
+    address: Address, authkey: bytes, cache: CacheOptions | None = None, connect_timeout: float = 60.0
+) -> None:
+    """
+    Connects to the coordinator listening on `address`, retrying for up to `connect_timeout` seconds, and evaluates
+    the tasks it hands out until it shuts down, caching evaluations in `cache` if given. Exits with code 1 if it failed,
+    after sending the coordinator why.
+    """
+    conn = _connect(address, authkey, connect_timeout)
+    welcome = conn.recv()
+    assert isinstance(welcome, Welcome)
+    LOGGER.info("Connected to %s", _show_address(address))
+    send_lock = Lock()
+    stop = Event()
+    heartbeats = Thread(
+        target=_send_heartbeats, args=(conn, send_lock, welcome.heartbeat_interval, stop), name="heartbeat", daemon=True
+    )
+    heartbeats.start()
+    try:
+        succeeded = worker_loop(conn, replace(welcome.options, cache=cache), send_lock)
+    finally:
+        stop.set()
+        heartbeats.join()
+    if not succeeded:
+        sys.exit(1)
@@ -0,0 +1,272 @@
+import os
+import socket
+import time
+import traceback
+from collections.abc import Mapping, Sequence
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, field, replace
+from logging import Logger
+from multiprocessing.connection import Connection
+from typing import Final
+
+import nix_eval_jobs.nix.eval.cache
+import nix_eval_jobs.nix.eval.evaluator
+import nix_eval_jobs.nix.eval.info
+import nix_eval_jobs.scheduler.dedup
+import nix_eval_jobs.tracing
+from nix_eval_jobs.logger import get_logger
+from nix_eval_jobs.nix.eval.cache import CacheOptions, EvalCache
+from nix_eval_jobs.nix.eval.evaluator import Evaluator, EvaluatorOptions
+from nix_eval_jobs.nix.eval.info import NixEvalResultGetInfo
+from nix_eval_jobs.output import FailureRecord
+from nix_eval_jobs.scheduler.exclusion import DEFAULT_EXCLUSIONS, ExclusionMatcher, ExclusionRules
+from nix_eval_jobs.scheduler.messages import EvalRecord, Task, TaskResult, WorkerFailed
+from nix_eval_jobs.tracing import TaskTrace
+
+LOGGER: Final[Logger] = get_logger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class WorkerOptions:
+    flakeref: str
+    root_attr_path: Sequence[str]
+    batch_size: int
+    # The name of the evaluator backend, or the import path of its factory (see nix_eval_jobs.nix.eval.evaluator).
+    backend: str
+    evaluator_options: EvaluatorOptions
+    cache: CacheOptions | None = None
+    # Number of samples to measure the cost of each included attribute with, if it is measured.
+    cost_samples: int | None = None
+    exclusions: ExclusionRules = field(default_factory=lambda: DEFAULT_EXCLUSIONS)
+    # Whether to probe scopes so they can be fingerprinted (see nix_eval_jobs.scheduler.dedup).
+    probe_scopes: bool = False
+    # Whether to record the spans of each task and send them back with its result (see nix_eval_jobs.tracing).
+    record_spans: bool = False
+    # Whether to report the attributes evaluated which are not included, so an incremental run can tell those the
+    # previous run included from those which were removed.
+    report_not_included: bool = False
+
+    def exclusion_matcher(self) -> ExclusionMatcher:
+        return ExclusionMatcher(self.exclusions, self.root_attr_path)
+
+    def cache_context(self, stats: bool) -> str:
+        """
+        Returns the context of evaluations cached by an evaluator of these options, given whether it reports stats.
+        """
+        return nix_eval_jobs.nix.eval.cache.evaluation_context(self.backend, stats, self.evaluator_options.nix_args)
+
+
+def force_root_recursion(options: WorkerOptions, info: NixEvalResultGetInfo) -> None:
+    if options.root_attr_path == info.value.attr_path:
+        # LOGGER.info("Setting recurse to true for the root attribute %s", root_attr_path_str)
+        info.value.recurse = True
+
+
+def needs_attr_names(task: Task, info: NixEvalResultGetInfo) -> bool:
+    """
+    Returns whether the names of the children of the attribute must be listed with a second evaluation.
+
+    info.nix returns the names of the children when it decides to recurse, so this is only needed when recursion was
+    forced (as it is for the root attribute).
+    """
+    return info.value.recurse and not task.refresh and info.value.attr_names is None
+
+
+def _failure_record(info: NixEvalResultGetInfo) -> str | None:
+    if (failure := info.failure) is None:
+        return None
+    return FailureRecord(
+        attr=info.value.attr,
+        attr_path=info.value.attr_path,
+        kind=failure.kind,
+        message=failure.message,
+        attempts=failure.attempts,
+        stderr=info.stderr,
+    ).model_dump_json(by_alias=True, indent=None)
+
+
+def build_result(
+    options: WorkerOptions,
+    task: Task,
+    infos: Sequence[NixEvalResultGetInfo],
+    listed_attr_names: Mapping[str, Sequence[str]],
+    exclusions: ExclusionMatcher,
+    batching: bool,
+) -> TaskResult:
+    """
+    Builds the result of a task from the info of each child and the names of the children listed for those which
+    needed it (see `needs_attr_names`), keyed by attribute.
+
+    Excluded children are dropped as they are discovered, so they are never made into tasks. Children which failed to
+    evaluate have a record, like included children, carrying the failure.
+    """
+    # Evaluators which cannot batch would evaluate a batch one child at a time anyway, so spread the children across
+    # tasks instead, where they can be evaluated in parallel.
+    batch_size = options.batch_size if batching else 1
+    results: list[EvalRecord] = []
+    discovered: list[tuple[Sequence[str], Sequence[str]]] = []
+    num_discovered = 0
+    num_excluded = 0
+    fingerprints: list[tuple[Sequence[str], str]] = []
+    not_included: list[str] = []
+    for info in infos:
+        attr_path = info.value.attr_path
+        if options.report_not_included and not info.value.include and info.failure is None:
+            not_included.append(info.value.attr)
+        if info.value.include or info.failure is not None:
+            # Produce newline delimited, minified JSON.
+            results.append(
+                EvalRecord(
+                    attr=info.value.attr,
+                    attr_path=attr_path,
+                    drv_path=info.value.drv_path,
+                    line=info.model_dump_json(
+                        by_alias=True, exclude=nix_eval_jobs.nix.eval.info.output_exclude(info), indent=None
+                    ),
+                    failure=_failure_record(info),
+                )
+            )
+
+        if info.value.recurse and not task.refresh:
+            child_attr_names = info.value.attr_names
+            if child_attr_names is None:
+                child_attr_names = listed_attr_names[info.value.attr]
+            if info.value.probe_drv_path is not None:
+                fingerprints.append((
+                    attr_path,
+                    nix_eval_jobs.scheduler.dedup.fingerprint(child_attr_names, info.value.probe_drv_path),
+                ))
+            included_attr_names = exclusions.filter(attr_path, child_attr_names)
+            num_discovered += len(child_attr_names)
+            num_excluded += len(child_attr_names) - len(included_attr_names)
+            discovered.extend(
+                (attr_path, included_attr_names[i : i + batch_size])
+                for i in range(0, len(included_attr_names), batch_size)
+            )
+
+    return TaskResult(
+        task.task_id,
+        results,
+        discovered,
+        num_discovered,
+        num_excluded,
+        len(infos),
+        fingerprints,
+        not_included=not_included,
+    )
+
+
+def process_task(
+    options: WorkerOptions,
+    task: Task,
+    evaluator: Evaluator,
+    exclusions: ExclusionMatcher,
+    cache: EvalCache | None = None,
+) -> TaskResult:
+    with nix_eval_jobs.tracing.span("evaluate"):
+        infos = nix_eval_jobs.nix.eval.info.get_info_many(
+            options.flakeref,
+            task.parent_attr_path,
+            task.child_names,
+            evaluator,
+            cache,
+            options.probe_scopes,
+            options.evaluator_options.validation,
+        )
+    listed_attr_names: dict[str, Sequence[str]] = {}
+    for info in infos:
+        force_root_recursion(options, info)
+        if needs_attr_names(task, info):
+            with nix_eval_jobs.tracing.span("attr-names"):
+                listed_attr_names[info.value.attr] = nix_eval_jobs.nix.eval.info.attr_names(
+                    options.flakeref, info.value.attr_path, evaluator, cache, options.evaluator_options.validation
+                ).value
+        if info.value.include and options.cost_samples is not None:
+            with nix_eval_jobs.tracing.span("cost"):
+                # Infos may come from the cache, whose stats would not be a sample of this run.
+                nix_eval_jobs.nix.eval.info.measure_cost(
+                    evaluator,
+                    options.flakeref,
+                    info,
+                    options.cost_samples,
+                    fresh=cache is None,
+                    probe_scopes=options.probe_scopes,
+                )
+
+    with nix_eval_jobs.tracing.span("build"):
+        return build_result(options, task, infos, listed_attr_names, exclusions, evaluator.capabilities.batching)
+
+
+def process_task_traced(
+    options: WorkerOptions,
+    task: Task,
+    evaluator: Evaluator,
+    exclusions: ExclusionMatcher,
+    cache: EvalCache | None,
+    worker: str,
+) -> TaskResult:
+    """
+    Processes a task as `process_task` does, sending back the spans recorded while processing it by `worker` with its
+    result if spans are recorded.
+    """
+    with nix_eval_jobs.tracing.recording(options.record_spans) as spans:
+        with nix_eval_jobs.tracing.span("task"):
+            result = process_task(options, task, evaluator, exclusions, cache)
+    if not options.record_spans:
+        return result
+    return replace(result, trace=TaskTrace(worker, spans, time.time()))
+
+
+def _serve(
+    conn: Connection,
+    options: WorkerOptions,
+    evaluator: Evaluator,
+    cache: EvalCache | None,
+    send_lock: AbstractContextManager[object],
+) -> None:
+    exclusions = options.exclusion_matcher()
+    # Workers may run on several machines (see nix_eval_jobs.scheduler.remote).
+    worker = f"worker {socket.gethostname()}:{os.getpid()}"
+    while (task := conn.recv()) is not None:
+        result = process_task_traced(options, task, evaluator, exclusions, cache, worker)
+        with send_lock:
+            conn.send(result)
+
+
+def worker_loop(
+    conn: Connection, options: WorkerOptions, send_lock: AbstractContextManager[object] = nullcontext()
+) -> bool:
+    """
+    Processes tasks received from the coordinator until told to stop (by receiving None), sending back a result for
+    each. Returns False if it failed, after sending the coordinator why.
+
+    `send_lock` is held while sending, so other threads can send on the connection too when it is a lock (see
+    `nix_eval_jobs.scheduler.remote`).
+    """
+    evaluator: Evaluator | None = None
+    cache: EvalCache | None = None
+    try:
+        # Creating these may fail too, such as when the cache cannot be opened, which is reported like any other
+        # failure.
+        evaluator = nix_eval_jobs.nix.eval.evaluator.create(options.backend, options.evaluator_options)
+        # Each worker has its own connection to the cache, since SQLite connections cannot be shared between processes.
+        cache = (
+            EvalCache(options.cache, options.cache_context(evaluator.capabilities.stats))
+            if options.cache is not None
+            else None
+        )
+        _serve(conn, options, evaluator, cache, send_lock)
+    except (EOFError, KeyboardInterrupt):
+        # The coordinator went away or we were interrupted along with it; there is no one to report to.
+        return True
+    except Exception:
+        with send_lock:
+            conn.send(WorkerFailed(traceback.format_exc()))
+        return False
+    finally:
+        if evaluator is not None:
+            evaluator.close()
+        if cache is not None:
+            cache.close()
+        conn.close()
+    return True
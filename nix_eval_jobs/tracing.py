@@ -0,0 +1,179 @@
+"""
+Spans: how long each step of a run took, such as waiting in the frontier, starting nix, waiting for it, and writing the
+output.
+
+Workers record the spans of each task into a list held in a context variable, so tasks processed at once in a single
+event loop (see `nix_eval_jobs.scheduler.async_coordinator`) each record their own, and send them back with the result
+of the task. Outside of `recording`, or when recording is disabled, `span` records nothing and costs next to nothing.
+
+The coordinator adds the spans of every task and its own to a `Recorder`, which totals them by name and, when tracing,
+keeps every one for a trace in the Chrome Trace Event Format, which can be opened with Perfetto or chrome://tracing.
+"""
+
+import json
+import time
+from collections.abc import Generator, Iterator, Mapping, Sequence
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Any, Final
+
+# Spans recorded for the task being processed, or None if spans are not being recorded.
+_SPANS: Final[ContextVar[list["Span"] | None]] = ContextVar("spans", default=None)
+
+# Chrome traces put every track in a process; a run is a single one.
+_TRACE_PID: Final[int] = 1
+
+
+@dataclass(frozen=True, slots=True)
+class Span:
+    name: str
+    # Wall clock time the span started at, so spans recorded on different machines can be lined up.
+    start: float
+    duration: float
+
+
+@dataclass(frozen=True, slots=True)
+class TaskTrace:
+    """
+    The spans a worker recorded while processing a task, sent back with its result.
+    """
+
+    # The worker which processed the task, shown as its track in a trace.
+    worker: str
+    spans: Sequence[Span]
+    # Wall clock time the worker finished processing the task, after which it sent the result.
+    finished_at: float
+
+
+@contextmanager
+def span(name: str) -> Generator[None, None, None]:
+    """
+    Records the time taken by the body as a span named `name` of the task being processed, if spans are recorded.
+    """
+    if (spans := _SPANS.get()) is None:
+        yield
+        return
+    start = time.time()
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        spans.append(Span(name, start, perf_counter() - started))
+
+
+@contextmanager
+def recording(enabled: bool) -> Generator[list[Span], None, None]:
+    """
+    Records the spans of the body into the list returned, if `enabled`.
+    """
+    spans: list[Span] = []
+    token = _SPANS.set(spans if enabled else None)
+    try:
+        yield spans
+    finally:
+        _SPANS.reset(token)
+
+
+@dataclass(slots=True)
+class SpanTotal:
+    count: int = 0
+    seconds: float = 0.0
+
+
+@dataclass(frozen=True, slots=True)
+class _TraceEvent:
+    track: str
+    span: Span
+    # Whether spans on the track overlap, as the time tasks wait in the frontier does, which traces show differently.
+    overlapping: bool
+
+
+class Recorder:
+    """
+    Totals spans by name and, when `tracing`, keeps every span and counter sample for a Chrome trace. Spans may be added
+    from any thread.
+    """
+
+    def __init__(self, tracing: bool = False) -> None:
+        self.tracing: bool = tracing
+        self._start: float = time.time()
+        self._lock: Lock = Lock()
+        self._totals: dict[str, SpanTotal] = {}
+        self._events: list[_TraceEvent] = []
+        self._counters: list[tuple[float, Mapping[str, float]]] = []
+
+    def add(self, track: str, span: Span, overlapping: bool = False) -> None:
+        with self._lock:
+            total = self._totals.setdefault(span.name, SpanTotal())
+            total.count += 1
+            total.seconds += span.duration
+            if self.tracing:
+                self._events.append(_TraceEvent(track, span, overlapping))
+
+    def add_task(self, trace: TaskTrace) -> None:
+        """
+        Adds the spans of a task as processed by a worker, and the time its result took to reach the coordinator.
+        """
+        for task_span in trace.spans:
+            self.add(trace.worker, task_span)
+        # Clocks of workers on other machines may be behind.
+        self.add("results", Span("receive", trace.finished_at, max(0.0, time.time() - trace.finished_at)), True)
+
+    @contextmanager
+    def span(self, track: str, name: str) -> Generator[None, None, None]:
+        """
+        Adds the time taken by the body as a span named `name` on `track`.
+        """
+        start = time.time()
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(track, Span(name, start, perf_counter() - started))
+
+    def add_counters(self, at: float, counters: Mapping[str, float]) -> None:
+        """
+        Adds a sample of counters taken at wall clock time `at`, shown as graphs in a trace.
+        """
+        if self.tracing:
+            with self._lock:
+                self._counters.append((at, counters))
+
+    def totals(self) -> dict[str, SpanTotal]:
+        with self._lock:
+            return {name: SpanTotal(total.count, total.seconds) for name, total in self._totals.items()}
+
+    def _microseconds(self, at: float) -> float:
+        return (at - self._start) * 1e6
+
+    def _trace_events(self) -> Iterator[dict[str, Any]]:
+        tids: dict[str, int] = {}
+        for event_id, event in enumerate(self._events):
+            if (tid := tids.get(event.track)) is None:
+                tid = tids[event.track] = len(tids)
+                yield {"name": "thread_name", "ph": "M", "pid": _TRACE_PID, "tid": tid, "args": {"name": event.track}}
+            start = self._microseconds(event.span.start)
+            common = {"name": event.span.name, "cat": event.track, "pid": _TRACE_PID, "tid": tid}
+            if event.overlapping:
+                # Async events may overlap, and are each shown on a row of their own.
+                yield common | {"ph": "b", "id": event_id, "ts": start}
+                yield common | {"ph": "e", "id": event_id, "ts": start + event.span.duration * 1e6}
+            else:
+                yield common | {"ph": "X", "ts": start, "dur": event.span.duration * 1e6}
+        for at, counters in self._counters:
+            for name, value in counters.items():
+                yield {"name": name, "ph": "C", "pid": _TRACE_PID, "ts": self._microseconds(at), "args": {name: value}}
+
+    def write_trace(self, path: Path) -> None:
+        """
+        Writes every span and counter sample as a Chrome trace.
+        """
+        with self._lock, path.open("w", encoding="utf-8") as trace_file:
+            _ = trace_file.write('{"displayTimeUnit":"ms","traceEvents":[\n')
+            for i, event in enumerate(self._trace_events()):
+                _ = trace_file.write(f"{',' if i else ''}{json.dumps(event, separators=(',', ':'))}\n")
+            _ = trace_file.write("]}\n")